@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "taskmaster"))
+
+from output import CHUNK_SIZE, LinePrefixer  # noqa: E402
+
+TARGET = 200 * 1024 * 1024
+TOTAL = 1024 * 1024 * 1024
+
+
+def chunks(line_length: int):
+    line = b"x" * (line_length - 1) + b"\n"
+    stream = line * (CHUNK_SIZE // len(line) + 2)
+    # Chunks never end on a line boundary, like reads from a busy pipe
+    return [stream[i:i + CHUNK_SIZE] for i in range(0, len(line) * 7, len(line))]
+
+
+def bench(line_length: int) -> float:
+    samples = chunks(line_length)
+    prefixer = LinePrefixer("nginx:111")
+    count = TOTAL // CHUNK_SIZE
+    start = time.perf_counter()
+    for i in range(count):
+        prefixer.feed(samples[i % len(samples)])
+    return count * CHUNK_SIZE / (time.perf_counter() - start)
+
+
+def main():
+    ok = True
+    for line_length in (40, 80, 200, 1024):
+        rate = bench(line_length)
+        ok = ok and rate >= TARGET
+        print("%5d byte lines: %8.1f MB/s" % (line_length, rate / 2 ** 20))
+    print("target %d MB/s: %s" % (TARGET // 2 ** 20, "ok" if ok else "MISSED"))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
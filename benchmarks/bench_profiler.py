@@ -0,0 +1,54 @@
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "taskmaster"))
+
+from profiler import SamplingProfiler  # noqa: E402
+
+
+def workload(rounds: int) -> float:
+    # Deep-ish stacks, like the event loop dispatching into handlers
+    def leaf(n):
+        return sum(range(n))
+
+    def middle(n):
+        return leaf(n) + leaf(n // 2)
+
+    start = time.process_time()
+    for _ in range(rounds):
+        middle(2000)
+    return time.process_time() - start
+
+
+def main():
+    rounds = 20000
+    repeats = 7
+    workload(rounds // 10)
+    for interval in (0.01, 0.001):
+        # Baseline and profiled runs alternate so that drift in CPU speed
+        # (frequency scaling, noisy neighbours) hits both alike
+        baselines, elapsed, slowdowns, samples, handler = [], [], [], [], []
+        for _ in range(repeats):
+            baselines.append(workload(rounds))
+            profiler = SamplingProfiler(interval)
+            profiler.start()
+            elapsed.append(workload(rounds))
+            profiler.stop()
+            report = profiler.report()
+            slowdowns.append(elapsed[-1] / baselines[-1] - 1)
+            samples.append(report["samples"])
+            handler.append(report["overhead_percent"])
+        print("interval %5.1fms baseline %.3fs, profiled %.3fs CPU, "
+              "%+.2f%% slowdown, %d samples, handler time %.3f%% "
+              "(medians of %d)" % (
+                  interval * 1000, statistics.median(baselines),
+                  statistics.median(elapsed),
+                  100 * statistics.median(slowdowns),
+                  statistics.median(samples), statistics.median(handler),
+                  repeats))
+
+
+if __name__ == "__main__":
+    main()
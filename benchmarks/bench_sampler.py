@@ -0,0 +1,48 @@
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "taskmaster"))
+
+from sampler import ProcSampler  # noqa: E402
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    children = [subprocess.Popen(["sleep", "600"]) for _ in range(count)]
+    pids = [child.pid for child in children]
+    try:
+        for label, sampler in (("reused fds", ProcSampler()),
+                               ("open per cycle", ProcSampler(max_fds=0))):
+            sampler.sample(pids)
+            cycles = 20
+            start = time.perf_counter()
+            for _ in range(cycles):
+                sampler.sample(pids)
+            per_cycle = (time.perf_counter() - start) / cycles
+            sampler.begin(pids)
+            slices = []
+            while True:
+                start = time.perf_counter()
+                more = sampler.step(256)
+                slices.append(time.perf_counter() - start)
+                if not more:
+                    break
+            print("%-15s %d pids: %7.2f ms/cycle, %6.2f ms per 10k pids, "
+                  "%5.2f ms per 256-pid slice" % (
+                      label, count, per_cycle * 1000, per_cycle * 1e7 / count,
+                      max(slices) * 1000))
+            sampler.clear()
+    finally:
+        for child in children:
+            child.kill()
+        for child in children:
+            child.wait()
+
+
+if __name__ == "__main__":
+    main()
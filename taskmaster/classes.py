@@ -1,7 +1,10 @@
 import yaml
-from pydantic import BaseModel, ValidationError
+from pydantic import (BaseModel, ValidationError, field_validator,
+                      model_validator)
 from typing import Dict, Union, List, Optional, Any
 
+from events import event_type
+
 
 class ProgramConfig(BaseModel):
     cmd: str
@@ -18,10 +21,107 @@ class ProgramConfig(BaseModel):
     stdout: Optional[str] = None
     stderr: Optional[str] = None
     env: Optional[Dict[str, Any]] = None
+    logprefix: bool = False
+    mergelogs: bool = False
+    events: Optional[List[str]] = None
+    batchsize: int = 100
+    batchlatency: float = 0.5
+    # Programs with a lower priority start before and stop after those
+    # with a higher one
+    priority: int = 999
+    # Programs whose instances must all be RUNNING before this one starts,
+    # and which stop only once this one stopped
+    depends_on: List[str] = []
+
+    @field_validator("events")
+    @classmethod
+    def known_events(cls, names: Optional[List[str]]) -> Optional[List[str]]:
+        for name in names or ():
+            event_type(name)
+        return names
+
+
+class DaemonConfig(BaseModel):
+    socket: str = "/tmp/taskmaster.sock"
+    statefile: Optional[str] = None
+    snapshotinterval: int = 5
+    trackinterval: float = 5
+    cgroup: Optional[str] = None
+    sampleinterval: float = 5
+    metrics: Optional[str] = None
+    tracefile: Optional[str] = None
+    journal: Optional[str] = None
+    journalsync: float = 1
+    tracers: List[str] = []
+
+
+def dependency_cycle(graph: Dict[str, List[str]]) -> Optional[List[str]]:
+    # A cycle of the graph as a path that ends where it starts, if any
+    visiting: List[str] = []
+    done = set()
+
+    def visit(node: str) -> Optional[List[str]]:
+        if node in visiting:
+            return visiting[visiting.index(node):] + [node]
+        if node in done:
+            return None
+        visiting.append(node)
+        for successor in graph[node]:
+            cycle = visit(successor)
+            if cycle:
+                return cycle
+        visiting.pop()
+        done.add(node)
+        return None
+
+    for node in graph:
+        cycle = visit(node)
+        if cycle:
+            return cycle
+    return None
 
 
 class ConfigYAML(BaseModel):
     programs: Dict[str, ProgramConfig]
+    # Named sets of programs, targeted as group:<name>
+    groups: Dict[str, List[str]] = {}
+    taskmasterd: DaemonConfig = DaemonConfig()
+
+    @model_validator(mode="after")
+    def known_programs(self) -> "ConfigYAML":
+        for group, programs in self.groups.items():
+            for program in programs:
+                if program not in self.programs:
+                    raise ValueError("group %s: no such program %r"
+                                     % (group, program))
+        for program, config in self.programs.items():
+            for dependency in config.depends_on:
+                if dependency not in self.programs:
+                    raise ValueError("%s depends on unknown program %r"
+                                     % (program, dependency))
+        cycle = dependency_cycle({program: config.depends_on for program,
+                                  config in self.programs.items()})
+        if cycle:
+            raise ValueError("dependency cycle: %s" % " -> ".join(cycle))
+        return self
+
+
+class ConfigError(Exception):
+    pass
+
+
+def validation_messages(error: ValidationError) -> List[str]:
+    # One line per error, with the message of the ValueError a validator
+    # raised rather than pydantic's wrapping of it
+    messages = []
+    for details in error.errors():
+        cause = details.get("ctx", {}).get("error")
+        message = str(cause) if isinstance(cause, ValueError) \
+            else details["msg"]
+        location = ".".join(str(part) for part in details["loc"])
+        messages.append("%s: %s" % (location, message) if location
+                        else message)
+    return messages
 
 
 class Config:
@@ -32,7 +132,7 @@ class Config:
                     value = yaml.safe_load(file)
                 self.config = ConfigYAML(**value)
             except ValidationError as e:
-                print(e.errors())
+                raise ConfigError("\n".join(validation_messages(e)))
         elif path.endswith(".ini"):
             print("coucou")
         else:
@@ -0,0 +1,650 @@
+import array
+import base64
+import fnmatch
+import heapq
+import itertools
+import json
+import logging
+import os
+import selectors
+import socket
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tracing
+from events import (EVENT_NAMES, Event, ProcessLogEvent, ProcessStateEvent,
+                    concrete_types, event_type)
+from journal import NO_EXIT_CODE
+from process import STATE_NAMES
+from profiler import profile_for
+from rolling import RollingRestart
+
+logger = logging.getLogger("taskmasterd")
+
+# Requests and responses are single-line JSON objects. Every request carries
+# an "id" echoed in its response, so a client may pipeline requests.
+MAX_REQUEST = 1 << 20
+# A subscriber that lets this much output pile up is disconnected
+MAX_BACKLOG = 4 << 20
+# Status rows per reply when the client does not ask for a chunk size
+STATUS_CHUNK = 500
+STATE_IDS = {name: state for state, name in STATE_NAMES.items()}
+# array typecodes of the columns command
+COLUMN_TYPES = {"pids": "i", "states": "H", "started": "d", "exitcodes": "i"}
+
+COMMANDS: Dict[str, Callable] = {}
+DEFERRED = set()
+
+
+class CommandError(Exception):
+    pass
+
+
+def command(name: str, deferred: bool = False):
+    # A deferred handler gets a Reply as third argument and answers through
+    # it later instead of returning its result
+    def register(handler: Callable) -> Callable:
+        COMMANDS[name] = handler
+        if deferred:
+            DEFERRED.add(name)
+        return handler
+    return register
+
+
+def encode(message: Dict) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+class ControlConnection:
+    def __init__(self, server: "ControlServer", sock: socket.socket):
+        self.server = server
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = b""
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
+        self.subscriptions: Dict[object, "Subscription"] = {}
+        sock.setblocking(False)
+
+    def on_event(self, mask: int) -> None:
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ and self.sock is not None:
+            self.receive()
+
+    def receive(self) -> None:
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            return
+        self.inbuf += data
+        lines = self.inbuf.split(b"\n")
+        self.inbuf = lines.pop()
+        if len(self.inbuf) > MAX_REQUEST:
+            self.close()
+            return
+        for line in lines:
+            if line.strip():
+                self.server.dispatch(self, line)
+
+    def send(self, message: Dict) -> None:
+        if self.sock is None:
+            return
+        self.outbuf += encode(message)
+        self.flush()
+
+    def flush(self) -> None:
+        while self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close()
+                return
+            del self.outbuf[:sent]
+        events = selectors.EVENT_READ
+        if self.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.server.selector.modify(self.fd, events, self.on_event)
+
+    def close(self) -> None:
+        if self.sock is None:
+            return
+        for subscription in list(self.subscriptions.values()):
+            subscription.cancel()
+        self.server.selector.unregister(self.fd)
+        self.server.connections.discard(self)
+        self.sock.close()
+        self.sock = None
+
+
+class Reply:
+    def __init__(self, connection: ControlConnection, request_id):
+        self.connection = connection
+        self.id = request_id
+
+    def send(self, result) -> None:
+        self.connection.send({"id": self.id, "ok": True, "result": result})
+
+    def fail(self, error: str) -> None:
+        self.connection.send({"id": self.id, "ok": False, "error": error})
+
+
+def wire_event(event: Event) -> Dict:
+    # Processes, programs and states stay ids on the wire: the subscribe
+    # reply carries the tables to resolve them
+    payload = event.payload()
+    for key, value in payload.items():
+        if isinstance(value, bytes):
+            payload[key] = value.decode("utf-8", "replace")
+    payload["event"] = EVENT_NAMES[type(event)]
+    payload["serial"] = event.serial
+    return payload
+
+
+class Subscription:
+    # Streams matching events as {"id": <subscribe id>, "event": {...}}.
+    # State changes are coalesced per instance until the end of the event
+    # loop iteration: ten transitions of one instance in a tick go out as
+    # its final state with "count": 10 and the state it started from.
+    def __init__(self, connection: ControlConnection, request_id,
+                 programs: List[str], instances: Optional[Tuple[int, int]],
+                 types: List[type]):
+        self.connection = connection
+        self.server = connection.server
+        self.id = request_id
+        # Filters are resolved once into a flag per process id
+        names = self.server.supervisor.names
+        wanted = [not programs or any(fnmatch.fnmatchcase(program, pattern)
+                                      for pattern in programs)
+                  for program in names.programs]
+        self.allowed = bytearray(
+            wanted[program_id] and (instances is None
+                                    or instances[0] <= instance
+                                    <= instances[1])
+            for program_id, instance in names.processes)
+        self.pending: Dict[int, list] = {}
+        self.ordered: List[Event] = []
+        self.dirty = False
+        bus = self.server.supervisor.events
+        for event_class in types:
+            for subclass in concrete_types(event_class):
+                if issubclass(subclass, ProcessStateEvent):
+                    bus.subscribe(subclass, self.coalesce)
+                elif issubclass(subclass, ProcessLogEvent):
+                    bus.subscribe(subclass, self.append_process)
+                else:
+                    bus.subscribe(subclass, self.append)
+        connection.subscriptions[request_id] = self
+
+    def coalesce(self, event: ProcessStateEvent) -> None:
+        if not self.allowed[event.process]:
+            return
+        entry = self.pending.get(event.process)
+        if entry is None:
+            self.pending[event.process] = [event, event.from_state, 1]
+        else:
+            entry[0] = event
+            entry[2] += 1
+        self.mark()
+
+    def append_process(self, event: ProcessLogEvent) -> None:
+        if self.allowed[event.process]:
+            self.append(event)
+
+    def append(self, event: Event) -> None:
+        self.ordered.append(event)
+        self.mark()
+
+    def mark(self) -> None:
+        if not self.dirty:
+            self.dirty = True
+            self.server.dirty.append(self)
+
+    def flush(self) -> None:
+        self.dirty = False
+        connection = self.connection
+        for event in self.ordered:
+            connection.outbuf += encode({"id": self.id,
+                                         "event": wire_event(event)})
+        for event, from_state, count in self.pending.values():
+            payload = wire_event(event)
+            payload["from_state"] = from_state
+            payload["count"] = count
+            connection.outbuf += encode({"id": self.id, "event": payload})
+        self.ordered = []
+        self.pending = {}
+        if len(connection.outbuf) > MAX_BACKLOG:
+            logger.warning("event subscriber is too slow, disconnecting")
+            connection.close()
+            return
+        connection.flush()
+
+    def cancel(self) -> None:
+        self.server.supervisor.events.unsubscribe(self.coalesce)
+        self.server.supervisor.events.unsubscribe(self.append_process)
+        self.server.supervisor.events.unsubscribe(self.append)
+        self.connection.subscriptions.pop(self.id, None)
+        self.ordered = []
+        self.pending = {}
+
+
+class ControlServer:
+    def __init__(self, supervisor, path: str):
+        self.supervisor = supervisor
+        self.selector = supervisor.selector
+        self.path = path
+        self.connections = set()
+        self.dirty: List[Subscription] = []
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+
+    def accept(self, mask: int) -> None:
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            connection = ControlConnection(self, sock)
+            self.connections.add(connection)
+            self.selector.register(connection.fd, selectors.EVENT_READ,
+                                   connection.on_event)
+
+    def dispatch(self, connection: ControlConnection, line: bytes) -> None:
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            name = request.get("cmd")
+            handler = COMMANDS.get(name)
+            requests = self.supervisor.metrics.requests
+            requests.labels(name if handler else "unknown").value += 1
+            if handler is None:
+                raise CommandError("unknown command %r" % name)
+            if self.supervisor.tracer.command:
+                self.supervisor.tracer.emit(tracing.COMMAND, name, 0, 0,
+                                            connection.fd)
+            args = request.get("args") or {}
+            if name in DEFERRED:
+                handler(self.supervisor, args, Reply(connection, request_id))
+                return
+            result = handler(self.supervisor, args)
+        except CommandError as e:
+            connection.send({"id": request_id, "ok": False, "error": str(e)})
+        except (ValueError, AttributeError, TypeError, IndexError,
+                KeyError) as e:
+            connection.send({"id": request_id, "ok": False,
+                             "error": "bad request: %s" % e})
+        else:
+            connection.send({"id": request_id, "ok": True, "result": result})
+
+    def flush_streams(self) -> None:
+        dirty, self.dirty = self.dirty, []
+        for subscription in dirty:
+            if subscription.connection.sock is not None:
+                subscription.flush()
+
+    def close(self) -> None:
+        self.flush_streams()
+        for connection in list(self.connections):
+            connection.close()
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+@command("stats")
+def stats(supervisor, args: Dict) -> List[Dict]:
+    program = args.get("program")
+    if program is not None and program not in supervisor.config.programs:
+        raise CommandError("no such program %r" % program)
+    return supervisor.metrics.stats(program, bool(args.get("reset")))
+
+
+def resolve(supervisor, args: Dict) -> List:
+    # Instances named by args["targets"], each once, in target order
+    targets = args.get("targets")
+    if not targets:
+        raise CommandError("no target given")
+    table = supervisor.table
+    seen = bytearray(len(table))
+    processes = []
+    for target in targets:
+        process_ids = supervisor.names.resolve(target)
+        if process_ids is None:
+            raise CommandError("no such process %r" % target)
+        for process_id in process_ids:
+            if not seen[process_id]:
+                seen[process_id] = 1
+                processes.append(table[process_id])
+    return processes
+
+
+@command("start")
+def start(supervisor, args: Dict) -> List[str]:
+    if supervisor.stopping:
+        raise CommandError("shutting down")
+    processes = resolve(supervisor, args)
+    supervisor.journal_command("start", processes)
+    processes = supervisor.start_processes(processes)
+    return [process.name for process in processes]
+
+
+@command("stop")
+def stop(supervisor, args: Dict) -> List[str]:
+    processes = resolve(supervisor, args)
+    supervisor.journal_command("stop", processes)
+    processes = supervisor.stop_processes(processes)
+    return [process.name for process in processes]
+
+
+@command("restart")
+def restart(supervisor, args: Dict) -> List[str]:
+    if supervisor.stopping:
+        raise CommandError("shutting down")
+    processes = resolve(supervisor, args)
+    supervisor.journal_command("restart", processes)
+    processes = supervisor.restart_processes(processes)
+    return [process.name for process in processes]
+
+
+@command("rolling-restart", deferred=True)
+def rolling_restart(supervisor, args: Dict, reply: Reply) -> None:
+    # Streams {"batch", "batches", "processes"} as each batch is through,
+    # then replies once the rollout is over
+    if supervisor.stopping:
+        raise CommandError("shutting down")
+    processes = resolve(supervisor, args)
+    size = int(args.get("batch", 1))
+    if size <= 0:
+        raise CommandError("batch size must be positive")
+    timeout = args.get("timeout")
+
+    def progress(batch: int, batches: int, names: List[str]) -> None:
+        reply.connection.send({"id": reply.id, "event": {
+            "batch": batch, "batches": batches, "processes": names}})
+
+    def done(error: Optional[str]) -> None:
+        if error is None:
+            reply.send({"restarted": len(processes),
+                        "batches": rollout.batches})
+        else:
+            reply.fail(error)
+
+    rollout = RollingRestart(
+        supervisor, processes, size, bool(args.get("wait_running")),
+        None if timeout is None else float(timeout), progress, done)
+    supervisor.journal_command("rolling-restart", processes)
+    rollout.start()
+
+
+@command("profile", deferred=True)
+def profile(supervisor, args: Dict, reply: Reply) -> None:
+    if supervisor.profiler is not None:
+        raise CommandError("a profile is already running")
+    seconds = float(args.get("seconds", 10))
+    interval = float(args.get("interval", 0.01))
+    if seconds <= 0 or interval <= 0:
+        raise CommandError("seconds and interval must be positive")
+    profile_for(supervisor, seconds, interval, reply.send)
+
+
+@command("subscribe", deferred=True)
+def subscribe(supervisor, args: Dict, reply: Reply) -> None:
+    if reply.id in reply.connection.subscriptions:
+        raise CommandError("subscription %r already exists" % reply.id)
+    programs = args.get("programs") or []
+    names = args.get("events") or ["PROCESS_STATE"]
+    instances = args.get("instances")
+    if instances is not None:
+        low, high = (int(bound) for bound in instances)
+        instances = (low, high)
+    types = [event_type(name) for name in names]
+    Subscription(reply.connection, reply.id, list(programs), instances, types)
+    result = {"events": [name.upper() for name in names],
+              "states": STATE_NAMES}
+    result.update(supervisor.names.export())
+    reply.send(result)
+
+
+@command("unsubscribe", deferred=True)
+def unsubscribe(supervisor, args: Dict, reply: Reply) -> None:
+    subscription = reply.connection.subscriptions.get(args.get("subscription"))
+    if subscription is None:
+        raise CommandError("no such subscription")
+    subscription.cancel()
+    reply.send(True)
+
+
+@command("history")
+def history(supervisor, args: Dict) -> List[Dict]:
+    if supervisor.journal is None:
+        raise CommandError("no journal configured")
+    program = args.get("program")
+    if program is None:
+        raise CommandError("history needs a program")
+    return supervisor.journal.history(program, int(args.get("limit", 50)))
+
+
+def resources(supervisor, process) -> Optional[Dict]:
+    usage = supervisor.tracker.resources(process)
+    if usage is not None:
+        return usage
+    samples = supervisor.sampler.samples
+    pids = [process.pid] + list(process.members)
+    found = [samples[pid] for pid in pids if pid in samples]
+    if not found:
+        return None
+    return {
+        "cpu": round(sum(sample.cpu_percent for sample in found), 1),
+        "rss": sum(sample.rss for sample in found),
+        "threads": sum(sample.threads for sample in found),
+        "fds": sum(sample.fds for sample in found if sample.fds > 0),
+        "processes": len(found),
+    }
+
+
+# Sort keys of status rows. The process id is appended to every key, so
+# keys are unique and the key of the last row sent is a cursor that stays
+# valid while processes change between two chunks.
+STATUS_SORTS: Dict[str, Callable] = {
+    "id": lambda supervisor, process: (),
+    "name": lambda supervisor, process: (supervisor.names.rank[process.id],),
+    "state": lambda supervisor, process: (process.state,),
+}
+# Length of the cursor of each sort: its key and the process id
+CURSOR_LENGTHS = {"id": 1, "name": 2, "state": 2}
+
+
+def status_cursor(cursor, sort: str) -> Optional[tuple]:
+    if cursor is None:
+        return None
+    if (not isinstance(cursor, (list, tuple))
+            or len(cursor) != CURSOR_LENGTHS[sort]
+            or not all(type(field) is int and field >= 0
+                       for field in cursor)):
+        raise CommandError("bad cursor %r for sort %r" % (cursor, sort))
+    return tuple(cursor)
+
+
+def status_filter(supervisor, args: Dict, now: float) -> Optional[Callable]:
+    checks = []
+    programs = args.get("programs")
+    if programs:
+        allowed = bytearray(len(supervisor.names.programs))
+        for program_id, program in enumerate(supervisor.names.programs):
+            if any(fnmatch.fnmatchcase(program, pattern)
+                   for pattern in programs):
+                allowed[program_id] = 1
+        checks.append(lambda process: allowed[process.program_id])
+    min_uptime = args.get("min_uptime")
+    if min_uptime is not None:
+        started = now - float(min_uptime)
+        checks.append(lambda process: process.pid
+                      and process.start_time <= started)
+    max_uptime = args.get("max_uptime")
+    if max_uptime is not None:
+        started = now - float(max_uptime)
+        checks.append(lambda process: not process.pid
+                      or process.start_time >= started)
+    if not checks:
+        return None
+    return lambda process: all(check(process) for check in checks)
+
+
+def status_rows(supervisor, args: Dict, limit: int) -> List:
+    # Returns up to limit + 1 processes following the cursor, so that the
+    # caller knows whether another chunk follows
+    sort = args.get("sort", "id")
+    key = STATUS_SORTS.get(sort)
+    if key is None:
+        raise CommandError("unknown sort %r, expected one of %s" % (
+            sort, ", ".join(STATUS_SORTS)))
+    after = status_cursor(args.get("cursor"), sort)
+    match = status_filter(supervisor, args, time.monotonic())
+    table = supervisor.table
+    try:
+        states = sorted({STATE_IDS[state.upper()]
+                         for state in args.get("states") or ()})
+    except KeyError as e:
+        raise CommandError("unknown state %s" % e)
+    since = args.get("since")
+    if since is not None:
+        # Few instances changed: sort just those
+        processes = (table[process_id]
+                     for process_id in supervisor.changed_since(int(since)))
+        if states:
+            processes = (process for process in processes
+                         if process.state in states)
+        if match is not None:
+            processes = filter(match, processes)
+        keyed = ((key(supervisor, process) + (process.id,), process)
+                 for process in processes)
+        if after is not None:
+            keyed = (item for item in keyed if item[0] > after)
+        return [process for _, process in heapq.nsmallest(
+            limit + 1, keyed, key=lambda item: item[0])]
+    if sort == "state":
+        processes = status_by_state(supervisor, states, after)
+    else:
+        # The table and the name order are indexes already: resume right
+        # after the cursor and stop once the chunk is full
+        order = range(len(table)) if sort == "id" else supervisor.names.order
+        start = after[0] + 1 if after is not None else 0
+        processes = (table[process_id]
+                     for process_id in itertools.islice(order, start, None))
+        if states:
+            processes = (process for process in processes
+                         if process.state in states)
+    if match is not None:
+        processes = filter(match, processes)
+    return list(itertools.islice(processes, limit + 1))
+
+
+def status_by_state(supervisor, states: List[int], after: Optional[tuple]):
+    # The instances of each state in turn, in id order, resuming after the
+    # cursor; states without instances are skipped through the state index
+    table = supervisor.table
+    for state in states or sorted(supervisor.by_state):
+        if after is not None and state < after[0]:
+            continue
+        remaining = len(supervisor.by_state[state])
+        start = 0
+        if after is not None and state == after[0]:
+            start = after[1] + 1
+        for process in itertools.islice(table, start, None):
+            if not remaining:
+                break
+            if process.state == state:
+                remaining -= 1
+                yield process
+
+
+@command("status")
+def status(supervisor, args: Dict) -> Dict:
+    # Rows come in chunks; a client asks for the next chunk with the cursor
+    # of the previous reply until the cursor is null, so that neither side
+    # holds a large table at once. With "since", only instances changed
+    # after that table version are listed; a poller passes the version of
+    # the first chunk of its previous poll, so nothing is missed when the
+    # table changes between chunks.
+    version = supervisor.version
+    limit = int(args.get("limit", STATUS_CHUNK))
+    if limit <= 0:
+        limit = len(supervisor.table)
+    processes = status_rows(supervisor, args, limit)
+    cursor = None
+    if len(processes) > limit:
+        del processes[limit:]
+        last = processes[-1]
+        sort = STATUS_SORTS[args.get("sort", "id")]
+        cursor = sort(supervisor, last) + (last.id,)
+    with_resources = bool(args.get("resources"))
+    if with_resources and not supervisor.config.taskmasterd.sampleinterval:
+        supervisor.sample(processes)
+    now = time.monotonic()
+    rows = []
+    for process in processes:
+        row = {
+            "name": process.name,
+            "state": STATE_NAMES[process.state],
+            "pid": process.pid,
+            "uptime": round(now - process.start_time, 1) if process.pid else 0,
+            "exitcode": process.exit_code,
+        }
+        if with_resources:
+            row["resources"] = resources(supervisor, process)
+        rows.append(row)
+    return {"rows": rows, "cursor": cursor, "version": version}
+
+
+@command("columns")
+def columns(supervisor, args: Dict) -> Dict:
+    # The whole table as packed native arrays in process id order, base64
+    # encoded, for agents that decode them with array.frombytes or NumPy.
+    # Names do not change while the daemon runs, so an agent asks for them
+    # once. Start times are wall clock, 0 when not running; a missing exit
+    # code is NO_EXIT_CODE.
+    table = supervisor.table
+    now = time.monotonic()
+    wall = time.time() - now
+    result = {
+        "version": supervisor.version,
+        "count": len(table),
+        "byteorder": sys.byteorder,
+        "typecodes": COLUMN_TYPES,
+        "pids": array.array(COLUMN_TYPES["pids"],
+                            [process.pid for process in table]),
+        "states": array.array(COLUMN_TYPES["states"],
+                              [process.state for process in table]),
+        "started": array.array(COLUMN_TYPES["started"], [
+            wall + process.start_time if process.pid else 0.0
+            for process in table]),
+        "exitcodes": array.array(COLUMN_TYPES["exitcodes"], [
+            NO_EXIT_CODE if process.exit_code is None else process.exit_code
+            for process in table]),
+    }
+    for column in COLUMN_TYPES:
+        result[column] = base64.b64encode(result[column]).decode("ascii")
+    if args.get("names"):
+        result.update(supervisor.names.export())
+        result["statenames"] = STATE_NAMES
+    return result
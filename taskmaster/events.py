@@ -1,2 +1,183 @@
+import logging
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger("taskmasterd")
+
+
+class Event:
+    __slots__ = ("serial",)
+
+    def payload(self) -> Dict:
+        return {name: getattr(self, name) for cls in type(self).__mro__
+                for name in getattr(cls, "__slots__", ()) if name != "serial"}
+
+
+# Process events name their process and program by their ids in the
+# supervisor's NameTable
+class ProcessStateEvent(Event):
+    __slots__ = ("process", "program", "instance", "pid", "from_state",
+                 "exit_code")
+
+    def __init__(self, process: int, program: int, instance: int, pid: int,
+                 from_state: int, exit_code: Optional[int]):
+        self.process = process
+        self.program = program
+        self.instance = instance
+        self.pid = pid
+        self.from_state = from_state
+        self.exit_code = exit_code
+
+
+class ProcessStateStoppedEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateStartingEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateRunningEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateBackoffEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateStoppingEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateExitedEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateFatalEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessStateUnknownEvent(ProcessStateEvent):
+    __slots__ = ()
+
+
+class ProcessLogEvent(Event):
+    __slots__ = ("process", "program", "instance", "pid", "data")
+
+    def __init__(self, process: int, program: int, instance: int, pid: int,
+                 data: bytes):
+        self.process = process
+        self.program = program
+        self.instance = instance
+        self.pid = pid
+        self.data = data
+
+
+class ProcessLogStdoutEvent(ProcessLogEvent):
+    __slots__ = ()
+
+
+class ProcessLogStderrEvent(ProcessLogEvent):
+    __slots__ = ()
+
+
+class ConfigEvent(Event):
+    __slots__ = ("programs",)
+
+    def __init__(self, programs: List[str]):
+        self.programs = programs
+
+
+class ConfigLoadedEvent(ConfigEvent):
+    __slots__ = ()
+
+
+class SupervisorStateChangeEvent(Event):
+    __slots__ = ("pid",)
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+
+class SupervisorRunningEvent(SupervisorStateChangeEvent):
+    __slots__ = ()
+
+
+class SupervisorStoppingEvent(SupervisorStateChangeEvent):
+    __slots__ = ()
+
+
 class EventsTypes:
-    PROCESS_STATE_STOPPED = ProcessStateStoppedEvent
\ No newline at end of file
+    EVENT = Event
+    PROCESS_STATE = ProcessStateEvent
+    PROCESS_STATE_STOPPED = ProcessStateStoppedEvent
+    PROCESS_STATE_STARTING = ProcessStateStartingEvent
+    PROCESS_STATE_RUNNING = ProcessStateRunningEvent
+    PROCESS_STATE_BACKOFF = ProcessStateBackoffEvent
+    PROCESS_STATE_STOPPING = ProcessStateStoppingEvent
+    PROCESS_STATE_EXITED = ProcessStateExitedEvent
+    PROCESS_STATE_FATAL = ProcessStateFatalEvent
+    PROCESS_STATE_UNKNOWN = ProcessStateUnknownEvent
+    PROCESS_LOG = ProcessLogEvent
+    PROCESS_LOG_STDOUT = ProcessLogStdoutEvent
+    PROCESS_LOG_STDERR = ProcessLogStderrEvent
+    CONFIG = ConfigEvent
+    CONFIG_LOADED = ConfigLoadedEvent
+    SUPERVISOR_STATE_CHANGE = SupervisorStateChangeEvent
+    SUPERVISOR_STATE_CHANGE_RUNNING = SupervisorRunningEvent
+    SUPERVISOR_STATE_CHANGE_STOPPING = SupervisorStoppingEvent
+
+
+EVENT_NAMES: Dict[type, str] = {
+    value: name for name, value in vars(EventsTypes).items()
+    if not name.startswith("_")
+}
+
+
+def event_type(name: str) -> type:
+    event_class = getattr(EventsTypes, name.upper(), None)
+    if not isinstance(event_class, type):
+        raise ValueError("unknown event type %r" % name)
+    return event_class
+
+
+def concrete_types(event_class: type) -> List[type]:
+    types = [event_class]
+    for subclass in event_class.__subclasses__():
+        types.extend(concrete_types(subclass))
+    return types
+
+
+class EventBus:
+    # Subscribing to a type also subscribes to all of its subtypes, so that
+    # publishing is a single lookup on the exact type of the event and only
+    # visits the listeners that asked for it
+    def __init__(self):
+        self.listeners: Dict[type, List[Callable]] = {}
+        self.serial = 0
+
+    def listeners_for(self, event_class: type) -> List[Callable]:
+        # The returned list is the live one: holding it lets a hot path test
+        # for listeners before building an event
+        return self.listeners.setdefault(event_class, [])
+
+    def subscribe(self, event_class: type, listener: Callable) -> None:
+        for subclass in concrete_types(event_class):
+            listeners = self.listeners_for(subclass)
+            if listener not in listeners:
+                listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable) -> None:
+        for listeners in self.listeners.values():
+            while listener in listeners:
+                listeners.remove(listener)
+
+    def publish(self, event: Event) -> None:
+        self.serial += 1
+        event.serial = self.serial
+        # A copy, as listeners may unsubscribe while being called
+        for listener in list(self.listeners.get(type(event), ())):
+            try:
+                listener(event)
+            except Exception:
+                logger.exception("event listener %r failed on %s", listener,
+                                 EVENT_NAMES[type(event)])
@@ -0,0 +1,113 @@
+import os
+import selectors
+import socket
+from typing import Tuple
+
+CONTENT_TYPE = b"application/openmetrics-text; version=1.0.0; charset=utf-8"
+MAX_REQUEST = 8192
+
+
+def parse_endpoint(endpoint: str) -> Tuple[int, object]:
+    # "unix:/run/taskmaster.metrics", "9100" or "127.0.0.1:9100"
+    if endpoint.startswith("unix:"):
+        return socket.AF_UNIX, endpoint[5:]
+    host, _, port = endpoint.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class ScrapeConnection:
+    def __init__(self, exporter: "MetricsExporter", sock: socket.socket):
+        self.exporter = exporter
+        self.sock = sock
+        self.request = b""
+        self.response = b""
+        sock.setblocking(False)
+
+    def on_event(self, mask: int) -> None:
+        if mask & selectors.EVENT_READ and not self.response:
+            try:
+                data = self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b""
+            self.request += data
+            if not data or len(self.request) > MAX_REQUEST:
+                self.close()
+                return
+            if b"\r\n\r\n" not in self.request and b"\n\n" not in self.request:
+                return
+            self.response = self.exporter.respond(self.request)
+            self.exporter.selector.modify(self.sock, selectors.EVENT_WRITE,
+                                          self.on_event)
+        if mask & selectors.EVENT_WRITE:
+            try:
+                sent = self.sock.send(self.response)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                sent = len(self.response)
+            self.response = self.response[sent:]
+            if not self.response:
+                self.close()
+
+    def close(self) -> None:
+        self.exporter.selector.unregister(self.sock)
+        self.exporter.connections.discard(self)
+        self.sock.close()
+
+
+class MetricsExporter:
+    # A minimal HTTP/1.0 responder: every request gets the current metrics
+    # and the connection is closed
+    def __init__(self, supervisor, endpoint: str):
+        self.supervisor = supervisor
+        self.selector = supervisor.selector
+        self.connections = set()
+        family, address = parse_endpoint(endpoint)
+        self.path = address if family == socket.AF_UNIX else None
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+
+    def accept(self, mask: int) -> None:
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            connection = ScrapeConnection(self, sock)
+            self.connections.add(connection)
+            self.selector.register(sock, selectors.EVENT_READ,
+                                   connection.on_event)
+
+    def respond(self, request: bytes) -> bytes:
+        method = request.split(b" ", 1)[0]
+        if method not in (b"GET", b"HEAD"):
+            return (b"HTTP/1.0 405 Method Not Allowed\r\n"
+                    b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+        body = self.supervisor.metrics.render()
+        header = (b"HTTP/1.0 200 OK\r\nContent-Type: %s\r\n"
+                  b"Content-Length: %d\r\nConnection: close\r\n\r\n"
+                  % (CONTENT_TYPE, len(body)))
+        if method == b"HEAD":
+            return header
+        return header + body
+
+    def close(self) -> None:
+        for connection in list(self.connections):
+            connection.close()
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,206 @@
+import array
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, Optional
+
+from events import ProcessStateEvent
+from process import EVENT_STATES, STATE_NAMES
+
+# Fixed-size little-endian records, in this order: wall time (double),
+# previous record of the same program, pid, instance (uint32 each), program
+# id, kind, old state, new state (uint16 each), exit code (int32).
+# The first record slot holds the magic, so record number 0 ends a chain.
+# Program ids index the names kept one per line in <journal>.names, so that
+# ids stay stable across restarts and config changes.
+RECORD = struct.Struct("<dIIIHHHHi")
+MAGIC = b"TMJRNL02".ljust(RECORD.size, b"\0")
+NO_EXIT_CODE = -(1 << 31)
+BUFFER_SIZE = 1 << 16
+SCAN_CHUNK = RECORD.size * 4096
+
+# Record kinds. Command records keep the command in the new state field.
+STATE_RECORD = 0
+COMMAND_RECORD = 1
+COMMANDS = ("start", "stop", "restart", "rolling-restart")
+
+# <journal>.heads checkpoints the last record of each program as of a
+# record count, so that opening only scans the records appended after it
+HEADS = struct.Struct("<8sI")
+HEADS_MAGIC = b"TMHEAD01"
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        # Last record number of each program, 0 for none
+        self.heads = array.array("I")
+        # Journal program id of each config program id, see bind()
+        self.local: List[int] = []
+        self.buffer = bytearray()
+        self.unsynced = False
+        self.load_names()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.names_fd = os.open(path + ".names",
+                                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            os.write(self.fd, MAGIC)
+            size = RECORD.size
+        elif os.pread(self.fd, RECORD.size, 0) != MAGIC:
+            os.close(self.fd)
+            os.close(self.names_fd)
+            raise ValueError("%s is not a taskmaster journal" % path)
+        if size % RECORD.size:
+            # A record torn by a crash
+            size -= size % RECORD.size
+            os.ftruncate(self.fd, size)
+        self.records = size // RECORD.size
+        self.scan(self.load_heads())
+
+    def load_names(self) -> None:
+        try:
+            with open(self.path + ".names") as f:
+                self.names = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def load_heads(self) -> int:
+        # Number of the first record the checkpoint does not cover
+        try:
+            with open(self.path + ".heads", "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 1
+        if len(data) < HEADS.size or (len(data) - HEADS.size) % 4:
+            return 1
+        magic, records = HEADS.unpack_from(data)
+        if magic != HEADS_MAGIC or records > self.records:
+            return 1
+        heads = array.array("I", data[HEADS.size:])
+        if sys.byteorder == "big":
+            heads.byteswap()
+        # A checkpoint left over from another journal at the same path
+        for program, number in enumerate(heads):
+            if number >= records or number and RECORD.unpack(os.pread(
+                    self.fd, RECORD.size, number * RECORD.size))[4] != program:
+                return 1
+        self.heads = heads
+        return records
+
+    def save_heads(self) -> None:
+        heads = array.array("I", self.heads)
+        if sys.byteorder == "big":
+            heads.byteswap()
+        temporary = self.path + ".heads.tmp"
+        with open(temporary, "wb") as f:
+            f.write(HEADS.pack(HEADS_MAGIC, self.records))
+            f.write(heads.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path + ".heads")
+
+    def scan(self, record: int) -> None:
+        offset = record * RECORD.size
+        size = self.records * RECORD.size
+        heads = self.heads
+        while offset < size:
+            data = os.pread(self.fd, min(SCAN_CHUNK, size - offset), offset)
+            if not data:
+                break
+            for fields in RECORD.iter_unpack(data):
+                program = fields[4]
+                if program >= len(heads):
+                    heads.extend([0] * (program + 1 - len(heads)))
+                heads[program] = record
+                record += 1
+            offset += len(data)
+
+    def program_id(self, program: str) -> int:
+        program_id = self.ids.get(program)
+        if program_id is None:
+            program_id = self.ids[program] = len(self.names)
+            self.names.append(program)
+            os.write(self.names_fd, program.encode() + b"\n")
+        return program_id
+
+    def bind(self, programs: List[str]) -> None:
+        self.local = [self.program_id(program) for program in programs]
+        if len(self.heads) < len(self.names):
+            self.heads.extend([0] * (len(self.names) - len(self.heads)))
+
+    def append(self, program_id: int, instance: int, pid: int, old: int,
+               new: int, exit_code: Optional[int],
+               kind: int = STATE_RECORD) -> None:
+        self.buffer += RECORD.pack(
+            time.time(), self.heads[program_id], pid, instance, program_id,
+            kind, old, new, NO_EXIT_CODE if exit_code is None else exit_code)
+        self.heads[program_id] = self.records
+        self.records += 1
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def record(self, event: ProcessStateEvent) -> None:
+        self.append(self.local[event.program], event.instance, event.pid,
+                    event.from_state, EVENT_STATES[type(event)],
+                    event.exit_code)
+
+    def command(self, program: int, instance: int, command: str) -> None:
+        # program is a config program id, as in events
+        self.append(self.local[program], instance, 0, 0,
+                    COMMANDS.index(command), None, COMMAND_RECORD)
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        view = memoryview(self.buffer)
+        while view:
+            view = view[os.write(self.fd, view):]
+        view.release()
+        self.buffer.clear()
+        self.unsynced = True
+
+    def sync(self) -> None:
+        self.flush()
+        if self.unsynced:
+            os.fsync(self.fd)
+            os.fsync(self.names_fd)
+            self.unsynced = False
+            self.save_heads()
+
+    def history(self, program: str, limit: int = 50) -> List[Dict]:
+        program_id = self.ids.get(program)
+        if program_id is None or program_id >= len(self.heads):
+            return []
+        self.flush()
+        # Follow the chain of the program back from its last record
+        rows = []
+        number = self.heads[program_id]
+        while number and (limit <= 0 or len(rows) < limit):
+            when, number, pid, instance, _, kind, old, new, exit_code = (
+                RECORD.unpack(os.pread(self.fd, RECORD.size,
+                                       number * RECORD.size)))
+            row = {"time": when, "instance": instance, "pid": pid}
+            if kind == COMMAND_RECORD:
+                row["command"] = (COMMANDS[new] if new < len(COMMANDS)
+                                  else str(new))
+            else:
+                row["from"] = STATE_NAMES.get(old, str(old))
+                row["to"] = STATE_NAMES.get(new, str(new))
+                row["exitcode"] = (None if exit_code == NO_EXIT_CODE
+                                   else exit_code)
+            rows.append(row)
+        rows.reverse()
+        return rows
+
+    def close(self) -> None:
+        if self.fd < 0:
+            return
+        self.sync()
+        os.close(self.fd)
+        os.close(self.names_fd)
+        self.fd = self.names_fd = -1
@@ -0,0 +1,87 @@
+import ctypes
+import ctypes.util
+import os
+import time
+from typing import Dict, List, Optional
+
+PR_SET_CHILD_SUBREAPER = 36
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def set_subreaper() -> bool:
+    try:
+        if libc().prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0:
+            return True
+    except (OSError, AttributeError):
+        pass
+    return False
+
+
+def proc_stat(pid: int) -> Optional[List[bytes]]:
+    # Fields after "comm", which may itself contain spaces and parentheses:
+    # index 0 is field 3 (state) of proc(5)
+    try:
+        with open("/proc/%d/stat" % pid, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    return data[data.rindex(b")") + 2:].split()
+
+
+def start_time(pid: int) -> int:
+    fields = proc_stat(pid)
+    if fields is None:
+        return 0
+    return int(fields[19])
+
+
+def age(proc_start: int) -> float:
+    # Seconds since a process started, from its start_time(). starttime
+    # counts clock ticks since boot, suspend included, as CLOCK_BOOTTIME does.
+    return max(0.0, time.clock_gettime(time.CLOCK_BOOTTIME)
+               - proc_start / os.sysconf("SC_CLK_TCK"))
+
+
+def parent_pid(pid: int) -> int:
+    fields = proc_stat(pid)
+    if fields is None:
+        return 0
+    return int(fields[1])
+
+
+def pidfd_open(pid: int) -> Optional[int]:
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def processes() -> Dict[int, List[bytes]]:
+    table = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            fields = proc_stat(int(name))
+            if fields is not None:
+                table[int(name)] = fields
+    return table
+
+
+def children() -> Optional[List[int]]:
+    # Children of this process across its threads, None when the kernel
+    # does not expose them
+    pids = []
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open("/proc/self/task/%s/children" % task, "rb") as f:
+                pids.extend(int(pid) for pid in f.read().split())
+    except OSError:
+        return None
+    return pids
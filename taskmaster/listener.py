@@ -0,0 +1,203 @@
+import collections
+import json
+import logging
+import os
+import selectors
+import time
+from typing import Deque, Dict, List, Tuple
+
+from classes import ProgramConfig
+from events import EVENT_NAMES, Event, event_type
+from names import NameTable
+from process import STATE_NAMES
+
+logger = logging.getLogger("taskmasterd")
+
+# Programs with an "events" list are event listeners. They talk to
+# taskmasterd over their stdin and stdout:
+#   listener -> daemon  "READY\n" once it can take events
+#   daemon -> listener  "BATCH <count> <length>\n" followed by <length>
+#                       bytes holding <count> JSON events, one per line
+#   listener -> daemon  "OK\n" to ack the whole batch, or "FAIL\n" to have
+#                       it delivered again; either makes it ready again
+# A batch leaves when batchsize events are queued or the oldest of them has
+# waited batchlatency seconds, whichever comes first.
+MAX_QUEUE = 10000
+MAX_LINE = 4096
+
+
+def event_payload(event: Event, names: NameTable) -> Dict:
+    payload = event.payload()
+    if "process" in payload:
+        del payload["process"]
+        payload["program"] = names.programs[payload["program"]]
+    for key, value in payload.items():
+        if isinstance(value, bytes):
+            payload[key] = value.decode("utf-8", "replace")
+    if "from_state" in payload:
+        payload["from_state"] = STATE_NAMES[payload["from_state"]]
+    payload["event"] = EVENT_NAMES[type(event)]
+    payload["serial"] = event.serial
+    return payload
+
+
+def encode_event(event: Event, names: NameTable) -> bytes:
+    return json.dumps(event_payload(event, names),
+                      separators=(",", ":")).encode() + b"\n"
+
+
+class EventListener:
+    def __init__(self, pool: "ListenerPool", process, stdin: int,
+                 stdout: int):
+        self.pool = pool
+        self.process = process
+        self.selector = pool.supervisor.selector
+        self.stdin = stdin
+        self.stdout = stdout
+        self.inbuf = b""
+        self.outbuf = bytearray()
+        self.writing = False
+        self.ready = False
+        self.batch: List[Tuple[float, bytes]] = []
+        os.set_blocking(stdin, False)
+        os.set_blocking(stdout, False)
+        self.selector.register(stdout, selectors.EVENT_READ, self.receive)
+
+    def receive(self, mask: int) -> None:
+        try:
+            data = os.read(self.stdout, MAX_LINE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.close()
+            return
+        lines = (self.inbuf + data).split(b"\n")
+        self.inbuf = lines.pop()
+        if len(self.inbuf) > MAX_LINE:
+            self.inbuf = b""
+        for line in lines:
+            token = line.strip()
+            if token == b"OK":
+                self.batch = []
+            elif token in (b"FAIL", b"READY"):
+                # READY with a batch in flight means it was lost
+                self.pool.requeue(self.batch)
+                self.batch = []
+            else:
+                logger.warning("%s: unexpected line from event listener: %r",
+                               self.process.name, line[:80])
+                continue
+            self.ready = True
+        if self.ready:
+            self.pool.dispatch()
+
+    def send(self, batch: List[Tuple[float, bytes]]) -> None:
+        self.ready = False
+        self.batch = batch
+        payload = b"".join(line for _, line in batch)
+        self.outbuf += b"BATCH %d %d\n" % (len(batch), len(payload))
+        self.outbuf += payload
+        self.pool.batches += 1
+        self.flush()
+
+    def flush(self, mask: int = 0) -> None:
+        while self.outbuf:
+            try:
+                written = os.write(self.stdin, self.outbuf)
+            except BlockingIOError:
+                break
+            except OSError:
+                # The listener closed its stdin; its exit is handled by reap
+                self.outbuf.clear()
+                break
+            del self.outbuf[:written]
+        if self.outbuf and not self.writing:
+            self.selector.register(self.stdin, selectors.EVENT_WRITE,
+                                   self.flush)
+            self.writing = True
+        elif not self.outbuf and self.writing:
+            self.selector.unregister(self.stdin)
+            self.writing = False
+
+    def close(self) -> None:
+        if self.stdout < 0:
+            return
+        self.selector.unregister(self.stdout)
+        if self.writing:
+            self.selector.unregister(self.stdin)
+            self.writing = False
+        os.close(self.stdout)
+        os.close(self.stdin)
+        self.stdout = self.stdin = -1
+        self.ready = False
+        self.pool.listeners.remove(self)
+        self.pool.requeue(self.batch)
+        self.batch = []
+        self.pool.dispatch()
+
+
+class ListenerPool:
+    # Instances of a listener program share one queue: a batch goes to
+    # whichever instance is ready first
+    def __init__(self, supervisor, program: str, config: ProgramConfig):
+        self.supervisor = supervisor
+        self.program = program
+        self.batchsize = config.batchsize
+        self.latency = config.batchlatency
+        self.queue: Deque[Tuple[float, bytes]] = collections.deque()
+        self.listeners: List[EventListener] = []
+        self.timer = None
+        self.batches = 0
+        self.dropped = 0
+        for name in config.events:
+            supervisor.events.subscribe(event_type(name), self.enqueue)
+
+    def attach(self, process, stdin: int, stdout: int) -> EventListener:
+        listener = EventListener(self, process, stdin, stdout)
+        self.listeners.append(listener)
+        return listener
+
+    def enqueue(self, event: Event) -> None:
+        if len(self.queue) >= MAX_QUEUE:
+            self.queue.popleft()
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning("%s: event listeners are behind, %d events "
+                               "dropped", self.program, self.dropped)
+        self.queue.append((time.monotonic(),
+                           encode_event(event, self.supervisor.names)))
+        if self.timer is None or len(self.queue) >= self.batchsize:
+            self.dispatch()
+
+    def requeue(self, batch: List[Tuple[float, bytes]]) -> None:
+        self.queue.extendleft(reversed(batch))
+
+    def dispatch(self) -> None:
+        queue = self.queue
+        now = time.monotonic()
+        for listener in self.listeners:
+            if not queue:
+                break
+            if not listener.ready:
+                continue
+            if (len(queue) < self.batchsize
+                    and now - queue[0][0] < self.latency):
+                break
+            listener.send([queue.popleft()
+                           for _ in range(min(self.batchsize, len(queue)))])
+        if queue and self.timer is None:
+            delay = queue[0][0] + self.latency - now
+            if delay > 0:
+                self.timer = self.supervisor.call_later(delay, self.expire)
+
+    def expire(self) -> None:
+        self.timer = None
+        self.dispatch()
+
+    def close(self) -> None:
+        self.supervisor.events.unsubscribe(self.enqueue)
+        if self.timer is not None:
+            self.supervisor.cancel(self.timer)
+            self.timer = None
+        for listener in list(self.listeners):
+            listener.close()
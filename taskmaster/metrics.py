@@ -0,0 +1,248 @@
+from typing import Dict, List, Optional, Tuple
+
+# Exposition buckets in seconds. Histograms record with a much finer
+# log-linear resolution and are folded into these when rendered.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# 8 sub-buckets per power of two: every recorded value is within 12.5% of
+# its bucket bounds. Values are microseconds; 256 buckets reach 4.7 hours.
+SUB_BITS = 3
+SUB_COUNT = 1 << SUB_BITS
+LINEAR = SUB_COUNT * 2
+SLOTS = 256
+
+
+def bucket_index(value: int) -> int:
+    if value < LINEAR:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    index = (shift << SUB_BITS) + (value >> shift)
+    return index if index < SLOTS else SLOTS - 1
+
+
+def bucket_bounds(index: int) -> Tuple[int, int]:
+    if index < LINEAR:
+        return index, index + 1
+    shift = (index >> SUB_BITS) - 1
+    sub = (index & (SUB_COUNT - 1)) + SUB_COUNT
+    return sub << shift, (sub + 1) << shift
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(str(value)))
+                             for name, value in zip(names, values))
+
+
+class Series:
+    __slots__ = ("prefix", "value", "rendered", "text")
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix.encode()
+        self.value = 0
+        self.rendered = None
+        self.text = b""
+
+    def render(self, out: List[bytes]) -> None:
+        if self.rendered != self.value:
+            self.rendered = self.value
+            self.text = b"%s %s\n" % (self.prefix, repr(self.value).encode())
+        out.append(self.text)
+
+
+class HistogramSeries:
+    # stats --reset only moves a baseline that summary() subtracts, so the
+    # exported buckets, count and sum never go backwards
+    __slots__ = ("name", "labels", "counts", "count", "sum", "max",
+                 "base_counts", "base_count", "base_sum", "updates",
+                 "rendered", "text")
+
+    def __init__(self, name: str, labels: str):
+        self.name = name
+        self.labels = labels
+        self.counts = [0] * SLOTS
+        self.count = 0
+        self.sum = 0
+        # Largest value since the last reset
+        self.max = 0
+        self.base_counts: Optional[List[int]] = None
+        self.base_count = 0
+        self.base_sum = 0
+        self.updates = 0
+        self.rendered = -1
+        self.text = b""
+
+    def observe(self, seconds: float) -> None:
+        value = int(seconds * 1e6)
+        if value < 0:
+            value = 0
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        self.updates += 1
+
+    def reset(self) -> None:
+        self.base_counts = list(self.counts)
+        self.base_count = self.count
+        self.base_sum = self.sum
+        self.max = 0
+
+    def percentile(self, q: float) -> float:
+        # Midpoint of the bucket holding the q-th percentile since the last
+        # reset, in seconds
+        count = self.count - self.base_count
+        if not count:
+            return 0.0
+        rank = max(1, int(q / 100 * count + 0.5))
+        base = self.base_counts or [0] * SLOTS
+        seen = 0
+        for index, observed in enumerate(self.counts):
+            seen += observed - base[index]
+            if seen >= rank:
+                low, high = bucket_bounds(index)
+                return min((low + high) / 2, self.max) / 1e6
+        return self.max / 1e6
+
+    def summary(self) -> Dict:
+        count = self.count - self.base_count
+        return {
+            "count": count,
+            "mean": (self.sum - self.base_sum) / count / 1e6 if count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max / 1e6,
+        }
+
+    def render(self, out: List[bytes]) -> None:
+        if self.rendered != self.updates:
+            self.rendered = self.updates
+            self.text = self.format()
+        out.append(self.text)
+
+    def format(self) -> bytes:
+        labels = self.labels[1:-1] + "," if self.labels else ""
+        lines = []
+        cumulative = 0
+        index = 0
+        for bound in BUCKETS:
+            limit = bound * 1e6
+            while index < SLOTS and bucket_bounds(index)[1] <= limit:
+                cumulative += self.counts[index]
+                index += 1
+            lines.append('%s_bucket{%sle="%s"} %d\n'
+                         % (self.name, labels, bound, cumulative))
+        lines.append('%s_bucket{%sle="+Inf"} %d\n'
+                     % (self.name, labels, self.count))
+        lines.append("%s_count%s %d\n" % (self.name, self.labels, self.count))
+        lines.append("%s_sum%s %s\n" % (self.name, self.labels,
+                                        repr(self.sum / 1e6)))
+        return "".join(lines).encode()
+
+
+class Family:
+    def __init__(self, name: str, kind: str, help: str,
+                 labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.kind = kind
+        self.label_names = labels
+        self.header = ("# TYPE %s %s\n# HELP %s %s\n"
+                       % (name, kind, name, help)).encode()
+        self.series: Dict[Tuple, object] = {}
+
+    def labels(self, *values):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = self.create(values)
+        return series
+
+    def create(self, values: Tuple):
+        suffix = "_total" if self.kind == "counter" else ""
+        return Series(self.name + suffix
+                      + label_text(self.label_names, values))
+
+    def render(self, out: List[bytes]) -> None:
+        out.append(self.header)
+        for series in self.series.values():
+            series.render(out)
+
+
+class HistogramFamily(Family):
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, "histogram", help, labels)
+
+    def create(self, values: Tuple) -> HistogramSeries:
+        return HistogramSeries(self.name, label_text(self.label_names, values))
+
+
+class Metrics:
+    def __init__(self):
+        self.processes = Family(
+            "taskmaster_processes", "gauge",
+            "Number of program instances in each state",
+            ("program", "state"))
+        self.restarts = Family(
+            "taskmaster_restarts", "counter",
+            "Instances spawned again after they exited or failed to start",
+            ("program",))
+        self.spawn_seconds = HistogramFamily(
+            "taskmaster_spawn_seconds",
+            "Time spent in the fork/exec of an instance", ("program",))
+        self.running_seconds = HistogramFamily(
+            "taskmaster_running_seconds",
+            "Time from spawn until an instance is RUNNING", ("program",))
+        self.reap_seconds = HistogramFamily(
+            "taskmaster_reap_seconds",
+            "Delay between the event loop waking up on SIGCHLD and the exit "
+            "being handled", ("program",))
+        self.restart_seconds = HistogramFamily(
+            "taskmaster_restart_seconds",
+            "Time from an unplanned exit until the replacement is RUNNING",
+            ("program",))
+        self.log_bytes = Family(
+            "taskmaster_log_bytes", "counter",
+            "Bytes of captured output written to log files",
+            ("program", "stream"))
+        self.requests = Family(
+            "taskmaster_control_requests", "counter",
+            "Requests received on the control socket", ("command",))
+        self.histograms: List[HistogramFamily] = [
+            self.spawn_seconds, self.running_seconds, self.reap_seconds,
+            self.restart_seconds]
+        self.families: List[Family] = [
+            self.processes, self.restarts, self.log_bytes,
+            self.requests] + self.histograms
+
+    def transition(self, program: str, old: Optional[str], new: str) -> None:
+        if old is not None:
+            self.processes.labels(program, old).value -= 1
+        self.processes.labels(program, new).value += 1
+
+    def stats(self, program: Optional[str] = None,
+              reset: bool = False) -> List[Dict]:
+        rows = []
+        for family in self.histograms:
+            for values, series in family.series.items():
+                if program is not None and values[0] != program:
+                    continue
+                row = {"metric": family.name, "program": values[0]}
+                row.update(series.summary())
+                rows.append(row)
+                if reset:
+                    series.reset()
+        return rows
+
+    def render(self) -> bytes:
+        out: List[bytes] = []
+        for family in self.families:
+            family.render(out)
+        out.append(b"# EOF\n")
+        return b"".join(out)
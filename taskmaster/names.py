@@ -0,0 +1,98 @@
+import fnmatch
+from typing import Dict, List, Optional, Tuple
+
+from classes import ConfigYAML
+
+
+class NameTable:
+    # Programs and instances get small integer ids when the config is
+    # loaded: program ids follow the config order, and the instances of a
+    # program get consecutive process ids. The process table, the event bus,
+    # the journal and the event stream work on these ids; names are only
+    # looked up to show something to a human or to persist it.
+    def __init__(self, config: ConfigYAML):
+        self.programs: List[str] = list(config.programs)
+        self.program_ids: Dict[str, int] = {
+            name: program_id for program_id, name in enumerate(self.programs)}
+        self.first: List[int] = []
+        self.processes: List[Tuple[int, int]] = []
+        for program_id, program_config in enumerate(config.programs.values()):
+            self.first.append(len(self.processes))
+            for instance in range(program_config.numprocs):
+                self.processes.append((program_id, instance))
+        # Process ids sorted by program name then instance, and the position
+        # of each process id in that order, for listings sorted by name
+        self.order: List[int] = sorted(
+            range(len(self.processes)),
+            key=lambda i: (self.programs[self.processes[i][0]],
+                           self.processes[i][1]))
+        self.rank: List[int] = [0] * len(self.processes)
+        for position, process_id in enumerate(self.order):
+            self.rank[process_id] = position
+        # Program ids each program depends on, and the reverse
+        self.depends: List[List[int]] = [
+            sorted({self.program_ids[dependency]
+                    for dependency in program_config.depends_on})
+            for program_config in config.programs.values()]
+        self.dependents: List[List[int]] = [[] for _ in self.programs]
+        for program_id, dependencies in enumerate(self.depends):
+            for dependency in dependencies:
+                self.dependents[dependency].append(program_id)
+        self.groups: Dict[str, List[int]] = {
+            group: [self.program_ids[program] for program in programs]
+            for group, programs in config.groups.items()}
+
+    def process_id(self, program: str, instance: int) -> Optional[int]:
+        program_id = self.program_ids.get(program)
+        if program_id is None:
+            return None
+        process_id = self.first[program_id] + instance
+        if (instance < 0 or process_id >= len(self.processes)
+                or self.processes[process_id][0] != program_id):
+            return None
+        return process_id
+
+    def instances(self, program_id: int) -> range:
+        end = (self.first[program_id + 1]
+               if program_id + 1 < len(self.first) else len(self.processes))
+        return range(self.first[program_id], end)
+
+    def resolve(self, target: str) -> Optional[List[int]]:
+        # Process ids named by a target: all, group:<group>, <program>,
+        # <program>:* or <program>:<instance>, where <program> may be a glob.
+        # None when nothing matches.
+        if target == "all":
+            return list(range(len(self.processes)))
+        if target.startswith("group:"):
+            program_ids = self.groups.get(target[6:])
+            if program_ids is None:
+                return None
+        else:
+            program, _, instance = target.partition(":")
+            if instance not in ("", "*"):
+                try:
+                    process_id = self.process_id(program, int(instance))
+                except ValueError:
+                    return None
+                return None if process_id is None else [process_id]
+            program_id = self.program_ids.get(program)
+            if program_id is not None:
+                program_ids = [program_id]
+            else:
+                program_ids = [program_id for program_id, name
+                               in enumerate(self.programs)
+                               if fnmatch.fnmatchcase(name, program)]
+            if not program_ids:
+                return None
+        process_ids = []
+        for program_id in program_ids:
+            process_ids.extend(self.instances(program_id))
+        return process_ids
+
+    def process_name(self, process_id: int) -> str:
+        program_id, instance = self.processes[process_id]
+        return "%s:%d" % (self.programs[program_id], instance)
+
+    def export(self) -> Dict:
+        # Sent once to clients that receive ids
+        return {"programs": self.programs, "processes": self.processes}
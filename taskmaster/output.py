@@ -0,0 +1,148 @@
+import os
+import time
+from typing import List, Optional
+
+CHUNK_SIZE = 65536
+# A partial line longer than this is written out instead of buffered forever
+MAX_LINE = 65536
+
+
+class Clock:
+    # strftime is by far the slowest part of a prefix, render it once a second
+    def __init__(self):
+        self.second = -1
+        self.text = b""
+
+    def stamp(self, now: Optional[float] = None) -> bytes:
+        if now is None:
+            now = time.time()
+        second = int(now)
+        if second != self.second:
+            self.second = second
+            self.text = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(second)).encode()
+        return b"%s.%03d" % (self.text, int((now - second) * 1000))
+
+
+clock = Clock()
+
+
+class LinePrefixer:
+    def __init__(self, tag: str, timestamps: bool = True):
+        self.tag = tag.encode()
+        self.timestamps = timestamps
+        self.partial = b""
+
+    def prefix(self, now: Optional[float] = None) -> bytes:
+        if not self.timestamps:
+            return self.tag + b" "
+        return b"%s %s " % (clock.stamp(now), self.tag)
+
+    def feed(self, data: bytes, now: Optional[float] = None) -> bytes:
+        # Works on the whole chunk: one rfind to cut off the trailing partial
+        # line, one replace to prefix every line in it
+        if self.partial:
+            data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        if not end:
+            if len(data) < MAX_LINE:
+                self.partial = data
+                return b""
+            end = len(data)
+            data += b"\n"
+            self.partial = b""
+        else:
+            self.partial = data[end:]
+        prefix = self.prefix(now)
+        return prefix + data[:end - 1].replace(b"\n", b"\n" + prefix) + b"\n"
+
+    def flush(self, now: Optional[float] = None) -> bytes:
+        if not self.partial:
+            return b""
+        data, self.partial = self.partial, b""
+        return self.prefix(now) + data + b"\n"
+
+
+class LogFile:
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class MergedLog(LogFile):
+    # Shared by every instance of a program: writes are queued and go out as
+    # a single write() when the supervisor flushes at the end of its tick
+    def __init__(self, path: str, dirty: List["MergedLog"]):
+        super().__init__(path)
+        self.dirty = dirty
+        self.buffer: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        if not self.buffer:
+            self.dirty.append(self)
+        self.buffer.append(data)
+
+    def flush(self) -> None:
+        if self.buffer:
+            data = b"".join(self.buffer)
+            self.buffer.clear()
+            LogFile.write(self, data)
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
+
+
+class OutputChannel:
+    def __init__(self, fd: int, sink: LogFile,
+                 prefixer: Optional[LinePrefixer] = None, counter=None):
+        self.fd = fd
+        self.sink = sink
+        self.prefixer = prefixer
+        self.counter = counter
+        self.blocked = False
+        # Raw output is published as log events only while someone listens
+        self.listeners = ()
+        self.publish = None
+        os.set_blocking(fd, False)
+
+    def read(self) -> bool:
+        try:
+            data = os.read(self.fd, CHUNK_SIZE)
+        except BlockingIOError:
+            self.blocked = True
+            return True
+        if not data:
+            return False
+        if self.listeners:
+            self.publish(data)
+        if self.prefixer:
+            data = self.prefixer.feed(data)
+            if not data:
+                return True
+        self.write(data)
+        return True
+
+    def write(self, data: bytes) -> None:
+        self.sink.write(data)
+        if self.counter is not None:
+            self.counter.value += len(data)
+
+    def close(self) -> None:
+        if self.prefixer:
+            data = self.prefixer.flush()
+            if data:
+                self.write(data)
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
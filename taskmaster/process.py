@@ -0,0 +1,423 @@
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+import events
+import linux
+import tracing
+from classes import ProgramConfig
+from output import LinePrefixer, OutputChannel
+
+logger = logging.getLogger("taskmasterd")
+
+
+class ProcessStates:
+    STOPPED = 0
+    STARTING = 10
+    RUNNING = 20
+    BACKOFF = 30
+    STOPPING = 40
+    EXITED = 100
+    FATAL = 200
+    UNKNOWN = 1000
+
+
+STATE_NAMES: Dict[int, str] = {
+    value: name for name, value in vars(ProcessStates).items()
+    if not name.startswith("_")
+}
+
+STOPPED_STATES = (ProcessStates.STOPPED, ProcessStates.EXITED,
+                  ProcessStates.FATAL, ProcessStates.UNKNOWN)
+RUNNING_STATES = (ProcessStates.STARTING, ProcessStates.RUNNING,
+                  ProcessStates.STOPPING)
+
+
+STATE_EVENTS = {
+    ProcessStates.STOPPED: events.ProcessStateStoppedEvent,
+    ProcessStates.STARTING: events.ProcessStateStartingEvent,
+    ProcessStates.RUNNING: events.ProcessStateRunningEvent,
+    ProcessStates.BACKOFF: events.ProcessStateBackoffEvent,
+    ProcessStates.STOPPING: events.ProcessStateStoppingEvent,
+    ProcessStates.EXITED: events.ProcessStateExitedEvent,
+    ProcessStates.FATAL: events.ProcessStateFatalEvent,
+    ProcessStates.UNKNOWN: events.ProcessStateUnknownEvent,
+}
+
+EVENT_STATES = {
+    event_class: state for state, event_class in STATE_EVENTS.items()}
+
+LOG_EVENTS = {
+    "stdout": events.ProcessLogStdoutEvent,
+    "stderr": events.ProcessLogStderrEvent,
+}
+
+
+def parse_signal(name: Optional[str]) -> int:
+    if not name:
+        return signal.SIGTERM
+    name = name.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    return signal.Signals[name]
+
+
+def parse_umask(umask) -> int:
+    if isinstance(umask, str):
+        return int(umask, 8)
+    return umask
+
+
+def exit_codes(config: ProgramConfig) -> List[int]:
+    if isinstance(config.exitcodes, int):
+        return [config.exitcodes]
+    return config.exitcodes
+
+
+class Process:
+    def __init__(self, supervisor, process_id: int, config: ProgramConfig):
+        names = supervisor.names
+        self.supervisor = supervisor
+        self.id = process_id
+        self.program_id, self.instance = names.processes[process_id]
+        self.program = names.programs[self.program_id]
+        self.config = config
+        self.name = names.process_name(process_id)
+        self.state = ProcessStates.STOPPED
+        self.pid = 0
+        self.popen: Optional[subprocess.Popen] = None
+        self.proc_start = 0
+        self.pidfd: Optional[int] = None
+        self.pgid = 0
+        self.members: Dict[int, int] = {}
+        self.channels: List[Optional[OutputChannel]] = [None, None]
+        self.listener = None
+        self.start_time = 0.0
+        self.stop_time = 0.0
+        self.exited_at = 0.0
+        self.exit_code: Optional[int] = None
+        self.retries = 0
+        self.timer = None
+        # Set once SIGKILL was sent to a stopping instance
+        self.escalated = False
+        # Start again once stopped
+        self.restarting = False
+
+    def change_state(self, state: int, pid: Optional[int] = None) -> None:
+        # pid names the process a transition is about once self.pid has
+        # been cleared by its exit
+        logger.info("%s: %s -> %s", self.name, STATE_NAMES[self.state],
+                    STATE_NAMES[state])
+        previous = self.state
+        self.set_state(state)
+        event_class = STATE_EVENTS[state]
+        if self.supervisor.events.listeners.get(event_class):
+            self.supervisor.events.publish(event_class(
+                self.id, self.program_id, self.instance,
+                self.pid if pid is None else pid, previous, self.exit_code))
+
+    def set_state(self, state: int) -> None:
+        # Bookkeeping of a state change, without its event
+        self.supervisor.metrics.transition(
+            self.program, STATE_NAMES[self.state], STATE_NAMES[state])
+        self.supervisor.by_state[self.state].discard(self.id)
+        self.supervisor.by_state[state].add(self.id)
+        self.state = state
+        self.supervisor.touch(self)
+
+    def log_path(self, path: Optional[str]) -> Optional[str]:
+        if path and self.config.numprocs > 1 and not self.config.mergelogs:
+            return "%s.%d" % (path, self.instance)
+        return path
+
+    def environment(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        if self.config.env:
+            env.update({k: str(v) for k, v in self.config.env.items()})
+        return env
+
+    def pipe(self, path: Optional[str]):
+        if path:
+            return os.pipe()
+        return None, subprocess.DEVNULL
+
+    def attach(self, fd: Optional[int], path: Optional[str],
+               stream: str) -> Optional[OutputChannel]:
+        if fd is None:
+            return None
+        prefixer = None
+        if self.config.logprefix or self.config.mergelogs:
+            prefixer = LinePrefixer(self.name, self.config.logprefix)
+        sink = self.supervisor.open_log(self.log_path(path),
+                                        self.config.mergelogs)
+        counter = self.supervisor.metrics.log_bytes.labels(self.program,
+                                                           stream)
+        channel = OutputChannel(fd, sink, prefixer, counter)
+        event_class = LOG_EVENTS[stream]
+        channel.listeners = self.supervisor.events.listeners_for(event_class)
+        channel.publish = lambda data: self.supervisor.events.publish(
+            event_class(self.id, self.program_id, self.instance, self.pid,
+                        data))
+        self.supervisor.add_channel(channel)
+        return channel
+
+    def cancel_timer(self) -> None:
+        if self.timer is not None:
+            self.supervisor.cancel(self.timer)
+            self.timer = None
+
+    def spawn(self) -> None:
+        self.cancel_timer()
+        self.exit_code = None
+        pool = self.supervisor.pools[self.program_id]
+        stdin, feed = subprocess.DEVNULL, None
+        if pool is not None:
+            # Event listeners talk to us over their stdin and stdout
+            stdin, feed = os.pipe()
+            stdout, stdout_w = os.pipe()
+        else:
+            stdout, stdout_w = self.pipe(self.config.stdout)
+        stderr, stderr_w = self.pipe(self.config.stderr)
+        started = time.monotonic()
+        try:
+            self.popen = subprocess.Popen(
+                shlex.split(self.config.cmd),
+                cwd=self.config.workingdir,
+                env=self.environment(),
+                umask=parse_umask(self.config.umask),
+                stdin=stdin,
+                stdout=stdout_w,
+                stderr=stderr_w,
+                start_new_session=True,
+                preexec_fn=self.supervisor.tracker.preexec(self),
+            )
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            logger.error("%s: spawn failed: %s", self.name, e)
+            for fd in (feed, stdout, stderr):
+                if fd is not None:
+                    os.close(fd)
+            self.popen = None
+            self.change_state(ProcessStates.STARTING)
+            self.backoff()
+            return
+        finally:
+            for fd in (stdin, stdout_w, stderr_w):
+                if fd != subprocess.DEVNULL:
+                    os.close(fd)
+        self.supervisor.metrics.spawn_seconds.labels(self.program).observe(
+            time.monotonic() - started)
+        self.pid = self.pgid = self.popen.pid
+        self.members = {}
+        self.proc_start = linux.start_time(self.pid)
+        self.start_time = time.monotonic()
+        if pool is not None:
+            self.listener = pool.attach(self, feed, stdout)
+            self.channels = [None,
+                             self.attach(stderr, self.config.stderr, "stderr")]
+        else:
+            self.channels = [
+                self.attach(stdout, self.config.stdout, "stdout"),
+                self.attach(stderr, self.config.stderr, "stderr")]
+        self.supervisor.pids[self.pid] = self
+        self.change_state(ProcessStates.STARTING)
+        self.timer = self.supervisor.call_later(self.config.starttime,
+                                                self.started)
+        if self.supervisor.tracer.spawn:
+            self.supervisor.tracer.emit(tracing.SPAWN, self.program,
+                                        self.instance, self.pid, self.retries)
+
+    def adopt(self, pid: int, proc_start: int, state: int,
+              fds: List[int]) -> None:
+        # Take over an instance left running by a previous taskmasterd. Its
+        # pipes survive only when that daemon re-executed itself; otherwise
+        # it is not our child and its exit is watched through a pidfd.
+        self.pid = pid
+        self.proc_start = proc_start
+        age = linux.age(proc_start)
+        self.start_time = time.monotonic() - age
+        self.members = {}
+        try:
+            self.pgid = os.getpgid(pid)
+        except ProcessLookupError:
+            self.pgid = 0
+        if self.pgid == os.getpgid(0):
+            # Never signal our own process group on behalf of an instance
+            self.pgid = 0
+        self.channels = [None, None]
+        paths = (self.config.stdout, self.config.stderr)
+        streams = ("stdout", "stderr")
+        for i, (fd, path) in enumerate(zip(fds, paths)):
+            if fd >= 0:
+                os.set_inheritable(fd, False)
+                self.channels[i] = self.attach(fd, path, streams[i])
+        self.supervisor.pids[pid] = self
+        if linux.parent_pid(pid) != os.getpid():
+            self.supervisor.watch(self)
+        # The instance did not change state, it changed hands
+        logger.info("%s: adopted as %s", self.name, STATE_NAMES[state])
+        self.set_state(state)
+        if state == ProcessStates.STARTING:
+            self.timer = self.supervisor.call_later(
+                max(0.0, self.config.starttime - age), self.started)
+        elif state == ProcessStates.STOPPING:
+            self.timer = self.supervisor.call_later(self.config.stoptime or 0,
+                                                    self.kill)
+
+    def respawn(self) -> None:
+        self.supervisor.metrics.restarts.labels(self.program).value += 1
+        self.spawn()
+
+    def started(self) -> None:
+        self.timer = None
+        if self.state == ProcessStates.STARTING:
+            self.retries = 0
+            self.change_state(ProcessStates.RUNNING)
+            if self.supervisor.tracer.started:
+                self.supervisor.tracer.emit(tracing.STARTED, self.program,
+                                            self.instance, self.pid, 0)
+            metrics = self.supervisor.metrics
+            now = time.monotonic()
+            metrics.running_seconds.labels(self.program).observe(
+                now - self.start_time)
+            if self.exited_at:
+                metrics.restart_seconds.labels(self.program).observe(
+                    now - self.exited_at)
+                self.exited_at = 0.0
+
+    def backoff(self, pid: int = 0) -> None:
+        if self.supervisor.stopping:
+            # Not worth another attempt once shutting down
+            self.change_state(ProcessStates.STOPPED, pid)
+            return
+        self.retries += 1
+        if self.retries > self.config.startretries:
+            self.change_state(ProcessStates.FATAL, pid)
+            if self.supervisor.tracer.fatal:
+                self.supervisor.tracer.emit(tracing.FATAL, self.program,
+                                            self.instance, pid, self.retries)
+            return
+        self.change_state(ProcessStates.BACKOFF, pid)
+        self.timer = self.supervisor.call_later(self.retries, self.respawn)
+        if self.supervisor.tracer.backoff:
+            self.supervisor.tracer.emit(tracing.BACKOFF, self.program,
+                                        self.instance, pid, self.retries)
+
+    def start(self) -> bool:
+        if self.state in RUNNING_STATES:
+            return False
+        self.cancel_timer()
+        self.retries = 0
+        self.exited_at = 0.0
+        self.spawn()
+        return True
+
+    def stop(self, escalate: bool = True) -> bool:
+        # Without escalate the caller arms the SIGKILL timer, see
+        # Supervisor.stop_processes()
+        if self.state == ProcessStates.BACKOFF:
+            self.cancel_timer()
+            self.exited_at = 0.0
+            self.change_state(ProcessStates.STOPPED)
+            return True
+        if self.state not in (ProcessStates.STARTING, ProcessStates.RUNNING):
+            return False
+        self.cancel_timer()
+        self.exited_at = 0.0
+        self.escalated = False
+        self.change_state(ProcessStates.STOPPING)
+        if self.supervisor.tracer.stop_requested:
+            self.supervisor.tracer.emit(tracing.STOP_REQUESTED, self.program,
+                                        self.instance, self.pid, 0)
+        self.stop_time = time.monotonic()
+        self.signal(parse_signal(self.config.stopsignal))
+        if escalate:
+            self.timer = self.supervisor.call_later(
+                self.config.stoptime or 0, self.kill)
+        return True
+
+    def kill(self) -> None:
+        self.timer = None
+        if self.state == ProcessStates.STOPPING:
+            self.escalated = True
+            logger.warning("%s: still running after %ss, killing", self.name,
+                           self.config.stoptime)
+            if self.supervisor.tracer.killed:
+                self.supervisor.tracer.emit(tracing.KILLED, self.program,
+                                            self.instance, self.pid, 0)
+            self.signal(signal.SIGKILL)
+
+    def signal(self, sig: int) -> None:
+        self.supervisor.tracker.signal(self, sig)
+
+    def follow(self, pid: int, proc_start: int) -> None:
+        logger.info("%s: pid %d exited, following pid %d", self.name,
+                    self.pid, pid)
+        self.pid = pid
+        self.proc_start = proc_start
+        self.members.pop(pid, None)
+        self.supervisor.touch(self)
+        self.supervisor.pids[pid] = self
+        if linux.parent_pid(pid) != os.getpid():
+            self.supervisor.watch(self)
+        if self.state == ProcessStates.STOPPING and self.escalated:
+            self.signal(signal.SIGKILL)
+
+    def exited(self, status: Optional[int]) -> None:
+        # status is None when the exit of an adopted process was seen
+        # through its pidfd and its exit code is lost
+        self.supervisor.pids.pop(self.pid, None)
+        self.supervisor.unwatch(self)
+        self.exit_code = None
+        if status is not None:
+            self.exit_code = os.waitstatus_to_exitcode(status)
+        if self.popen is not None:
+            self.popen.returncode = self.exit_code
+            self.popen = None
+        if self.supervisor.tracer.exited:
+            self.supervisor.tracer.emit(
+                tracing.EXITED, self.program, self.instance, self.pid,
+                -1 if self.exit_code is None else self.exit_code)
+        state = self.state
+        if (state == ProcessStates.STOPPING
+                or self.exit_code in exit_codes(self.config)):
+            # The leader may have forked and daemonized: keep following the
+            # instance through its oldest surviving descendant
+            survivor = self.supervisor.tracker.survivor(self)
+            if survivor is not None:
+                self.follow(*survivor)
+                return
+        self.cancel_timer()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        pid = self.pid
+        self.pid = self.pgid = 0
+        self.members = {}
+        self.proc_start = 0
+        if state != ProcessStates.STOPPING and not self.exited_at:
+            self.exited_at = time.monotonic()
+        if state == ProcessStates.STOPPING:
+            self.change_state(ProcessStates.STOPPED, pid)
+            if self.restarting and not self.supervisor.stopping:
+                self.restarting = False
+                self.start()
+        elif state == ProcessStates.STARTING:
+            self.backoff(pid)
+        elif state == ProcessStates.RUNNING:
+            self.change_state(ProcessStates.EXITED, pid)
+            if self.should_restart():
+                self.respawn()
+
+    def should_restart(self) -> bool:
+        if self.supervisor.stopping:
+            return False
+        autorestart = self.config.autorestart
+        if autorestart == "unexpected":
+            return self.exit_code not in exit_codes(self.config)
+        if isinstance(autorestart, str):
+            return autorestart.lower() in ("true", "always")
+        return autorestart
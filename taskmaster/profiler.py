@@ -0,0 +1,102 @@
+import os
+import signal
+import time
+from typing import Dict, Optional, Tuple
+
+MIN_INTERVAL = 0.001
+MAX_DURATION = 300.0
+# Share of the profiled CPU time the sampler may spend in its own handler
+# before it halves its sampling rate
+BUDGET = 0.01
+
+
+class SamplingProfiler:
+    # SIGPROF fires on consumed CPU time only: an idle daemon blocked in
+    # select() is never sampled. The handler only counts a tuple of code
+    # objects; names are formatted once, when the stacks are collected.
+    def __init__(self, interval: float = 0.01, budget: float = BUDGET):
+        self.interval = max(interval, MIN_INTERVAL)
+        self.budget = budget
+        self.stacks: Dict[Tuple, int] = {}
+        self.samples = 0
+        self.overhead = 0.0
+        self.started = 0.0
+        self.cpu_started = 0.0
+        self.previous = None
+        self.running = False
+
+    def handler(self, signum: int, frame) -> None:
+        start = time.perf_counter()
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        key = tuple(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+        self.overhead += time.perf_counter() - start
+        if self.overhead > self.budget * (time.process_time()
+                                          - self.cpu_started):
+            self.interval *= 2
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def start(self) -> None:
+        self.running = True
+        self.started = time.monotonic()
+        self.cpu_started = time.process_time()
+        self.previous = signal.signal(signal.SIGPROF, self.handler)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self.running = False
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+
+    @staticmethod
+    def frame_name(code) -> str:
+        return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+    def collapsed(self) -> str:
+        names: Dict[object, str] = {}
+        lines = []
+        for stack, count in self.stacks.items():
+            parts = []
+            for code in reversed(stack):
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = self.frame_name(code)
+                parts.append(name)
+            lines.append("%s %d" % (";".join(parts), count))
+        lines.sort()
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def report(self) -> Dict:
+        cpu = time.process_time() - self.cpu_started
+        return {
+            "duration": round(time.monotonic() - self.started, 3),
+            "cpu": round(cpu, 3),
+            "samples": self.samples,
+            "interval": self.interval,
+            "overhead": round(self.overhead, 6),
+            "overhead_percent": round(100 * self.overhead / cpu, 3)
+            if cpu > 0 else 0.0,
+            "stacks": self.collapsed(),
+        }
+
+
+def profile_for(supervisor, seconds: float, interval: float,
+                done) -> Optional[SamplingProfiler]:
+    profiler = SamplingProfiler(interval)
+    supervisor.profiler = profiler
+
+    def finish():
+        profiler.stop()
+        supervisor.profiler = None
+        done(profiler.report())
+
+    profiler.start()
+    supervisor.call_later(min(seconds, MAX_DURATION), finish)
+    return profiler
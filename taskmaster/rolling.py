@@ -0,0 +1,96 @@
+import logging
+from typing import Callable, List, Optional
+
+from events import ProcessStateEvent
+from process import EVENT_STATES, Process, ProcessStates
+
+logger = logging.getLogger("taskmasterd")
+
+# Added to stoptime + starttime to get the default time a batch may take
+BATCH_SLACK = 10
+
+
+class RollingRestart:
+    # Restarts instances a batch at a time. A batch is through once all its
+    # instances were spawned again or, with wait_running, once all of them
+    # passed their starttime and reached RUNNING. An instance that goes to
+    # BACKOFF or FATAL, or a batch that is not through in time, ends the
+    # rollout: a broken release takes down one batch at most.
+    def __init__(self, supervisor, processes: List[Process], size: int,
+                 wait_running: bool, timeout: Optional[float],
+                 progress: Callable, done: Callable):
+        self.supervisor = supervisor
+        self.processes = processes
+        self.size = size
+        self.wait_running = wait_running
+        self.timeout = timeout
+        self.progress = progress
+        self.done = done
+        self.batches = (len(processes) + size - 1) // size
+        self.batch = 0
+        self.pending = set()
+        self.timer = None
+        self.finished = False
+
+    def start(self) -> None:
+        self.supervisor.events.subscribe(ProcessStateEvent, self.changed)
+        self.next_batch()
+
+    def next_batch(self) -> None:
+        self.timer = None
+        if self.batch == self.batches:
+            self.finish(None)
+            return
+        if self.supervisor.stopping:
+            self.finish("taskmasterd is shutting down")
+            return
+        batch = self.processes[self.batch * self.size:
+                               (self.batch + 1) * self.size]
+        self.batch += 1
+        self.pending = {process.id for process in batch}
+        timeout = self.timeout
+        if timeout is None:
+            timeout = max((process.config.stoptime or 0)
+                          + process.config.starttime
+                          for process in batch) + BATCH_SLACK
+        self.timer = self.supervisor.call_later(timeout, self.expired)
+        logger.info("rolling restart: batch %d/%d", self.batch, self.batches)
+        # State changes of the batch come back through changed()
+        self.supervisor.restart_processes(batch)
+
+    def changed(self, event: ProcessStateEvent) -> None:
+        if self.finished or event.process not in self.pending:
+            return
+        state = EVENT_STATES[type(event)]
+        if state in (ProcessStates.BACKOFF, ProcessStates.FATAL):
+            self.finish("%s went %s" % (
+                self.supervisor.table[event.process].name,
+                "FATAL" if state == ProcessStates.FATAL else "BACKOFF"))
+            return
+        if state == (ProcessStates.RUNNING if self.wait_running
+                     else ProcessStates.STARTING):
+            self.pending.discard(event.process)
+            if not self.pending:
+                self.supervisor.cancel(self.timer)
+                self.progress(self.batch, self.batches, [
+                    process.name for process in self.processes[
+                        (self.batch - 1) * self.size:self.batch * self.size]])
+                # Not from within the restart of the batch that completed
+                self.timer = self.supervisor.call_later(0, self.next_batch)
+
+    def expired(self) -> None:
+        self.timer = None
+        self.finish("%d instances not %s in time" % (
+            len(self.pending), "running" if self.wait_running else "started"))
+
+    def finish(self, error: Optional[str]) -> None:
+        self.finished = True
+        if self.timer is not None:
+            self.supervisor.cancel(self.timer)
+            self.timer = None
+        self.supervisor.events.unsubscribe(self.changed)
+        if error is not None:
+            logger.warning("rolling restart stopped at batch %d/%d: %s",
+                           self.batch, self.batches, error)
+            error = "batch %d/%d: %s" % (self.batch, self.batches, error)
+        self.done(error)
@@ -0,0 +1,134 @@
+import os
+import resource
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class Sample:
+    __slots__ = ("time", "cpu_time", "cpu_percent", "rss", "threads", "fds")
+
+    def __init__(self, cpu_time: float, rss: int, threads: int, fds: int):
+        self.time = time.monotonic()
+        self.cpu_time = cpu_time
+        self.cpu_percent = 0.0
+        self.rss = rss
+        self.threads = threads
+        self.fds = fds
+
+
+def count_fds(pid: int) -> int:
+    path = "/proc/%d/fd" % pid
+    try:
+        # Since Linux 6.2 the size of the fd directory is the number of
+        # open descriptors, which spares listing it
+        size = os.stat(path).st_size
+        if size:
+            return size
+        return len(os.listdir(path))
+    except OSError:
+        return -1
+
+
+class ProcSampler:
+    # Keeps /proc/<pid>/stat and statm open between cycles and re-reads them
+    # with pread: a cycle is two preads per pid instead of two open/read/close
+    # triplets. An fd opened on a /proc file fails with ESRCH once the process
+    # is gone, so a reused pid can never be sampled through a stale fd.
+    # The kernel needs a few microseconds to render each file, so a cycle can
+    # be spread over several event-loop iterations with begin() and step().
+    def __init__(self, max_fds: Optional[int] = None):
+        if max_fds is None:
+            max_fds = resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 4
+        self.max_fds = max_fds
+        self.open: Dict[int, Tuple[int, int]] = {}
+        self.samples: Dict[int, Sample] = {}
+        self.pending: List[int] = []
+        self.next: Dict[int, Sample] = {}
+        self.started = 0.0
+        self.duration = 0.0
+
+    def read(self, pid: int) -> Optional[Sample]:
+        fds = self.open.get(pid)
+        keep = True
+        if fds is None:
+            try:
+                stat = os.open("/proc/%d/stat" % pid, os.O_RDONLY)
+            except OSError:
+                return None
+            try:
+                statm = os.open("/proc/%d/statm" % pid, os.O_RDONLY)
+            except OSError:
+                os.close(stat)
+                return None
+            fds = (stat, statm)
+            keep = len(self.open) * 2 < self.max_fds
+            if keep:
+                self.open[pid] = fds
+        try:
+            stat = os.pread(fds[0], 4096, 0)
+            statm = os.pread(fds[1], 256, 0)
+        except OSError:
+            stat = None
+        if stat is None or not keep:
+            self.close(pid, fds)
+        if stat is None:
+            return None
+        fields = stat[stat.rindex(b")") + 2:].split()
+        return Sample((int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+                      int(statm.split()[1]) * PAGE_SIZE, int(fields[17]),
+                      count_fds(pid))
+
+    def close(self, pid: int, fds: Tuple[int, int]) -> None:
+        if self.open.get(pid) == fds:
+            del self.open[pid]
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def begin(self, pids: Iterable[int]) -> None:
+        self.pending = list(pids)
+        self.pending.reverse()
+        self.next = {}
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def step(self, count: int) -> bool:
+        start = time.monotonic()
+        previous = self.samples
+        pending = self.pending
+        samples = self.next
+        for _ in range(min(count, len(pending))):
+            pid = pending.pop()
+            sample = self.read(pid)
+            if sample is None:
+                continue
+            last = previous.get(pid)
+            if last is not None and sample.time > last.time:
+                sample.cpu_percent = 100 * (
+                    (sample.cpu_time - last.cpu_time) / (sample.time - last.time))
+            samples[pid] = sample
+        self.duration += time.monotonic() - start
+        if pending:
+            return True
+        for pid in [pid for pid in self.open if pid not in samples]:
+            self.close(pid, self.open[pid])
+        self.samples = samples
+        self.next = {}
+        return False
+
+    def sample(self, pids: Iterable[int]) -> Dict[int, Sample]:
+        self.begin(pids)
+        self.step(len(self.pending))
+        return self.samples
+
+    def clear(self) -> None:
+        for pid, fds in list(self.open.items()):
+            self.close(pid, fds)
+        self.samples = {}
+        self.pending = []
+        self.next = {}
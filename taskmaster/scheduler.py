@@ -0,0 +1,91 @@
+import logging
+from typing import Dict, List
+
+from events import ProcessStateEvent
+from process import EVENT_STATES, ProcessStates
+
+logger = logging.getLogger("taskmasterd")
+
+
+class StartScheduler:
+    # Starts each program as soon as every program it depends on has all
+    # its instances RUNNING, so that start-up takes the critical path of
+    # the dependency graph rather than the sum of its levels. Programs that
+    # become ready together start by ascending priority.
+    def __init__(self, supervisor, program_ids: List[int]):
+        self.supervisor = supervisor
+        names = supervisor.names
+        self.programs = len(names.programs)
+        self.instances = [len(names.instances(program_id))
+                          for program_id in range(self.programs)]
+        # Dependencies not satisfied yet of each program left to start
+        self.waiting: Dict[int, int] = {
+            program_id: len(names.depends[program_id])
+            for program_id in program_ids}
+        self.running = [0] * self.programs
+        for process in supervisor.table:
+            if process.state == ProcessStates.RUNNING:
+                self.running[process.program_id] += 1
+        self.satisfied = [False] * self.programs
+
+    def start(self) -> None:
+        ready = [program_id for program_id, count in self.waiting.items()
+                 if not count]
+        for program_id in range(self.programs):
+            if self.running[program_id] == self.instances[program_id]:
+                ready += self.satisfy(program_id)
+        if self.waiting:
+            self.supervisor.events.subscribe(ProcessStateEvent, self.changed)
+        self.launch(ready)
+
+    def satisfy(self, program_id: int) -> List[int]:
+        # Programs that became ready
+        self.satisfied[program_id] = True
+        ready = []
+        for dependent in self.supervisor.names.dependents[program_id]:
+            if dependent in self.waiting:
+                self.waiting[dependent] -= 1
+                if not self.waiting[dependent]:
+                    ready.append(dependent)
+        return ready
+
+    def launch(self, ready: List[int]) -> None:
+        supervisor = self.supervisor
+        programs = supervisor.config.programs
+        names = supervisor.names
+        ready.sort(key=lambda program_id:
+                   (programs[names.programs[program_id]].priority, program_id))
+        for program_id in ready:
+            del self.waiting[program_id]
+        if not self.waiting:
+            supervisor.events.unsubscribe(self.changed)
+        for program_id in ready:
+            supervisor.start_processes([
+                supervisor.table[process_id]
+                for process_id in names.instances(program_id)
+                if supervisor.table[process_id].state
+                == ProcessStates.STOPPED])
+
+    def changed(self, event: ProcessStateEvent) -> None:
+        if self.supervisor.stopping:
+            self.waiting.clear()
+            self.supervisor.events.unsubscribe(self.changed)
+            return
+        program_id = event.program
+        state = EVENT_STATES[type(event)]
+        if state == ProcessStates.RUNNING:
+            self.running[program_id] += 1
+        elif event.from_state == ProcessStates.RUNNING:
+            self.running[program_id] -= 1
+        if state == ProcessStates.FATAL:
+            blocked = [self.supervisor.names.programs[dependent]
+                       for dependent in
+                       self.supervisor.names.dependents[program_id]
+                       if dependent in self.waiting]
+            if blocked:
+                logger.warning("%s is FATAL, %s cannot start",
+                               self.supervisor.table[event.process].name,
+                               ", ".join(blocked))
+        if (not self.satisfied[program_id]
+                and self.running[program_id] == self.instances[program_id]):
+            self.launch(self.satisfy(program_id))
@@ -0,0 +1,45 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from process import Process
+
+VERSION = 1
+
+
+def snapshot(processes: List[Process]) -> bytes:
+    table = []
+    for process in processes:
+        if not process.pid:
+            continue
+        fds = [channel.fd if channel is not None else -1
+               for channel in process.channels]
+        table.append([process.program, process.instance, process.pid,
+                      process.proc_start, process.state, fds])
+    return json.dumps({"version": VERSION, "daemon": os.getpid(),
+                       "processes": table}, separators=(",", ":")).encode()
+
+
+def write_snapshot(path: str, processes: List[Process]) -> None:
+    data = snapshot(processes)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "rb") as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        return None
+    return data
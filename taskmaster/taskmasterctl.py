@@ -1,20 +1,723 @@
-import signal
+import argparse
+import array
+import base64
+import json
+import os
+import shlex
+import socket
+import sys
+import threading
+import time
 import typing
-from types import FrameType
+
+try:
+    import readline
+except ImportError:
+    readline = None
+
+DEFAULT_SOCKET = "/tmp/taskmaster.sock"
+HISTORY_FILE = "~/.taskmasterctl_history"
+# Batch commands waiting for their reply at the same time
+MAX_IN_FLIGHT = 64
+
+
+class ControlError(Exception):
+    pass
+
 
 class Controller:
-    configFile = None
+    socketFile = None
+
     def __init__(self, options):
         self.options = options
-        self.configFile = "/etc/supervisord.conf"
+        self.socketFile = options.socket
+        self.sock = None
+        self.buffer = b""
+        self.nextId = 0
+        # Once a reader thread owns the socket, replies are routed to the
+        # requests waiting for them by id and events to their streams
+        self.reader = None
+        self.lock = threading.Lock()
+        self.waiting: typing.Dict[int, list] = {}
+        self.streams: typing.Dict[int, typing.Callable] = {}
+        self.onClose = None
+        # local.sent is set once the thread's next request is written
+        self.local = threading.local()
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.socketFile)
+        except OSError as e:
+            self.sock.close()
+            self.sock = None
+            raise ControlError("cannot connect to %s: %s"
+                               % (self.socketFile, e.strerror))
+
+    def readMessage(self) -> typing.Dict:
+        while b"\n" not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ControlError("connection closed by taskmasterd")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def send(self, cmd: str, args: typing.Optional[typing.Dict] = None,
+             waiter: typing.Optional[list] = None,
+             stream: typing.Optional[typing.Callable] = None) -> int:
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            self.nextId += 1
+            requestId = self.nextId
+            if waiter is not None:
+                self.waiting[requestId] = waiter
+            if stream is not None:
+                self.streams[requestId] = stream
+            message = {"id": requestId, "cmd": cmd, "args": args or {}}
+            self.sock.sendall(json.dumps(message).encode() + b"\n")
+        sent = getattr(self.local, "sent", None)
+        if sent is not None:
+            self.local.sent = None
+            sent.set()
+        return requestId
+
+    def request(self, cmd: str, args: typing.Optional[typing.Dict] = None,
+                stream: typing.Optional[typing.Callable] = None,
+                keep: bool = True):
+        # Without keep, the stream ends with the reply
+        if self.reader is not None:
+            waiter = [threading.Event(), None]
+            requestId = self.send(cmd, args, waiter, stream)
+            waiter[0].wait()
+            reply = waiter[1]
+        else:
+            requestId = self.send(cmd, args, stream=stream)
+            reply = self.readMessage()
+            while reply.get("id") != requestId or "event" in reply:
+                self.route(reply)
+                reply = self.readMessage()
+        if not reply.get("ok") or not keep:
+            self.streams.pop(requestId, None)
+        if not reply.get("ok"):
+            raise ControlError(reply.get("error", "request failed"))
+        return reply.get("result")
+
+    def route(self, message: typing.Dict) -> None:
+        if "event" in message:
+            stream = self.streams.get(message.get("id"))
+            if stream is not None:
+                stream(message["event"])
+            return
+        with self.lock:
+            waiter = self.waiting.pop(message.get("id"), None)
+        if waiter is not None:
+            waiter[1] = message
+            waiter[0].set()
+
+    def pump(self) -> None:
+        while True:
+            self.route(self.readMessage())
+
+    def startReader(self) -> None:
+        if self.sock is None:
+            self.connect()
+        self.reader = threading.Thread(target=self.readLoop, daemon=True)
+        self.reader.start()
+
+    def readLoop(self) -> None:
+        try:
+            self.pump()
+        except ControlError as e:
+            error = str(e)
+        except (OSError, ValueError) as e:
+            error = "connection lost: %s" % e
+        with self.lock:
+            waiters = list(self.waiting.values())
+            self.waiting.clear()
+            self.streams.clear()
+        for waiter in waiters:
+            waiter[1] = {"ok": False, "error": error}
+            waiter[0].set()
+        if self.onClose is not None:
+            self.onClose(error)
+
+    def unsubscribeAll(self) -> int:
+        streams = list(self.streams)
+        for requestId in streams:
+            self.request("unsubscribe", {"subscription": requestId})
+            self.streams.pop(requestId, None)
+        return len(streams)
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+def formatUptime(seconds: float) -> str:
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    text = "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    if days:
+        return "%d days, %s" % (days, text)
+    return text
+
+
+def formatBytes(size: float) -> str:
+    if size < 1024:
+        return "%dB" % size
+    for unit in "KMG":
+        size /= 1024
+        if size < 1024 or unit == "G":
+            return "%.1f%s" % (size, unit)
+
+
+def formatStatus(row: typing.Dict) -> str:
+    if row["pid"]:
+        detail = "pid %d, uptime %s" % (row["pid"], formatUptime(row["uptime"]))
+    elif row["exitcode"] is not None:
+        detail = "exit code %d" % row["exitcode"]
+    else:
+        detail = ""
+    line = "%-32s %-9s %s" % (row["name"], row["state"], detail)
+    resources = row.get("resources")
+    if resources:
+        line = "%-72s cpu %5.1f%%  rss %7s  threads %3d  fds %4d" % (
+            line, resources["cpu"], formatBytes(resources["rss"]),
+            resources["threads"], resources["fds"])
+    return line
+
+
+def decodeColumns(result: typing.Dict) -> typing.Dict[str, array.array]:
+    # Unpacks the reply of the columns command
+    decoded = {}
+    for column, typecode in result["typecodes"].items():
+        values = array.array(typecode)
+        values.frombytes(base64.b64decode(result[column]))
+        if result["byteorder"] != sys.byteorder:
+            values.byteswap()
+        decoded[column] = values
+    return decoded
+
+
+def statusRows(controller: Controller, args: typing.Dict,
+               versions: typing.Optional[typing.List[int]] = None):
+    # Yields rows chunk by chunk as the daemon sends them, and appends the
+    # table version of each chunk to versions
+    args = dict(args)
+    while True:
+        reply = controller.request("status", args)
+        if versions is not None:
+            versions.append(reply["version"])
+        yield from reply["rows"]
+        if reply["cursor"] is None:
+            return
+        args["cursor"] = reply["cursor"]
+
+
+def status(controller: Controller, options) -> int:
+    args = {"resources": options.resources, "sort": options.sort,
+            "limit": options.chunk}
+    if options.state:
+        args["states"] = options.state
+    if options.program:
+        args["programs"] = options.program
+    if options.min_uptime is not None:
+        args["min_uptime"] = options.min_uptime
+    if options.max_uptime is not None:
+        args["max_uptime"] = options.max_uptime
+    if options.since is not None:
+        args["since"] = options.since
+    versions = []
+    for row in statusRows(controller, args, versions):
+        print(formatStatus(row), flush=True)
+    if options.since is not None:
+        # The version to poll from next time
+        print("version %d" % versions[0])
+    return 0
+
+
+def formatSeconds(seconds: float) -> str:
+    if seconds < 0.001:
+        return "%.0fus" % (seconds * 1e6)
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1e3)
+    return "%.2fs" % seconds
+
+
+def stats(controller: Controller, options) -> int:
+    rows = controller.request("stats", {"program": options.program,
+                                        "reset": options.reset})
+    print("%-28s %-20s %8s %9s %9s %9s %9s %9s" % (
+        "METRIC", "PROGRAM", "COUNT", "MEAN", "P50", "P90", "P99", "MAX"))
+    for row in rows:
+        print("%-28s %-20s %8d %9s %9s %9s %9s %9s" % (
+            row["metric"], row["program"], row["count"],
+            formatSeconds(row["mean"]), formatSeconds(row["p50"]),
+            formatSeconds(row["p90"]), formatSeconds(row["p99"]),
+            formatSeconds(row["max"])))
+    if options.reset:
+        print("histograms reset")
+    return 0
+
+
+def profile(controller: Controller, options) -> int:
+    report = controller.request("profile", {
+        "seconds": options.seconds, "interval": options.interval / 1000})
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(report["stacks"])
+    else:
+        sys.stdout.write(report["stacks"])
+    print("%d samples over %.1fs (%.2fs CPU), sampler overhead %.3f%%" % (
+        report["samples"], report["duration"], report["cpu"],
+        report["overhead_percent"]), file=sys.stderr)
+    return 0
+
+
+def formatEvent(event: typing.Dict, tables: typing.Dict) -> str:
+    # Events carry ids, resolved with the tables of the subscribe reply
+    name = event["event"]
+    if "process" not in event:
+        return name
+    program, instance = tables["processes"][event["process"]]
+    line = "%-32s %s" % ("%s:%d" % (tables["programs"][program], instance),
+                         name)
+    if "data" in event:
+        return "%s %s" % (line, event["data"].rstrip("\n"))
+    if event.get("count", 1) > 1:
+        line += " (from %s, %d changes)" % (
+            tables["states"][str(event["from_state"])], event["count"])
+    if event.get("exit_code") is not None:
+        line += " exit code %d" % event["exit_code"]
+    return line
+
+
+def parseInstances(text: str) -> typing.List[int]:
+    low, _, high = text.partition("-")
+    return [int(low), int(high or low)]
+
+
+def events(controller: Controller, options) -> int:
+    args = {"programs": options.program, "events": options.event}
+    if options.instances:
+        args["instances"] = parseInstances(options.instances)
+    tables = {}
+    ready = threading.Event()
+
+    def show(event: typing.Dict) -> None:
+        # A reader thread may see events before the reply is unpacked here
+        ready.wait()
+        print(formatEvent(event, tables), flush=True)
+
+    tables.update(controller.request("subscribe", args, show))
+    ready.set()
+    if controller.reader is not None:
+        # In the shell, events keep coming in the background
+        return 0
+    try:
+        controller.pump()
+    except KeyboardInterrupt:
+        return 0
+
+
+def control(action: str, done: str):
+    def handler(controller: Controller, options) -> int:
+        names = controller.request(action, {"targets": options.targets})
+        for name in names:
+            print("%s: %s" % (name, done))
+        return 0
+    return handler
+
+
+def rollingRestart(controller: Controller, options) -> int:
+    def progress(event: typing.Dict) -> None:
+        names = event["processes"]
+        print("batch %d/%d: %s%s %s" % (
+            event["batch"], event["batches"], names[0],
+            " .. %s" % names[-1] if len(names) > 1 else "",
+            "running" if options.wait_running else "restarted"), flush=True)
+
+    args = {"targets": options.targets, "batch": options.batch,
+            "wait_running": options.wait_running}
+    if options.timeout is not None:
+        args["timeout"] = options.timeout
+    result = controller.request("rolling-restart", args, stream=progress,
+                                keep=False)
+    print("%d instances restarted in %d batches" % (result["restarted"],
+                                                    result["batches"]))
+    return 0
+
+
+def history(controller: Controller, options) -> int:
+    rows = controller.request("history", {"program": options.program,
+                                          "limit": options.limit})
+    for row in rows:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["time"]))
+        name = "%s:%d" % (options.program, row["instance"])
+        if "command" in row:
+            print("%s.%03d %-32s %s" % (when, row["time"] % 1 * 1000, name,
+                                         row["command"]))
+            continue
+        line = "%s.%03d %-32s %-8s -> %-8s" % (
+            when, row["time"] % 1 * 1000, name, row["from"], row["to"])
+        if row["pid"]:
+            line += " pid %d" % row["pid"]
+        if row["exitcode"] is not None:
+            line += " exit code %d" % row["exitcode"]
+        print(line)
+    return 0
+
+
+class PromptWriter:
+    # Stands in for sys.stdout while the shell is at its prompt: output from
+    # background commands is written above the line being edited, which is
+    # then redrawn. fileno() keeps input() on its readline path.
+    def __init__(self, stream, prompt: str):
+        self.stream = stream
+        self.encoding = stream.encoding
+        self.errors = stream.errors
+        self.prompt = prompt
+        self.lock = threading.Lock()
+        self.partial = ""
+        self.reading = False
+
+    def write(self, text: str) -> int:
+        with self.lock:
+            self.partial += text
+            if "\n" not in self.partial:
+                return len(text)
+            lines, self.partial = self.partial.rsplit("\n", 1)
+            if self.reading:
+                self.stream.write("\r\x1b[K")
+            self.stream.write(lines + "\n")
+            if self.reading:
+                line = readline.get_line_buffer() if readline else ""
+                self.stream.write(self.prompt + line)
+            self.stream.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def fileno(self) -> int:
+        return self.stream.fileno()
+
+    def isatty(self) -> bool:
+        return self.stream.isatty()
+
+
+class Shell:
+    prompt = "taskmaster> "
+    builtins = ("help", "quit", "exit", "unsubscribe")
+
+    def __init__(self, controller: Controller, parser, commands):
+        self.controller = controller
+        self.parser = parser
+        self.commands = sorted(commands.choices) + list(self.builtins)
+        self.names: typing.List[str] = []
+
+    def complete(self, text: str, state: int) -> typing.Optional[str]:
+        line = readline.get_line_buffer() if readline else text
+        first = not line[:len(line) - len(text)].strip()
+        candidates = self.commands if first else self.names
+        matches = [word for word in candidates if word.startswith(text)]
+        return matches[state] if state < len(matches) else None
+
+    def loadNames(self) -> None:
+        try:
+            names = set()
+            for row in statusRows(self.controller, {}):
+                program = row["name"].rsplit(":", 1)[0]
+                names.update((row["name"], program, program + ":*"))
+            names.add("all")
+        except ControlError:
+            return
+        self.names = sorted(names)
+
+    def execute(self, line: str) -> bool:
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print("error: %s" % e)
+            return True
+        if not words:
+            return True
+        if words[0] in ("quit", "exit"):
+            return False
+        if words[0] == "help":
+            self.parser.print_help()
+            return True
+        if words[0] == "unsubscribe":
+            self.run(lambda: print("%d subscriptions cancelled"
+                                   % self.controller.unsubscribeAll()))
+            return True
+        try:
+            options = self.parser.parse_args(words)
+        except SystemExit:
+            return True
+        if options.command is None:
+            return True
+        self.run(lambda: options.handler(self.controller, options))
+        return True
+
+    def run(self, command: typing.Callable) -> None:
+        # Commands run in the background so that the prompt stays usable
+        def target():
+            try:
+                command()
+            except ControlError as e:
+                print("error: %s" % e)
+        threading.Thread(target=target, daemon=True).start()
+
+    def loop(self) -> int:
+        history = os.path.expanduser(HISTORY_FILE)
+        if readline is not None:
+            try:
+                readline.read_history_file(history)
+            except OSError:
+                pass
+            readline.set_completer(self.complete)
+            readline.set_completer_delims(" \t")
+            readline.parse_and_bind("tab: complete")
+        self.controller.onClose = lambda error: print("taskmasterctl: %s"
+                                                      % error)
+        self.controller.startReader()
+        self.loadNames()
+        writer = PromptWriter(sys.stdout, self.prompt)
+        stdout, sys.stdout = sys.stdout, writer
+        try:
+            while self.controller.reader.is_alive():
+                writer.reading = True
+                try:
+                    line = input(self.prompt)
+                except EOFError:
+                    print()
+                    break
+                except KeyboardInterrupt:
+                    print()
+                    continue
+                finally:
+                    writer.reading = False
+                if not self.execute(line):
+                    break
+        finally:
+            sys.stdout = stdout
+            self.controller.onClose = None
+            if readline is not None:
+                try:
+                    readline.write_history_file(history)
+                except OSError:
+                    pass
+        return 0
+
+
+class ThreadOutput:
+    # Stands in for sys.stdout during a batch: each command collects its
+    # output in its own buffer so that results are printed whole
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self) -> None:
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def capture(self) -> None:
+        self.local.buffer = []
+
+    def collect(self) -> str:
+        text = "".join(self.local.buffer)
+        self.local.buffer = None
+        return text
+
+
+class Batch:
+    # Commands are sent in script order as they are read, over one
+    # connection: the next line is only read once the request of the
+    # previous one is written. Each result is printed when its reply arrives.
+    def __init__(self, controller: Controller, parser, lines):
+        self.controller = controller
+        self.parser = parser
+        self.lines = lines
+        self.window = threading.Semaphore(MAX_IN_FLIGHT)
+        self.lock = threading.Lock()
+        self.output = None
+        self.commands = 0
+        self.failed = 0
+
+    def report(self, line: str, text: str, ok: bool) -> None:
+        with self.lock:
+            self.commands += 1
+            if not ok:
+                self.failed += 1
+            self.output.stream.write("> %s\n%s" % (line, text))
+            self.output.stream.flush()
+
+    def execute(self, line: str, options, sent: threading.Event) -> None:
+        self.output.capture()
+        self.controller.local.sent = sent
+        ok = False
+        try:
+            ok = options.handler(self.controller, options) == 0
+        except ControlError as e:
+            print("error: %s" % e)
+        finally:
+            # Handlers that fail before sending anything
+            sent.set()
+            self.report(line, self.output.collect(), ok)
+            self.window.release()
+
+    def run(self) -> int:
+        self.controller.startReader()
+        self.output = ThreadOutput(sys.stdout)
+        stdout, sys.stdout = sys.stdout, self.output
+        threads = []
+        try:
+            for line in self.lines:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    options = self.parser.parse_args(shlex.split(line))
+                except (SystemExit, ValueError):
+                    options = None
+                if options is None or options.command is None:
+                    self.report(line, "error: invalid command\n", False)
+                    continue
+                self.window.acquire()
+                sent = threading.Event()
+                thread = threading.Thread(target=self.execute,
+                                          args=(line, options, sent),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+                sent.wait()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.stdout = stdout
+        print("%d commands, %d failed" % (self.commands, self.failed),
+              file=sys.stderr)
+        return 1 if self.failed else 0
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog="taskmasterctl")
+    parser.add_argument("-s", "--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("-f", "--file",
+                        help="run the commands of a file, - for stdin")
+    commands = parser.add_subparsers(dest="command")
+    parser_status = commands.add_parser("status")
+    parser_status.add_argument("--resources", action="store_true",
+                               help="show CPU, memory, threads and fds")
+    parser_status.add_argument("--state", action="append",
+                               help="only instances in this state, "
+                                    "repeatable")
+    parser_status.add_argument("-p", "--program", action="append",
+                               help="program name or glob, repeatable")
+    parser_status.add_argument("--min-uptime", type=float,
+                               help="only instances running this many "
+                                    "seconds or more")
+    parser_status.add_argument("--max-uptime", type=float,
+                               help="only instances stopped or running at "
+                                    "most this many seconds")
+    parser_status.add_argument("--sort", default="id",
+                               choices=("id", "name", "state"))
+    parser_status.add_argument("--chunk", type=int, default=500,
+                               help="rows per request")
+    parser_status.add_argument("--since", type=int, metavar="VERSION",
+                               help="only instances changed after this "
+                                    "table version, 0 for all")
+    parser_status.set_defaults(handler=status)
+    for action, done in (("start", "started"), ("stop", "stopping"),
+                         ("restart", "restarting")):
+        parser_action = commands.add_parser(
+            action, help="%s instances: all, group:<group>, <program>, "
+                         "<program>:* or <program>:<instance>" % action)
+        parser_action.add_argument("targets", nargs="+")
+        parser_action.set_defaults(handler=control(action, done))
+    parser_rolling = commands.add_parser(
+        "rolling-restart", help="restart instances a batch at a time")
+    parser_rolling.add_argument("targets", nargs="+")
+    parser_rolling.add_argument("-b", "--batch", type=int, default=1,
+                                help="instances per batch")
+    parser_rolling.add_argument("-w", "--wait-running", action="store_true",
+                                help="wait for each batch to pass its "
+                                     "starttime before the next one")
+    parser_rolling.add_argument("-t", "--timeout", type=float,
+                                help="seconds a batch may take, by default "
+                                     "stoptime + starttime + 10")
+    parser_rolling.set_defaults(handler=rollingRestart)
+    parser_stats = commands.add_parser("stats")
+    parser_stats.add_argument("program", nargs="?")
+    parser_stats.add_argument("--reset", action="store_true",
+                              help="clear the histograms after reading them")
+    parser_stats.set_defaults(handler=stats)
+    parser_profile = commands.add_parser(
+        "profile", help="sample taskmasterd stacks, collapsed for flamegraphs")
+    parser_profile.add_argument("-d", "--seconds", type=float, default=10)
+    parser_profile.add_argument("-i", "--interval", type=float, default=10,
+                                help="sampling interval in ms of CPU time")
+    parser_profile.add_argument("-o", "--output")
+    parser_profile.set_defaults(handler=profile)
+    parser_events = commands.add_parser(
+        "events", help="stream events until interrupted")
+    parser_events.add_argument("-p", "--program", action="append",
+                               help="program name or glob, repeatable")
+    parser_events.add_argument("-e", "--event", action="append",
+                               help="event type such as PROCESS_STATE_FATAL, "
+                                    "repeatable")
+    parser_events.add_argument("-i", "--instances",
+                               help="instance or range, e.g. 0-9")
+    parser_events.set_defaults(handler=events)
+    parser_history = commands.add_parser(
+        "history", help="state changes of a program from the journal")
+    parser_history.add_argument("program")
+    parser_history.add_argument("-n", "--limit", type=int, default=50,
+                                help="number of changes, 0 for all")
+    parser_history.set_defaults(handler=history)
+    return parser, commands
+
+
+def parseArguments(argv: typing.List[str]):
+    parser, _ = buildParser()
+    return parser.parse_args(argv)
 
 
-def signal_handler(signal: int, frame :FrameType):
-    print("Process Done")
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+    options = parseArguments(sys.argv[1:] if argv is None else argv)
+    controller = Controller(options)
+    try:
+        if options.file not in (None, "-"):
+            with open(options.file) as lines:
+                return Batch(controller, buildParser()[0], lines).run()
+        if options.file == "-" or (options.command is None
+                                   and not sys.stdin.isatty()):
+            return Batch(controller, buildParser()[0], sys.stdin).run()
+        if options.command is None:
+            parser, commands = buildParser()
+            return Shell(controller, parser, commands).loop()
+        return options.handler(controller, options)
+    except (ControlError, OSError) as e:
+        print("taskmasterctl: %s" % e, file=sys.stderr)
+        return 1
+    finally:
+        controller.close()
 
-def main():
-    signal.signal(signal.SIGINT, signal_handler)
-    while 1:
-        print("1")
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
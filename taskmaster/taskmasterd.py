@@ -1,20 +1,621 @@
-import subprocess
-# from subprocess import Popen, PIPE
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import signal
+import sys
 import time
-from classes import Config
+from typing import Callable, Dict, List, Optional, Set
 
+import linux
+import state
+from classes import Config, ConfigError, ConfigYAML
+from control import ControlServer
+from events import (ConfigLoadedEvent, EventBus, ProcessStateEvent,
+                    SupervisorRunningEvent, SupervisorStoppingEvent)
+from exporter import MetricsExporter
+from journal import Journal
+from listener import ListenerPool
+from names import NameTable
+from metrics import Metrics
+from output import LogFile, MergedLog, OutputChannel
+from process import (STATE_NAMES, STOPPED_STATES, Process, ProcessStates,
+                     parse_signal)
+from sampler import ProcSampler
+from scheduler import StartScheduler
+from tracing import RingFileTracer, Tracer
+from tracker import CgroupTracker, ProcessGroupTracker
 
-def startProcess() -> None:
-    while 1:
-        subprocess.Popen(["ls", "-la"])
-        time.sleep(0.5)
+logger = logging.getLogger("taskmasterd")
+
+SAMPLE_BATCH = 256
+
+
+class Supervisor:
+    def __init__(self, config: ConfigYAML):
+        self.config = config
+        self.selector = selectors.DefaultSelector()
+        self.timers: List[list] = []
+        self.sequence = itertools.count()
+        self.logs: Dict[str, LogFile] = {}
+        self.dirty_logs: List[MergedLog] = []
+        self.channels: Dict[int, OutputChannel] = {}
+        self.pids: Dict[int, Process] = {}
+        self.names = NameTable(config)
+        # The process table is indexed by process id; names map instance
+        # names to process ids
+        self.table: List[Process] = []
+        # Process ids in each state, kept up to date by change_state()
+        self.by_state: Dict[int, Set[int]] = {
+            code: set() for code in STATE_NAMES}
+        self.by_state[ProcessStates.STOPPED].update(
+            range(len(self.names.processes)))
+        # The table version grows with every change of an instance, and
+        # changed maps process ids to the version of their last change,
+        # oldest first, so that changes since a version are found without
+        # scanning the table. Everything counts as changed at version 1.
+        self.version = 1
+        self.changed: Dict[int, int] = dict.fromkeys(
+            range(len(self.names.processes)), 1)
+        self.stopping = False
+        # Programs not told to stop yet at shutdown, and for each program
+        # those that must have stopped before it, see shutdown()
+        self.stop_pending: Set[int] = set()
+        self.stop_after: List[List[int]] = []
+        self.stopped_programs = bytearray(len(self.names.programs))
+        self.dirty = False
+        self.tracker = self.make_tracker()
+        self.sampler = ProcSampler()
+        self.control = None
+        self.exporter = None
+        self.metrics = Metrics()
+        self.events = EventBus()
+        self.tracer = Tracer()
+        self.ring = None
+        self.journal = None
+        self.pools: List[Optional[ListenerPool]] = [
+            ListenerPool(self, program, program_config)
+            if program_config.events else None
+            for program, program_config in config.programs.items()]
+        self.woke = 0.0
+        self.profiler = None
+        self.signals = None
+        self.wakeup = None
+        self.handlers = {}
+        for process_id, (program_id, _) in enumerate(self.names.processes):
+            program = self.names.programs[program_id]
+            process = Process(self, process_id, config.programs[program])
+            self.table.append(process)
+            self.metrics.transition(program, None, "STOPPED")
+
+    def make_tracker(self) -> ProcessGroupTracker:
+        root = self.config.taskmasterd.cgroup
+        if root:
+            if CgroupTracker.usable(root):
+                try:
+                    return CgroupTracker(self, root)
+                except OSError as e:
+                    logger.warning("cannot use cgroup %s: %s", root, e)
+            else:
+                logger.warning("cgroup %s is not delegated to us, falling "
+                               "back to process group tracking", root)
+        return ProcessGroupTracker(self)
+
+    def touch(self, process: Process) -> None:
+        # The state or pid of the instance changed: so did the snapshot
+        self.dirty = True
+        self.version += 1
+        self.changed.pop(process.id, None)
+        self.changed[process.id] = self.version
+
+    def changed_since(self, version: int) -> List[int]:
+        process_ids = []
+        for process_id in reversed(self.changed):
+            if self.changed[process_id] <= version:
+                break
+            process_ids.append(process_id)
+        return process_ids
+
+    def call_later(self, delay: float, callback: Callable) -> list:
+        timer = [time.monotonic() + delay, next(self.sequence), callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer: list) -> None:
+        timer[2] = None
+
+    def run_timers(self) -> None:
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            callback = heapq.heappop(self.timers)[2]
+            if callback is not None:
+                callback()
+
+    def open_log(self, path: str, merged: bool = False) -> LogFile:
+        log = self.logs.get(path)
+        if log is None:
+            if merged:
+                log = MergedLog(path, self.dirty_logs)
+            else:
+                log = LogFile(path)
+            self.logs[path] = log
+        return log
+
+    def flush_logs(self) -> None:
+        for log in self.dirty_logs:
+            log.flush()
+        self.dirty_logs.clear()
+
+    def add_channel(self, channel: OutputChannel) -> None:
+        self.channels[channel.fd] = channel
+        self.selector.register(channel.fd, selectors.EVENT_READ,
+                               lambda mask: self.read_channel(channel))
+
+    def read_channel(self, channel: OutputChannel) -> None:
+        if not channel.read():
+            self.remove_channel(channel)
+
+    def remove_channel(self, channel: OutputChannel) -> None:
+        del self.channels[channel.fd]
+        self.selector.unregister(channel.fd)
+        channel.close()
+
+    def drain(self) -> None:
+        for channel in list(self.channels.values()):
+            channel.blocked = False
+            while not channel.blocked:
+                if not channel.read():
+                    self.remove_channel(channel)
+                    break
+        self.flush_logs()
+
+    def watch(self, process: Process) -> None:
+        fd = linux.pidfd_open(process.pid)
+        if fd is None:
+            self.call_later(1, lambda: self.poll_watched(process, process.pid))
+            return
+        process.pidfd = fd
+        self.selector.register(fd, selectors.EVENT_READ,
+                               lambda mask: process.exited(None))
+
+    def unwatch(self, process: Process) -> None:
+        if process.pidfd is not None:
+            self.selector.unregister(process.pidfd)
+            os.close(process.pidfd)
+            process.pidfd = None
+
+    def poll_watched(self, process: Process, pid: int) -> None:
+        if process.pid != pid:
+            return
+        if linux.start_time(pid) != process.proc_start:
+            process.exited(None)
+        else:
+            self.call_later(1, lambda: self.poll_watched(process, pid))
+
+    def snapshot(self) -> None:
+        path = self.config.taskmasterd.statefile
+        if path and self.dirty:
+            self.dirty = False
+            try:
+                state.write_snapshot(path, self.table)
+            except OSError as e:
+                logger.error("cannot write state snapshot %s: %s", path, e)
+
+    def snapshot_tick(self) -> None:
+        self.snapshot()
+        self.call_later(self.config.taskmasterd.snapshotinterval,
+                        self.snapshot_tick)
+
+    def adopt(self) -> None:
+        path = self.config.taskmasterd.statefile
+        data = path and state.read_snapshot(path)
+        if not data:
+            return
+        inherited = data["daemon"] == os.getpid()
+        for program, instance, pid, proc_start, status, fds in \
+                data["processes"]:
+            process_id = self.names.process_id(program, instance)
+            process = None if process_id is None else self.table[process_id]
+            if not inherited:
+                fds = []
+            if (process is None or not proc_start
+                    or linux.start_time(pid) != proc_start):
+                for fd in fds:
+                    if fd >= 0:
+                        os.close(fd)
+                continue
+            if self.pools[process.program_id] is not None:
+                # The pipes an event listener talks over do not survive us:
+                # replace it with a fresh instance
+                logger.info("%s: stopping event listener pid %d",
+                            process.name, pid)
+                for fd in fds:
+                    if fd >= 0:
+                        os.close(fd)
+                try:
+                    os.kill(pid, parse_signal(process.config.stopsignal))
+                except OSError:
+                    pass
+                continue
+            logger.info("%s: adopting pid %d", process.name, pid)
+            process.adopt(pid, proc_start, status, fds)
+        # Children that exited while we were exec'ing sent SIGCHLD to the
+        # old image
+        self.reap()
+
+    def upgrade(self) -> None:
+        if not self.config.taskmasterd.statefile:
+            logger.warning("no statefile configured, cannot re-exec")
+            return
+        self.drain()
+        self.flush_logs()
+        self.dirty = True
+        self.snapshot()
+        # The journal fd does not survive the exec: write out what is
+        # buffered and checkpoint the heads
+        self.close_journal()
+        for process in self.table:
+            for channel in process.channels:
+                if channel is not None and channel.fd >= 0:
+                    os.set_inheritable(channel.fd, True)
+        logger.info("re-executing taskmasterd")
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def install_signals(self) -> None:
+        read, write = os.pipe()
+        os.set_blocking(read, False)
+        os.set_blocking(write, False)
+        signal.set_wakeup_fd(write)
+        self.wakeup = write
+        for sig in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT,
+                    signal.SIGHUP, signal.SIGUSR2):
+            self.handlers[sig] = signal.signal(sig, lambda signum, frame: None)
+        self.signals = read
+        self.selector.register(read, selectors.EVENT_READ, self.read_signals)
+
+    def read_signals(self, mask: int) -> None:
+        try:
+            received = os.read(self.signals, 4096)
+        except BlockingIOError:
+            return
+        for signum in set(received):
+            if signum == signal.SIGCHLD:
+                self.reap(self.woke)
+            elif signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                logger.info("received %s, shutting down",
+                            signal.Signals(signum).name)
+                self.shutdown()
+            elif signum == signal.SIGUSR2:
+                self.upgrade()
+
+    def reap(self, woke: float = None) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            process = self.pids.get(pid)
+            if process is not None:
+                if woke is not None:
+                    self.metrics.reap_seconds.labels(process.program).observe(
+                        time.monotonic() - woke)
+                process.exited(status)
+            else:
+                self.tracker.forget(pid)
+
+    def open_journal(self, path: str) -> None:
+        try:
+            self.journal = Journal(path)
+        except (OSError, ValueError) as e:
+            logger.error("cannot open journal %s: %s", path, e)
+            return
+        self.journal.bind(self.names.programs)
+        self.events.subscribe(ProcessStateEvent, self.journal.record)
+        self.journal_tick()
+
+    def journal_command(self, command: str, processes: List) -> None:
+        # Operator commands go to the journal along with the state changes
+        # they cause
+        if self.journal is None:
+            return
+        for process in processes:
+            self.journal.command(process.program_id, process.instance,
+                                 command)
+
+    def close_journal(self) -> None:
+        if self.journal is None:
+            return
+        self.events.unsubscribe(self.journal.record)
+        try:
+            self.journal.close()
+        except OSError as e:
+            logger.error("cannot write journal: %s", e)
+        self.journal = None
+
+    def journal_tick(self) -> None:
+        if self.journal is None:
+            return
+        try:
+            self.journal.sync()
+        except OSError as e:
+            logger.error("cannot write journal: %s", e)
+        self.call_later(self.config.taskmasterd.journalsync,
+                        self.journal_tick)
+
+    def start(self) -> None:
+        if self.journal is None and self.config.taskmasterd.journal:
+            self.open_journal(self.config.taskmasterd.journal)
+        self.events.publish(ConfigLoadedEvent(list(self.config.programs)))
+        self.adopt()
+        programs = self.config.programs
+        StartScheduler(self, [
+            program_id for program_id, name in enumerate(self.names.programs)
+            if programs[name].autostart]).start()
+        if self.config.taskmasterd.statefile:
+            self.snapshot_tick()
+        if self.config.taskmasterd.trackinterval:
+            self.track_tick()
+        if self.config.taskmasterd.sampleinterval:
+            self.sample_tick()
+        self.events.publish(SupervisorRunningEvent(os.getpid()))
+
+    def sampled_pids(self, processes=None) -> List[int]:
+        pids = []
+        for process in self.pids.values() if processes is None else processes:
+            if process.pid and not self.tracker.accounts(process):
+                pids.append(process.pid)
+                pids.extend(process.members)
+        return pids
+
+    def sample(self, processes=None) -> None:
+        self.sampler.sample(self.sampled_pids(processes))
+
+    def sample_tick(self) -> None:
+        self.call_later(self.config.taskmasterd.sampleinterval,
+                        self.sample_tick)
+        if not self.sampler.pending:
+            self.sampler.begin(self.sampled_pids())
+            self.sample_step()
+
+    def sample_step(self) -> None:
+        # Bounded slices keep a cycle over thousands of pids from stalling
+        # the event loop
+        if self.sampler.step(SAMPLE_BATCH):
+            self.call_later(0, self.sample_step)
+
+    def listen(self, path: str) -> None:
+        self.control = ControlServer(self, path)
+
+    def serve_metrics(self, endpoint: str) -> None:
+        self.exporter = MetricsExporter(self, endpoint)
+
+    def track_tick(self) -> None:
+        if self.pids:
+            self.tracker.scan()
+        self.call_later(self.config.taskmasterd.trackinterval, self.track_tick)
+
+    def shutdown(self) -> None:
+        if self.stopping:
+            # Asked again: do not wait for stoptimes
+            logger.warning("killing instances still stopping")
+            self.stop_pending.clear()
+            self.stop_processes(self.table)
+            for process_id in list(self.by_state[ProcessStates.STOPPING]):
+                self.table[process_id].kill()
+            return
+        self.events.publish(SupervisorStoppingEvent(os.getpid()))
+        self.stopping = True
+        # Output keeps being read meanwhile, so that instances blocked on a
+        # full pipe can still exit. With dependencies, a program stops as
+        # soon as the programs depending on it stopped. Without, programs
+        # stop by descending priority, a priority once all higher ones
+        # stopped; mixing both orders could deadlock.
+        names = self.names
+        if any(names.depends):
+            self.stop_after = names.dependents
+        else:
+            bands: Dict[int, List[int]] = {}
+            for program_id, program in enumerate(names.programs):
+                bands.setdefault(self.config.programs[program].priority,
+                                 []).append(program_id)
+            self.stop_after = [[] for _ in names.programs]
+            priorities = sorted(bands, reverse=True)
+            for higher, lower in zip(priorities, priorities[1:]):
+                for program_id in bands[lower]:
+                    self.stop_after[program_id] = bands[higher]
+        self.stop_pending = set(range(len(names.programs)))
+        # Nothing waiting for its turn may respawn from BACKOFF meanwhile
+        self.stop_processes([self.table[process_id] for process_id in
+                             list(self.by_state[ProcessStates.BACKOFF])])
+        self.shutdown_step()
+
+    def program_stopped(self, program_id: int) -> bool:
+        # Nothing starts or respawns once shutting down, see
+        # Process.backoff(), so this stays true once true
+        if self.stopped_programs[program_id]:
+            return True
+        if program_id in self.stop_pending or any(
+                self.table[process_id].state not in STOPPED_STATES
+                for process_id in self.names.instances(program_id)):
+            return False
+        self.stopped_programs[program_id] = 1
+        return True
+
+    def shutdown_step(self) -> None:
+        programs = self.config.programs
+        names = self.names
+        while self.stop_pending:
+            ready = [program_id for program_id in self.stop_pending
+                     if all(self.program_stopped(other)
+                            for other in self.stop_after[program_id])]
+            if not ready:
+                return
+            # Whatever may stop now stops as one operation
+            ready.sort(key=lambda program_id: (
+                -programs[names.programs[program_id]].priority, program_id))
+            self.stop_pending.difference_update(ready)
+            self.stop_processes([
+                self.table[process_id] for program_id in ready
+                for process_id in names.instances(program_id)])
+
+    def start_processes(self, processes: List[Process]) -> List[Process]:
+        for process in processes:
+            process.restarting = False
+        return [process for process in processes if process.start()]
+
+    def stop_processes(self, processes: List[Process]) -> List[Process]:
+        # Every stop signal goes out in one pass, to the process group of
+        # each instance. A single timer then walks the distinct stoptimes
+        # in order and sends SIGKILL to whatever is still stopping, so that
+        # stopping everything takes max(stoptime), not the sum.
+        stopped = []
+        deadlines: Dict[float, List[tuple]] = {}
+        for process in processes:
+            process.restarting = False
+            if process.stop(escalate=False):
+                stopped.append(process)
+                if process.state == ProcessStates.STOPPING:
+                    deadlines.setdefault(process.config.stoptime or 0,
+                                         []).append(
+                        (process, process.stop_time))
+        if deadlines:
+            started = time.monotonic()
+            self.escalate(started, sorted(deadlines.items(), reverse=True))
+        return stopped
+
+    def escalate(self, started: float, deadlines: List[tuple]) -> None:
+        # deadlines holds (stoptime, [(process, stop_time)]), latest first
+        now = time.monotonic()
+        while deadlines and started + deadlines[-1][0] <= now:
+            for process, stop_time in deadlines.pop()[1]:
+                # Unless it was stopped again since
+                if process.stop_time == stop_time:
+                    process.kill()
+        if deadlines:
+            self.call_later(started + deadlines[-1][0] - now,
+                            lambda: self.escalate(started, deadlines))
+
+    def restart_processes(self, processes: List[Process]) -> List[Process]:
+        # Running instances are stopped and start again once stopped, the
+        # others start right away
+        running = [process for process in processes
+                   if process.state in (ProcessStates.STARTING,
+                                        ProcessStates.RUNNING,
+                                        ProcessStates.STOPPING)]
+        self.stop_processes(running)
+        for process in running:
+            if process.state == ProcessStates.STOPPING:
+                process.restarting = True
+        self.start_processes([process for process in processes
+                              if process.state != ProcessStates.STOPPING])
+        return processes
+
+    def finished(self) -> bool:
+        return self.stopping and sum(
+            len(self.by_state[state])
+            for state in STOPPED_STATES) == len(self.table)
+
+    def tick(self, timeout: float = None) -> None:
+        if self.timers:
+            delay = max(0.0, self.timers[0][0] - time.monotonic())
+            timeout = delay if timeout is None else min(timeout, delay)
+        events = self.selector.select(timeout)
+        self.woke = time.monotonic()
+        for key, mask in events:
+            key.data(mask)
+        self.run_timers()
+        if self.stop_pending:
+            self.shutdown_step()
+        self.flush_logs()
+        if self.control is not None and self.control.dirty:
+            self.control.flush_streams()
+
+    def attach_tracers(self) -> None:
+        daemon = self.config.taskmasterd
+        if daemon.tracefile and self.ring is None:
+            try:
+                self.ring = RingFileTracer(daemon.tracefile)
+            except OSError as e:
+                logger.error("cannot open trace file %s: %s",
+                             daemon.tracefile, e)
+            else:
+                self.tracer.register(self.ring)
+        for spec in daemon.tracers:
+            try:
+                self.tracer.load(spec, self)
+            except Exception as e:
+                logger.error("cannot load tracer %s: %s", spec, e)
+
+    def run(self) -> None:
+        if not linux.set_subreaper():
+            logger.warning("cannot become a child subreaper")
+        if self.signals is None:
+            self.install_signals()
+        if self.control is None:
+            self.listen(self.config.taskmasterd.socket)
+        if self.exporter is None and self.config.taskmasterd.metrics:
+            self.serve_metrics(self.config.taskmasterd.metrics)
+        self.attach_tracers()
+        self.start()
+        while not self.finished():
+            self.tick()
+        self.close()
+
+    def close(self) -> None:
+        self.drain()
+        for channel in list(self.channels.values()):
+            self.remove_channel(channel)
+        for log in self.logs.values():
+            log.close()
+        self.snapshot()
+        for pool in self.pools:
+            if pool is not None:
+                pool.close()
+        self.close_journal()
+        self.tracker.close()
+        self.sampler.clear()
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+        if self.ring is not None:
+            self.tracer.unregister(self.ring)
+            self.ring.close()
+            self.ring = None
+        if self.signals is not None:
+            signal.set_wakeup_fd(-1)
+            for sig, handler in self.handlers.items():
+                signal.signal(sig, handler)
+            self.selector.unregister(self.signals)
+            os.close(self.signals)
+            os.close(self.wakeup)
+            self.signals = self.wakeup = None
+        self.selector.close()
 
 
 def main():
-    # path = searchFilePath('.')
-    config = Config(path="./foo.yml")
-    print(config.config)
-    # startProcess(config)
+    parser = argparse.ArgumentParser(prog="taskmasterd")
+    parser.add_argument("-c", "--config", default="./foo.yml")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        config = Config(path=args.config)
+    except ConfigError as e:
+        print("taskmasterd: invalid config %s:\n%s" % (args.config, e),
+              file=sys.stderr)
+        sys.exit(1)
+    Supervisor(config.config).run()
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import importlib
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Callable, Iterator, List, Tuple
+
+logger = logging.getLogger("taskmasterd")
+
+SPAWN = 0
+STARTED = 1
+EXITED = 2
+BACKOFF = 3
+FATAL = 4
+STOP_REQUESTED = 5
+KILLED = 6
+COMMAND = 7
+
+POINT_NAMES = ("spawn", "started", "exited", "backoff", "fatal",
+               "stop_requested", "killed", "command")
+
+
+class Tracer:
+    # One list of hooks per trace point, exposed as attributes so the hot
+    # paths only pay for an attribute load and a truth test:
+    #     if tracer.spawn:
+    #         tracer.emit(tracing.SPAWN, ...)
+    # Nothing is allocated or called while a point has no hook.
+    def __init__(self):
+        self.points: List[List[Callable]] = [[] for _ in POINT_NAMES]
+        for name, hooks in zip(POINT_NAMES, self.points):
+            setattr(self, name, hooks)
+
+    def register(self, hook: Callable, points=None) -> None:
+        for point in range(len(POINT_NAMES)) if points is None else points:
+            self.points[point].append(hook)
+
+    def unregister(self, hook: Callable) -> None:
+        for hooks in self.points:
+            while hook in hooks:
+                hooks.remove(hook)
+
+    def emit(self, point: int, name: str, instance: int, pid: int,
+             detail: int) -> None:
+        now = time.monotonic_ns()
+        # Hooks run inside the state machine: one that fails must not leave
+        # an instance half way through a transition
+        for hook in list(self.points[point]):
+            try:
+                hook(point, now, name, instance, pid, detail)
+            except Exception:
+                logger.exception("trace hook %r failed on %s", hook,
+                                 POINT_NAMES[point])
+
+    def load(self, spec: str, supervisor) -> None:
+        # "package.module:factory": factory(supervisor, tracer) registers
+        # its own hooks
+        module, _, attribute = spec.partition(":")
+        factory = getattr(importlib.import_module(module), attribute)
+        factory(supervisor, self)
+
+
+HEADER = struct.Struct("<8sIIQ")
+RECORD = struct.Struct("<qBxxxiii24s")
+MAGIC = b"TMTRACE1"
+
+
+class RingFileTracer:
+    # Fixed-size records in a memory-mapped ring: a hook is one pack_into
+    # and one header update, with no syscall
+    def __init__(self, path: str, capacity: int = 65536):
+        self.capacity = capacity
+        size = HEADER.size + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, capacity, 0)
+        self.count = 0
+
+    def __call__(self, point: int, now: int, name: str, instance: int,
+                 pid: int, detail: int) -> None:
+        RECORD.pack_into(self.map,
+                         HEADER.size + (self.count % self.capacity)
+                         * RECORD.size,
+                         now, point, pid, instance, detail, name.encode())
+        self.count += 1
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, self.capacity,
+                         self.count)
+
+    def close(self) -> None:
+        self.map.flush()
+        self.map.close()
+
+
+def read_ring(path: str) -> Iterator[Tuple[int, str, str, int, int, int]]:
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, record_size, capacity, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("%s is not a taskmaster trace ring" % path)
+    for sequence in range(max(0, count - capacity), count):
+        now, point, pid, instance, detail, name = RECORD.unpack_from(
+            data, HEADER.size + (sequence % capacity) * RECORD.size)
+        yield (now, POINT_NAMES[point], name.rstrip(b"\0").decode(),
+               instance, pid, detail)
@@ -0,0 +1,333 @@
+import logging
+import os
+import signal
+import time
+from typing import Dict, List, Optional, Tuple
+
+import linux
+from process import Process
+from sampler import count_fds
+
+logger = logging.getLogger("taskmasterd")
+
+
+class ProcessGroupTracker:
+    # Every instance is spawned as the leader of its own session and process
+    # group. Descendants are attributed to an instance by process group, by
+    # session, or by walking their parents up to a known member, so workers
+    # of a program that forks and daemonizes stay under its control.
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.daemon = os.getpid()
+        self.owners: Dict[int, Tuple[Process, int]] = {}
+
+    def accounts(self, process: Process) -> bool:
+        # Whether resources() knows the usage of the instance
+        return False
+
+    def resources(self, process: Process) -> Optional[Dict]:
+        # Resources of an instance and its members, None when they have to
+        # be sampled from /proc
+        return None
+
+    def groups(self) -> Dict[int, Process]:
+        return {process.pgid: process
+                for process in self.supervisor.pids.values() if process.pgid}
+
+    def scan(self, exiting: Optional[Process] = None) -> None:
+        self.daemon = os.getpid()
+        table = linux.processes()
+        groups = self.groups()
+        if exiting is not None and exiting.pgid:
+            groups[exiting.pgid] = exiting
+        owners: Dict[int, Optional[Process]] = {}
+        for process in self.supervisor.pids.values():
+            process.members = {}
+        if exiting is not None:
+            exiting.members = {}
+        for pid, fields in table.items():
+            if fields[0] == b"Z" or pid in self.supervisor.pids:
+                continue
+            process = self.owner(pid, table, groups, owners, exiting)
+            if process is not None:
+                process.members[pid] = int(fields[2])
+        self.owners = {
+            pid: (process, int(table[pid][19]))
+            for pid, process in owners.items()
+            if process is not None and pid in process.members
+        }
+
+    def owner(self, pid: int, table: Dict[int, List[bytes]],
+              groups: Dict[int, Process], owners: Dict[int, Optional[Process]],
+              exiting: Optional[Process]) -> Optional[Process]:
+        chain = []
+        found = None
+        while pid > 1 and pid != self.daemon:
+            if pid in owners:
+                found = owners[pid]
+                break
+            found = self.supervisor.pids.get(pid)
+            fields = table.get(pid)
+            if found is not None or fields is None:
+                break
+            chain.append(pid)
+            found = groups.get(int(fields[2])) or groups.get(int(fields[3]))
+            if found is None and pid in self.owners:
+                process, started = self.owners[pid]
+                if started == int(fields[19]):
+                    found = process
+            if found is not None:
+                break
+            pid = int(fields[1])
+            if pid == self.daemon and exiting is not None:
+                # Reparented to us before we ever saw it: it can only come
+                # from the leader that just exited
+                if exiting.proc_start <= int(fields[19]):
+                    found = exiting
+                break
+        for pid in chain:
+            owners[pid] = found
+        return found
+
+    def leftovers(self, process: Process) -> bool:
+        # Whether a leader that just exited may have left something behind:
+        # a live process group, a member seen by the last scan that is still
+        # the same process, or a child reparented to us that no instance
+        # accounts for. Most exits leave nothing and skip the /proc walk.
+        if process.pgid:
+            try:
+                os.killpg(process.pgid, 0)
+                return True
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                return True
+        for pid in process.members:
+            owner = self.owners.get(pid)
+            started = linux.start_time(pid)
+            if started and (owner is None or owner[1] == started):
+                return True
+        children = linux.children()
+        if children is None:
+            return True
+        return any(pid not in self.supervisor.pids for pid in children)
+
+    def survivor(self, process: Process) -> Optional[Tuple[int, int]]:
+        if not self.leftovers(process):
+            process.members = {}
+            return None
+        self.scan(exiting=process)
+        if not process.members:
+            return None
+        return min((self.owners[pid][1], pid) for pid in process.members
+                   if pid in self.owners)[::-1]
+
+    def preexec(self, process: Process):
+        return None
+
+    def forget(self, pid: int) -> None:
+        owner = self.owners.pop(pid, None)
+        if owner is not None:
+            owner[0].members.pop(pid, None)
+
+    def signal(self, process: Process, sig: int) -> None:
+        if process.pgid:
+            try:
+                os.killpg(process.pgid, sig)
+            except ProcessLookupError:
+                pass
+        targets = [pid for pid, pgrp in process.members.items()
+                   if pgrp != process.pgid]
+        if process.pid and process.pid != process.pgid:
+            targets.append(process.pid)
+        for pid in targets:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def close(self) -> None:
+        pass
+
+
+class CgroupTracker(ProcessGroupTracker):
+    # Used when a cgroup v2 subtree is delegated to taskmasterd: every
+    # instance runs in <root>/<program>/<instance>, so its members are simply
+    # the content of cgroup.procs and a SIGKILL is one write to cgroup.kill
+    CONTROLLERS = ("cpu", "memory", "io", "pids")
+    LEAF = "_taskmasterd"
+
+    def __init__(self, supervisor, root: str):
+        super().__init__(supervisor)
+        self.root = root
+        self.paths: Dict[str, str] = {}
+        # Time and usage_usec of the last read of each cgroup
+        self.cpu: Dict[str, Tuple[float, int]] = {}
+        if os.getpid() in self.read_pids(root):
+            # A cgroup with controllers enabled for its children cannot
+            # hold processes itself
+            leaf = os.path.join(root, self.LEAF)
+            os.makedirs(leaf, exist_ok=True)
+            self.write(os.path.join(leaf, "cgroup.procs"), "0")
+        self.enable(root)
+
+    @staticmethod
+    def usable(root: str) -> bool:
+        return (os.path.isfile(os.path.join(root, "cgroup.procs"))
+                and os.access(root, os.W_OK))
+
+    @staticmethod
+    def write(path: str, value: str) -> None:
+        with open(path, "w") as f:
+            f.write(value)
+
+    @staticmethod
+    def read_pids(path: str) -> List[int]:
+        try:
+            with open(os.path.join(path, "cgroup.procs"), "rb") as f:
+                return [int(pid) for pid in f.read().split()]
+        except OSError:
+            return []
+
+    def enable(self, path: str) -> None:
+        try:
+            with open(os.path.join(path, "cgroup.controllers")) as f:
+                available = f.read().split()
+            wanted = ["+" + name for name in self.CONTROLLERS
+                      if name in available]
+            if wanted:
+                self.write(os.path.join(path, "cgroup.subtree_control"),
+                           " ".join(wanted))
+        except OSError as e:
+            logger.warning("cannot enable cgroup controllers in %s: %s",
+                           path, e)
+
+    def program_path(self, program: str) -> str:
+        path = os.path.join(self.root, program)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+            self.enable(path)
+        return path
+
+    def path(self, process: Process) -> str:
+        path = self.paths.get(process.name)
+        if path is None:
+            path = os.path.join(self.program_path(process.program),
+                                str(process.instance))
+            os.makedirs(path, exist_ok=True)
+            self.paths[process.name] = path
+        return path
+
+    def preexec(self, process: Process):
+        procs = os.path.join(self.path(process), "cgroup.procs")
+        return lambda: self.write(procs, "0")
+
+    def scan(self, exiting: Optional[Process] = None) -> None:
+        for process in list(self.supervisor.pids.values()) + [exiting]:
+            if process is not None:
+                process.members = {
+                    pid: 0 for pid in self.read_pids(self.path(process))
+                    if pid != process.pid}
+
+    def survivor(self, process: Process) -> Optional[Tuple[int, int]]:
+        # Only the cgroup of this instance, not every instance's
+        process.members = {
+            pid: 0 for pid in self.read_pids(self.path(process))
+            if pid != process.pid}
+        started = [(linux.start_time(pid), pid) for pid in process.members]
+        started = [entry for entry in started if entry[0]]
+        if not started:
+            return None
+        return min(started)[::-1]
+
+    def signal(self, process: Process, sig: int) -> None:
+        path = self.path(process)
+        pids = self.read_pids(path)
+        if not pids or (process.pid and process.pid not in pids):
+            # Adopted from a daemon that did not use this cgroup
+            return super().signal(process, sig)
+        if sig == signal.SIGKILL:
+            try:
+                self.write(os.path.join(path, "cgroup.kill"), "1")
+                return
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def usage(self, path: str) -> Dict[str, int]:
+        usage = {}
+        try:
+            with open(os.path.join(path, "cpu.stat"), "rb") as f:
+                for line in f:
+                    key, value = line.split()
+                    if key in (b"usage_usec", b"user_usec", b"system_usec"):
+                        usage[key.decode()] = int(value)
+        except (OSError, ValueError):
+            pass
+        for name, key in (("memory.current", "memory_bytes"),
+                          ("pids.current", "tasks")):
+            try:
+                with open(os.path.join(path, name), "rb") as f:
+                    usage[key] = int(f.read())
+            except (OSError, ValueError):
+                pass
+        try:
+            with open(os.path.join(path, "io.stat"), "rb") as f:
+                read = written = 0
+                for line in f:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition(b"=")
+                        if key == b"rbytes":
+                            read += int(value)
+                        elif key == b"wbytes":
+                            written += int(value)
+                usage["io_read_bytes"] = read
+                usage["io_write_bytes"] = written
+        except (OSError, ValueError):
+            pass
+        return usage
+
+    def accounts(self, process: Process) -> bool:
+        # Not an instance adopted from a daemon that did not use this cgroup
+        return bool(process.pid) and process.pid in self.read_pids(
+            self.path(process))
+
+    def resources(self, process: Process) -> Optional[Dict]:
+        # From the accounting of the cgroup rather than from /proc: only the
+        # fd counts are per pid
+        if not process.pid:
+            return None
+        path = self.path(process)
+        pids = self.read_pids(path)
+        if process.pid not in pids:
+            return None
+        usage = self.usage(path)
+        cpu = 0.0
+        used = usage.get("usage_usec")
+        if used is not None:
+            now = time.monotonic()
+            previous = self.cpu.get(path)
+            if previous is not None and now > previous[0]:
+                cpu = (used - previous[1]) / 1e4 / (now - previous[0])
+            self.cpu[path] = (now, used)
+        return {
+            "cpu": round(cpu, 1),
+            "rss": usage.get("memory_bytes", 0),
+            "threads": usage.get("tasks", len(pids)),
+            "fds": sum(fds for fds in map(count_fds, pids) if fds > 0),
+            "processes": len(pids),
+        }
+
+    def close(self) -> None:
+        for path in self.paths.values():
+            for directory in (path, os.path.dirname(path)):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        self.paths.clear()
+        self.cpu.clear()
@@ -0,0 +1,51 @@
+import os
+import sys
+
+# The daemon modules import each other as top-level modules, the same way
+# they resolve when taskmasterd.py is run from the taskmaster directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "taskmaster"))
+
+import time  # noqa: E402
+
+import pytest  # noqa: E402
+
+from classes import ConfigYAML  # noqa: E402
+from taskmasterd import Supervisor  # noqa: E402
+
+
+@pytest.fixture
+def make_supervisor(tmp_path):
+    # A supervisor of one program that neither starts nor restarts on its
+    # own; keyword arguments override its config. programs maps the names
+    # of several programs to their overrides instead.
+    def make(name="daemon", taskmasterd=None, programs=None, groups=None,
+             **options):
+        defaults = {
+            "cmd": "sleep 30",
+            "umask": "022",
+            "workingdir": str(tmp_path),
+            "autostart": False,
+            "autorestart": False,
+            "startretries": 0,
+            "starttime": 0,
+        }
+        if programs is None:
+            programs = {name: options}
+        supervisor = Supervisor(ConfigYAML(
+            programs={program: dict(defaults, **overrides)
+                      for program, overrides in programs.items()},
+            groups=groups or {}, taskmasterd=taskmasterd or {}))
+        supervisor.install_signals()
+        return supervisor
+    return make
+
+
+@pytest.fixture
+def wait_for():
+    # Runs the event loop until predicate() holds
+    def wait(supervisor, predicate, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            assert time.monotonic() < deadline
+            supervisor.tick(0.05)
+    return wait
@@ -0,0 +1,77 @@
+import os
+import signal
+
+import pytest
+
+import linux
+from control import resources
+from process import ProcessStates
+from tracker import CgroupTracker, ProcessGroupTracker
+
+
+def cgroup2_mount():
+    with open("/proc/mounts") as f:
+        for line in f:
+            fields = line.split()
+            if fields[2] == "cgroup2":
+                return fields[1]
+    return None
+
+
+@pytest.fixture
+def cgroup_root():
+    mount = cgroup2_mount()
+    if mount is None:
+        pytest.skip("no cgroup v2 hierarchy")
+    root = os.path.join(mount, "taskmaster-test-%d" % os.getpid())
+    try:
+        os.mkdir(root)
+    except OSError:
+        pytest.skip("cgroup v2 hierarchy is not writable")
+    yield root
+    for path, dirs, files in os.walk(root, topdown=False):
+        os.rmdir(path)
+
+
+def web(make_supervisor, root, cmd):
+    return make_supervisor(name="web", cmd=cmd, numprocs=2, stopsignal="KILL",
+                           stoptime=5, taskmasterd={"cgroup": root,
+                                                    "trackinterval": 0})
+
+
+def test_falls_back_without_delegation(tmp_path, make_supervisor):
+    supervisor = web(make_supervisor, str(tmp_path / "missing"), "true")
+    assert type(supervisor.tracker) is ProcessGroupTracker
+    supervisor.close()
+
+
+def test_instances_get_their_own_cgroup(make_supervisor, wait_for,
+                                        cgroup_root):
+    supervisor = web(make_supervisor, cgroup_root,
+                     "sh -c 'setsid sleep 30 & sleep 30'")
+    assert isinstance(supervisor.tracker, CgroupTracker)
+    for process in supervisor.table:
+        process.start()
+    process = supervisor.table[supervisor.names.process_id("web", 1)]
+    path = os.path.join(cgroup_root, "web", "1")
+    wait_for(supervisor, lambda: len(CgroupTracker.read_pids(path)) >= 2)
+    pids = CgroupTracker.read_pids(path)
+    assert process.pid in pids
+    supervisor.tracker.scan()
+    assert set(process.members) == set(pids) - {process.pid}
+    usage = resources(supervisor, process)
+    assert usage["processes"] == len(pids) == usage["threads"]
+    assert supervisor.sampled_pids([process]) == []
+    supervisor.sample([process])
+    assert process.pid not in supervisor.sampler.samples
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    assert CgroupTracker.read_pids(path) == []
+    assert all(linux.proc_stat(pid) is None or linux.proc_stat(pid)[0] == b"Z"
+               for pid in pids)
+    other = supervisor.table[supervisor.names.process_id("web", 0)]
+    assert other.state != ProcessStates.STOPPED
+    other.signal(signal.SIGKILL)
+    wait_for(supervisor, lambda: not other.pid)
+    supervisor.close()
+    assert not os.path.exists(path)
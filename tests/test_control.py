@@ -0,0 +1,449 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from control import CommandError, columns, status
+from process import ProcessStates
+from journal import NO_EXIT_CODE
+from taskmasterctl import (Batch, Controller, Shell, buildParser,
+                           decodeColumns, formatEvent)
+
+
+# Instances start with the supervisor and die on their first signal
+SERVED = {"autostart": True, "autorestart": "unexpected", "stopsignal": "KILL"}
+
+
+@pytest.fixture
+def serve(tmp_path, make_supervisor):
+    # A supervisor of several programs, listening on tmp_path/sock
+    def make(programs, groups=None):
+        supervisor = make_supervisor(groups=groups, programs={
+            name: dict(SERVED, **options)
+            for name, options in programs.items()})
+        supervisor.listen(str(tmp_path / "sock"))
+        return supervisor
+    return make
+
+
+@pytest.fixture
+def connect(tmp_path, wait_for):
+    def make(supervisor):
+        return Client(supervisor, str(tmp_path / "sock"), wait_for)
+    return make
+
+
+class Client:
+    def __init__(self, supervisor, path, wait_for):
+        class Options:
+            socket = path
+
+        self.supervisor = supervisor
+        self.wait_for = wait_for
+        self.controller = Controller(Options)
+        self.controller.connect()
+
+    def send(self, request_id, cmd, args=None):
+        self.controller.sock.sendall(json.dumps(
+            {"id": request_id, "cmd": cmd, "args": args or {}}).encode()
+            + b"\n")
+
+    def receive(self, timeout=5):
+        controller = self.controller
+
+        def received():
+            try:
+                controller.buffer += controller.sock.recv(65536,
+                                                          socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                pass
+            return b"\n" in controller.buffer
+        self.wait_for(self.supervisor, received, timeout)
+        return controller.readMessage()
+
+
+def running(supervisor):
+    return len(supervisor.by_state[ProcessStates.RUNNING])
+
+
+def instance(supervisor, program, number):
+    return supervisor.table[supervisor.names.process_id(program, number)]
+
+
+def stop(supervisor, wait_for):
+    supervisor.shutdown()
+    wait_for(supervisor, supervisor.finished)
+    supervisor.close()
+
+
+def test_subscription_filters_and_coalesces(serve, connect, wait_for):
+    supervisor = serve({"web": {"numprocs": 4}, "db": {}})
+    client = connect(supervisor)
+    client.send(7, "subscribe", {"programs": ["w*"], "instances": [1, 2],
+                                 "events": ["PROCESS_STATE"]})
+    reply = client.receive()
+    assert reply["id"] == 7 and reply["ok"]
+    tables = reply["result"]
+    assert tables["events"] == ["PROCESS_STATE"]
+    assert tables["programs"] == ["web", "db"]
+    assert tables["processes"] == [[0, 0], [0, 1], [0, 2], [0, 3], [1, 0]]
+    supervisor.start()
+    received = [client.receive()["event"] for _ in range(2)]
+    assert sorted(event["process"] for event in received) == [1, 2]
+    for event in received:
+        assert event["event"] == "PROCESS_STATE_RUNNING"
+        assert event["program"] == 0
+        assert event["from_state"] == ProcessStates.STOPPED
+        assert event["count"] == 2
+    assert "(from STOPPED, 2 changes)" in formatEvent(received[0], tables)
+    client.send(8, "unsubscribe", {"subscription": 7})
+    assert client.receive() == {"id": 8, "ok": True, "result": True}
+    instance(supervisor, "web", 1).stop()
+    client.send(9, "stats", {"program": "db"})
+    assert client.receive()["id"] == 9
+    client.controller.close()
+    stop(supervisor, wait_for)
+
+
+def test_status_is_chunked_filtered_and_sorted(serve, wait_for):
+    supervisor = serve({"web": {"numprocs": 5}, "db": {}})
+    supervisor.start()
+    web = instance(supervisor, "web", 1)
+    web.stop()
+    wait_for(supervisor, lambda: web.state == ProcessStates.STOPPED)
+
+    def names(args):
+        args = dict(args, limit=2)
+        found = []
+        while True:
+            reply = status(supervisor, args)
+            assert len(reply["rows"]) <= 2
+            found += [row["name"] for row in reply["rows"]]
+            if reply["cursor"] is None:
+                return found
+            args["cursor"] = reply["cursor"]
+
+    try:
+        assert names({}) == ["web:%d" % i for i in range(5)] + ["db:0"]
+        assert names({"sort": "name"}) == (
+            ["db:0"] + ["web:%d" % i for i in range(5)])
+        assert names({"states": ["stopped"]}) == ["web:1"]
+        assert names({"programs": ["w*"], "min_uptime": 0}) == [
+            "web:0", "web:2", "web:3", "web:4"]
+        assert names({"sort": "state"}) == [
+            "web:1", "web:0", "web:2", "web:3", "web:4", "db:0"]
+        assert names({"sort": "state", "states": ["running"]}) == [
+            "web:0", "web:2", "web:3", "web:4", "db:0"]
+        assert names({"sort": "state", "max_uptime": 0}) == ["web:1"]
+        with pytest.raises(CommandError):
+            status(supervisor, {"sort": "size"})
+    finally:
+        stop(supervisor, wait_for)
+
+
+def test_bad_status_cursors_are_rejected(serve, connect, wait_for):
+    supervisor = serve({"web": {"numprocs": 2}})
+    client = connect(supervisor)
+    requests = [{"cursor": []}, {"sort": "state", "cursor": [0]},
+                {"sort": "name", "cursor": [0, "1"]}, {"cursor": [-2]},
+                {"cursor": 3}]
+    try:
+        for request_id, args in enumerate(requests):
+            client.send(request_id, "status", args)
+            reply = client.receive()
+            assert reply["id"] == request_id and not reply["ok"]
+            assert reply["error"].startswith("bad cursor")
+        client.send(9, "status", {"cursor": [0]})
+        assert [row["name"] for row in client.receive()["result"]["rows"]] \
+            == ["web:1"]
+    finally:
+        client.controller.close()
+        stop(supervisor, wait_for)
+
+
+def test_status_since_lists_changed_instances(serve, wait_for):
+    supervisor = serve({"web": {"numprocs": 3}})
+    assert len(status(supervisor, {"since": 0})["rows"]) == 3
+    supervisor.start()
+    wait_for(supervisor, lambda: running(supervisor) == 3)
+    try:
+        version = status(supervisor, {"since": 0})["version"]
+        assert status(supervisor, {"since": version})["rows"] == []
+        web = instance(supervisor, "web", 1)
+        web.stop()
+        wait_for(supervisor, lambda: web.state == ProcessStates.STOPPED)
+        reply = status(supervisor, {"since": version})
+        assert [row["name"] for row in reply["rows"]] == ["web:1"]
+        assert reply["rows"][0]["state"] == "STOPPED"
+        assert reply["version"] == version + 2
+        assert status(supervisor, {"since": version,
+                                   "states": ["running"]})["rows"] == []
+    finally:
+        stop(supervisor, wait_for)
+
+
+def test_columns_decode_with_frombytes(serve, wait_for):
+    supervisor = serve({"web": {"numprocs": 3}, "db": {}})
+    supervisor.start()
+    wait_for(supervisor, lambda: running(supervisor) == 4)
+    try:
+        result = json.loads(json.dumps(columns(supervisor, {"names": True})))
+        table = decodeColumns(result)
+        pids = [process.pid for process in supervisor.table]
+        assert "programs" not in columns(supervisor, {})
+    finally:
+        stop(supervisor, wait_for)
+    assert result["count"] == 4
+    assert result["processes"] == [[0, 0], [0, 1], [0, 2], [1, 0]]
+    assert list(table["pids"]) == pids
+    assert all(pid > 0 for pid in table["pids"])
+    assert set(table["states"]) == {ProcessStates.RUNNING}
+    assert all(abs(started - time.time()) < 5
+               for started in table["started"])
+    assert list(table["exitcodes"]) == [NO_EXIT_CODE] * 4
+
+
+def test_group_stop_arms_one_escalation_timer(serve, connect, wait_for):
+    stubborn = {"cmd": "sh -c \"trap '' TERM; while :; do sleep 0.1; done\"",
+                "stopsignal": "TERM", "stoptime": 1, "numprocs": 3}
+    supervisor = serve({"web": stubborn, "db": {}},
+                       groups={"front": ["web"]})
+    client = connect(supervisor)
+    client.send(1, "start", {"targets": ["all"]})
+    assert client.receive()["result"] == ["web:0", "web:1", "web:2", "db:0"]
+    wait_for(supervisor, lambda: running(supervisor) == 4)
+    timers = len(supervisor.timers)
+    stopped = supervisor.stop_processes(
+        [supervisor.table[i] for i in supervisor.names.resolve("group:front")])
+    assert len(stopped) == 3 and len(supervisor.timers) == timers + 1
+    started = time.monotonic()
+    wait_for(supervisor, lambda: len(
+        supervisor.by_state[ProcessStates.STOPPED]) == 3)
+    assert 0.9 < time.monotonic() - started < 2
+    assert all(process.escalated for process in stopped)
+    client.send(2, "restart", {"targets": ["web:1", "db"]})
+    assert client.receive()["result"] == ["web:1", "db:0"]
+    db = instance(supervisor, "db", 0)
+    wait_for(supervisor, lambda: db.state == ProcessStates.RUNNING)
+    assert instance(supervisor, "web", 1).state == ProcessStates.RUNNING
+    client.send(3, "stop", {"targets": ["nope:*"]})
+    assert client.receive()["error"] == "no such process 'nope:*'"
+    client.controller.close()
+    stop(supervisor, wait_for)
+
+
+def test_shutdown_takes_the_longest_stoptime(serve, wait_for):
+    # starttime lets the shells set their trap before they count as RUNNING
+    stubborn = {"cmd": "sh -c \"trap '' TERM; while :; do sleep 0.1; done\"",
+                "stopsignal": "TERM", "numprocs": 3, "starttime": 1}
+    supervisor = serve({
+        "a": dict(stubborn, stoptime=1), "b": dict(stubborn, stoptime=2),
+        "c": dict(stubborn, stoptime=1)})
+    supervisor.start()
+    wait_for(supervisor, lambda: running(supervisor) == 9)
+    for process in supervisor.table:
+        assert os.getpgid(process.pid) == process.pid
+    started = time.monotonic()
+    supervisor.shutdown()
+    # One timer for the whole stop, at the earliest stoptime
+    assert sum(1 for timer in supervisor.timers
+               if timer[2] is not None
+               and started + 0.5 < timer[0] < started + 2.5) == 1
+    wait_for(supervisor, supervisor.finished)
+    assert 1.9 < time.monotonic() - started < 2.9
+    assert all(process.escalated for process in supervisor.table)
+    supervisor.close()
+
+
+CHATTY = """
+import signal, sys, time
+def flood(signum, frame):
+    sys.stdout.write(("x" * 1023 + "\\n") * 1024)
+    sys.stdout.flush()
+    sys.exit(0)
+signal.signal(signal.SIGTERM, flood)
+while True:
+    time.sleep(1)
+"""
+
+
+def test_shutdown_follows_priorities_and_drains_output(tmp_path, serve,
+                                                        wait_for):
+    script = tmp_path / "chatty.py"
+    script.write_text(CHATTY)
+    log = tmp_path / "web.log"
+    supervisor = serve({
+        "db": {"priority": 1, "stopsignal": "TERM"},
+        "web": {"cmd": "%s %s" % (sys.executable, script), "numprocs": 2,
+                "stopsignal": "TERM", "stoptime": 5, "priority": 10,
+                "stdout": str(log), "starttime": 1},
+        "cache": {"stopsignal": "TERM", "stoptime": 30, "priority": 0,
+                  "cmd": "sh -c \"trap '' TERM; sleep 30\""}})
+    supervisor.start()
+    wait_for(supervisor, lambda: running(supervisor) == 4)
+    supervisor.shutdown()
+    db = instance(supervisor, "db", 0)
+    cache = instance(supervisor, "cache", 0)
+    web = [instance(supervisor, "web", i) for i in range(2)]
+
+    def db_after_web():
+        if any(process.state != ProcessStates.STOPPED for process in web):
+            assert db.state == ProcessStates.RUNNING
+        return db.state == ProcessStates.STOPPED
+    wait_for(supervisor, db_after_web)
+    assert cache.state == ProcessStates.STOPPING
+    assert not any(process.escalated for process in web)
+    # A second request does not wait for the 30s stoptime of cache
+    supervisor.shutdown()
+    wait_for(supervisor, supervisor.finished)
+    assert cache.escalated
+    supervisor.close()
+    for i in range(2):
+        assert os.path.getsize("%s.%d" % (log, i)) == 1 << 20
+
+
+def test_no_respawn_while_waiting_for_a_priority(tmp_path, serve, wait_for):
+    supervisor = serve({
+        "slow": {"cmd": "sh -c \"trap '' TERM; touch trapped; "
+                        "while :; do sleep 0.1; done\"",
+                 "stopsignal": "TERM", "stoptime": 1, "priority": 10},
+        "crashy": {"cmd": "sh -c 'sleep 0.5; exit 1'", "starttime": 5,
+                   "startretries": 5, "priority": 1}})
+    supervisor.start()
+    crashy = instance(supervisor, "crashy", 0)
+    wait_for(supervisor, (tmp_path / "trapped").exists)
+    pid = crashy.pid
+    supervisor.shutdown()
+    assert crashy.state == ProcessStates.STARTING
+
+    def not_respawned():
+        assert crashy.pid in (pid, 0)
+        return supervisor.finished()
+    wait_for(supervisor, not_respawned)
+    assert crashy.state == ProcessStates.STOPPED
+    supervisor.close()
+
+
+def test_programs_start_and_stop_along_dependencies(serve, wait_for):
+    supervisor = serve({
+        "web": {"depends_on": ["db", "cache"], "numprocs": 2},
+        "db": {"starttime": 1, "stopsignal": "TERM"},
+        "cache": {},
+        "worker": {"depends_on": ["cache"]},
+    })
+    web = [instance(supervisor, "web", i) for i in range(2)]
+    db = instance(supervisor, "db", 0)
+    worker = instance(supervisor, "worker", 0)
+    supervisor.start()
+    # worker only waits for cache, not for the slower db
+    wait_for(supervisor, lambda: worker.state == ProcessStates.RUNNING)
+    assert db.state == ProcessStates.STARTING
+    assert all(process.state == ProcessStates.STOPPED for process in web)
+    wait_for(supervisor, lambda: all(
+        process.state == ProcessStates.RUNNING for process in web + [db]))
+    supervisor.shutdown()
+    assert db.state == ProcessStates.RUNNING
+    assert worker.state != ProcessStates.RUNNING
+
+    def web_before_db():
+        if db.state != ProcessStates.RUNNING:
+            assert all(process.state == ProcessStates.STOPPED
+                       for process in web)
+        return supervisor.finished()
+    wait_for(supervisor, web_before_db)
+    supervisor.close()
+
+
+def test_rolling_restart_goes_batch_by_batch(serve, connect, wait_for):
+    supervisor = serve({"web": {"numprocs": 5}, "slow": {"starttime": 5}})
+    supervisor.start()
+    wait_for(supervisor, lambda: running(supervisor) == 5)
+    pids = [process.pid for process in supervisor.table[:5]]
+    client = connect(supervisor)
+    client.send(1, "rolling-restart", {"targets": ["web"], "batch": 2,
+                                       "wait_running": True})
+    messages = [client.receive() for _ in range(4)]
+    assert [message["event"]["processes"] for message in messages[:3]] == [
+        ["web:0", "web:1"], ["web:2", "web:3"], ["web:4"]]
+    assert messages[3]["result"] == {"restarted": 5, "batches": 3}
+    for process, pid in zip(supervisor.table, pids):
+        assert process.state == ProcessStates.RUNNING and process.pid != pid
+    client.send(2, "rolling-restart", {"targets": ["slow"],
+                                       "wait_running": True, "timeout": 0.2})
+    assert client.receive()["error"] == (
+        "batch 1/1: 1 instances not running in time")
+    client.controller.close()
+    stop(supervisor, wait_for)
+
+
+def test_shell_runs_commands_in_the_background(serve, connect, wait_for,
+                                               capsys):
+    supervisor = serve({"web": {"numprocs": 2}})
+    client = connect(supervisor)
+    controller = client.controller
+    parser, commands = buildParser()
+    shell = Shell(controller, parser, commands)
+    assert [shell.complete("st", i) for i in range(5)] == [
+        "start", "stats", "status", "stop", None]
+    controller.startReader()
+    loader = threading.Thread(target=shell.loadNames)
+    loader.start()
+    wait_for(supervisor, lambda: not loader.is_alive())
+    assert shell.names == ["all", "web", "web:*", "web:0", "web:1"]
+    assert shell.execute("events -p web")
+    wait_for(supervisor, lambda: controller.streams
+             and not controller.waiting)
+    supervisor.start()
+    printed = []
+
+    def shown():
+        printed.append(capsys.readouterr().out)
+        return "web:1" in "".join(printed)
+    wait_for(supervisor, shown)
+    output = "".join(printed)
+    assert "web:0" in output and "web:1" in output
+    assert "PROCESS_STATE_RUNNING" in output
+    assert shell.execute("bogus") and shell.execute("")
+    assert not shell.execute("quit")
+    controller.close()
+    controller.reader.join(5)
+    stop(supervisor, wait_for)
+
+
+def test_batch_pipelines_commands_and_counts_failures(serve, connect,
+                                                      wait_for, capsys):
+    supervisor = serve({"web": {"numprocs": 2}})
+    supervisor.start()
+    client = connect(supervisor)
+    lines = ["# warm up", "status", "", "stats nope", "history web",
+             "bogus", "stats web"]
+    batch = Batch(client.controller, buildParser()[0], lines)
+    # A slow first command must still be the first on the wire
+    sent = []
+    send = client.controller.send
+
+    def slow_send(cmd, args=None, waiter=None, stream=None):
+        if cmd == "status":
+            time.sleep(0.2)
+        sent.append(cmd)
+        return send(cmd, args, waiter, stream)
+    client.controller.send = slow_send
+    result = []
+    runner = threading.Thread(target=lambda: result.append(batch.run()))
+    runner.start()
+    wait_for(supervisor, lambda: not runner.is_alive())
+    captured = capsys.readouterr()
+    assert result == [1]
+    assert (batch.commands, batch.failed) == (5, 3)
+    assert sent == ["status", "stats", "history", "stats"]
+    assert "> status\nweb:0" in captured.out
+    assert "> stats nope\nerror: no such program 'nope'\n" in captured.out
+    assert "> history web\nerror: no journal configured\n" in captured.out
+    assert "> stats web\nMETRIC" in captured.out
+    assert "5 commands, 3 failed" in captured.err
+    client.controller.close()
+    stop(supervisor, wait_for)
@@ -0,0 +1,59 @@
+import events
+from classes import ConfigYAML
+from process import ProcessStates
+from taskmasterd import Supervisor
+
+
+def test_subscribing_to_a_base_type_covers_subtypes():
+    bus = events.EventBus()
+    states, fatal = [], []
+    bus.subscribe(events.EventsTypes.PROCESS_STATE, states.append)
+    bus.subscribe(events.event_type("process_state_fatal"), fatal.append)
+    bus.publish(events.ProcessStateRunningEvent(0, 0, 0, 42, 10, None))
+    bus.publish(events.ProcessStateFatalEvent(1, 0, 1, 0, 30, None))
+    bus.publish(events.SupervisorRunningEvent(1))
+    assert [type(event) for event in states] == [
+        events.ProcessStateRunningEvent, events.ProcessStateFatalEvent]
+    assert [event.serial for event in fatal] == [2]
+    assert fatal[0].payload() == {"process": 1, "program": 0, "instance": 1,
+                                  "pid": 0, "from_state": 30,
+                                  "exit_code": None}
+    assert not bus.listeners.get(events.SupervisorRunningEvent)
+    bus.unsubscribe(states.append)
+    bus.publish(events.ProcessStateRunningEvent(0, 0, 0, 42, 10, None))
+    assert len(states) == 2
+
+
+def test_supervisor_publishes_state_and_log_events(tmp_path, wait_for):
+    config = ConfigYAML(programs={"echo": {
+        "cmd": "sh -c 'echo hello; sleep 0.3'",
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "autorestart": False,
+        "startretries": 0,
+        "starttime": 0,
+        "stdout": str(tmp_path / "out"),
+    }})
+    supervisor = Supervisor(config)
+    received = []
+    supervisor.events.subscribe(events.EventsTypes.EVENT, received.append)
+    supervisor.install_signals()
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("echo", 0)]
+    try:
+        wait_for(supervisor, lambda: process.state == ProcessStates.EXITED
+                 and not supervisor.channels)
+    finally:
+        supervisor.close()
+    names = [events.EVENT_NAMES[type(event)] for event in received]
+    assert names[0] == "CONFIG_LOADED"
+    assert "SUPERVISOR_STATE_CHANGE_RUNNING" in names
+    assert "PROCESS_STATE_STARTING" in names
+    assert "PROCESS_STATE_RUNNING" in names
+    logs = [event for event in received
+            if isinstance(event, events.ProcessLogStdoutEvent)]
+    assert b"".join(event.data for event in logs) == b"hello\n"
+    exited = [event for event in received
+              if isinstance(event, events.ProcessStateExitedEvent)]
+    assert exited[0].exit_code == 0
+    assert exited[0].from_state == ProcessStates.RUNNING
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+from classes import ConfigYAML
+from control import history, stop
+from journal import RECORD, Journal
+from process import ProcessStates
+from taskmasterd import Supervisor
+
+
+def test_index_survives_reopen_and_torn_record(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.bind(["web", "db"])
+    for i in range(5):
+        journal.append(0, i, 100 + i, ProcessStates.STARTING,
+                       ProcessStates.RUNNING, None)
+        journal.append(1, 0, 200 + i, ProcessStates.RUNNING,
+                       ProcessStates.EXITED, i)
+    assert [row["pid"] for row in journal.history("web", 2)] == [103, 104]
+    journal.close()
+    with open(path, "ab") as f:
+        f.write(b"\1" * (RECORD.size // 2))
+
+    journal = Journal(path)
+    assert os.path.getsize(path) == RECORD.size * 11
+    rows = journal.history("db", 0)
+    assert [row["exitcode"] for row in rows] == [0, 1, 2, 3, 4]
+    assert rows[0]["from"] == "RUNNING" and rows[0]["to"] == "EXITED"
+    assert journal.history("web")[0]["exitcode"] is None
+    assert journal.history("nope") == []
+    journal.bind(["cache", "db"])
+    assert journal.local == [2, 1]
+    assert journal.ids == {"web": 0, "db": 1, "cache": 2}
+    journal.close()
+
+
+def test_open_scans_past_the_checkpoint_only(tmp_path, monkeypatch):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.bind(["web", "db"])
+    for i in range(3):
+        journal.append(0, 70000 + i, 100 + i, ProcessStates.STARTING,
+                       ProcessStates.RUNNING, None)
+    journal.sync()
+    journal.append(1, 0, 200, ProcessStates.RUNNING, ProcessStates.EXITED, 0)
+    journal.command(0, 1, "restart")
+    # Crash: the last two records were never checkpointed
+    journal.flush()
+    os.close(journal.fd)
+    os.close(journal.names_fd)
+
+    scans = []
+    scan = Journal.scan
+    monkeypatch.setattr(Journal, "scan", lambda self, record:
+                        scans.append(record) or scan(self, record))
+    journal = Journal(path)
+    journal.bind(["web", "db"])
+    assert scans == [4]
+    rows = journal.history("web", 0)
+    assert [row["instance"] for row in rows] == [70000, 70001, 70002, 1]
+    assert rows[-1]["command"] == "restart" and "to" not in rows[-1]
+    assert journal.history("web", 2)[0]["pid"] == 102
+    assert [row["exitcode"] for row in journal.history("db")] == [0]
+    journal.close()
+
+    # A checkpoint that does not match the journal is ignored
+    os.unlink(path)
+    journal = Journal(path)
+    journal.bind(["web", "db"])
+    assert journal.history("web") == []
+    assert scans[-1] == 1
+    journal.close()
+
+
+def test_supervisor_journals_state_changes(tmp_path, wait_for):
+    config = ConfigYAML(programs={"fail": {
+        "cmd": "sh -c 'exit 3'",
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "autorestart": False,
+        "startretries": 0,
+        "starttime": 5,
+    }}, taskmasterd={"journal": str(tmp_path / "journal"),
+                     "journalsync": 0.1})
+    supervisor = Supervisor(config)
+    supervisor.install_signals()
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("fail", 0)]
+    try:
+        wait_for(supervisor, lambda: process.state == ProcessStates.FATAL)
+        pid = supervisor.journal.history("fail")[-1]["pid"]
+        stop(supervisor, {"targets": ["fail"]})
+        rows = history(supervisor, {"program": "fail"})
+    finally:
+        supervisor.close()
+    assert [(row["from"], row["to"]) for row in rows[:2]] == [
+        ("STOPPED", "STARTING"), ("STARTING", "FATAL")]
+    assert rows[2]["command"] == "stop" and rows[2]["instance"] == 0
+    assert rows[1]["exitcode"] == 3
+    assert pid == rows[0]["pid"] > 0
+
+
+def test_upgrade_syncs_the_journal(tmp_path, make_supervisor, wait_for,
+                                   monkeypatch):
+    path = str(tmp_path / "journal")
+    supervisor = make_supervisor(taskmasterd={
+        "journal": path, "journalsync": 60,
+        "statefile": str(tmp_path / "state")})
+    supervisor.start()
+    supervisor.table[supervisor.names.process_id("daemon", 0)].start()
+
+    def execv(executable, argv):
+        raise RuntimeError("exec")
+    monkeypatch.setattr(os, "execv", execv)
+    with pytest.raises(RuntimeError):
+        supervisor.upgrade()
+    assert supervisor.journal is None
+    journal = Journal(path)
+    assert [row["to"] for row in journal.history("daemon")] == ["STARTING"]
+    assert os.path.exists(path + ".heads")
+    journal.close()
+    process = supervisor.table[supervisor.names.process_id("daemon", 0)]
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    supervisor.close()
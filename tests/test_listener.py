@@ -0,0 +1,87 @@
+import json
+import sys
+
+import pytest
+from pydantic import ValidationError
+
+from classes import ConfigYAML, ProgramConfig
+from taskmasterd import Supervisor
+
+LISTENER = """
+import sys
+out = open(sys.argv[1], "a")
+sys.stdout.write("READY\\n")
+sys.stdout.flush()
+while True:
+    header = sys.stdin.buffer.readline()
+    if not header:
+        break
+    _, count, length = header.split()
+    payload = sys.stdin.buffer.read(int(length))
+    out.write("%s %s" % (count.decode(), payload.decode()))
+    out.flush()
+    sys.stdout.write("OK\\n")
+    sys.stdout.flush()
+"""
+
+
+def test_unknown_event_type_is_rejected():
+    with pytest.raises(ValidationError):
+        ProgramConfig(cmd="true", umask="022", workingdir="/", startretries=0,
+                      starttime=0, events=["PROCESS_STATE_BOGUS"])
+
+
+def test_events_are_delivered_in_batches(tmp_path, wait_for):
+    script = tmp_path / "listener.py"
+    script.write_text(LISTENER)
+    received = tmp_path / "received"
+    config = ConfigYAML(programs={
+        "alerts": {
+            "cmd": "%s %s %s" % (sys.executable, script, received),
+            "umask": "022",
+            "workingdir": str(tmp_path),
+            "startretries": 0,
+            "starttime": 0,
+            "events": ["PROCESS_STATE_RUNNING", "PROCESS_STATE_EXITED"],
+            "batchsize": 4,
+            "batchlatency": 0.2,
+        },
+        "workers": {
+            "cmd": "sleep 0.3",
+            "numprocs": 6,
+            "umask": "022",
+            "workingdir": str(tmp_path),
+            "autorestart": False,
+            "startretries": 0,
+            "starttime": 0,
+        },
+    })
+    supervisor = Supervisor(config)
+    supervisor.install_signals()
+    supervisor.start()
+    pool = supervisor.pools[supervisor.names.program_ids["alerts"]]
+    events = []
+
+    def delivered():
+        if received.exists():
+            events[:] = received.read_text().splitlines()
+        return len(events) >= 13
+    try:
+        wait_for(supervisor, delivered, timeout=10)
+    finally:
+        supervisor.close()
+    batches = [int(line.split(" ", 1)[0]) for line in events
+               if line[0].isdigit()]
+    records = [json.loads(line.split(" ", 1)[1] if line[0].isdigit()
+                          else line) for line in events]
+    # The listener's own RUNNING, then RUNNING and EXITED for six workers
+    assert len(records) == 13
+    assert max(batches) <= 4
+    assert len(batches) < len(records)
+    assert pool.batches == len(batches)
+    exited = [record for record in records
+              if record["event"] == "PROCESS_STATE_EXITED"]
+    assert {record["instance"] for record in exited} == set(range(6))
+    assert all(record["from_state"] == "RUNNING" for record in exited)
+    serials = [record["serial"] for record in records]
+    assert serials == sorted(serials)
@@ -0,0 +1,131 @@
+import socket
+
+from classes import ConfigYAML
+from metrics import Metrics, bucket_bounds, bucket_index
+from taskmasterd import Supervisor
+
+
+def test_bucket_bounds_cover_values():
+    for value in list(range(200)) + [1000, 12345, 10 ** 6, 3 * 10 ** 9]:
+        low, high = bucket_bounds(bucket_index(value))
+        assert low <= value < high
+        assert high - low <= max(1, low / 8)
+
+
+def test_render_reuses_unchanged_series():
+    metrics = Metrics()
+    metrics.transition("nginx", None, "STOPPED")
+    metrics.restarts.labels('we"ird').value += 2
+    first = metrics.render()
+    assert b'taskmaster_processes{program="nginx",state="STOPPED"} 1\n' in first
+    assert b'taskmaster_restarts_total{program="we\\"ird"} 2\n' in first
+    assert first.endswith(b"# EOF\n")
+    series = metrics.restarts.labels('we"ird')
+    cached = series.text
+    metrics.transition("nginx", "STOPPED", "STARTING")
+    second = metrics.render()
+    assert series.text is cached
+    assert b'state="STOPPED"} 0\n' in second
+    assert b'state="STARTING"} 1\n' in second
+
+
+def test_histogram_folds_into_exposition_buckets():
+    metrics = Metrics()
+    histogram = metrics.spawn_seconds.labels("web")
+    for seconds in (0.0002, 0.003, 0.003, 2.0):
+        histogram.observe(seconds)
+    text = metrics.render().decode()
+    assert 'taskmaster_spawn_seconds_bucket{program="web",le="0.00025"} 1' \
+        in text
+    assert 'taskmaster_spawn_seconds_bucket{program="web",le="0.005"} 3' in text
+    assert 'taskmaster_spawn_seconds_bucket{program="web",le="+Inf"} 4' in text
+    assert 'taskmaster_spawn_seconds_count{program="web"} 4' in text
+
+
+def test_exporter_serves_openmetrics(tmp_path, wait_for):
+    config = ConfigYAML(programs={"echo": {
+        "cmd": "echo hello",
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "autorestart": False,
+        "startretries": 0,
+        "starttime": 0,
+        "stdout": str(tmp_path / "out"),
+    }})
+    supervisor = Supervisor(config)
+    supervisor.install_signals()
+    supervisor.serve_metrics("127.0.0.1:0")
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("echo", 0)]
+    wait_for(supervisor,
+             lambda: not process.pid and not supervisor.channels)
+    client = socket.create_connection(supervisor.exporter.address)
+    client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+    client.setblocking(False)
+    chunks = []
+
+    def answered():
+        try:
+            chunks.append(client.recv(65536))
+        except BlockingIOError:
+            pass
+        return b"".join(chunks).endswith(b"# EOF\n")
+    wait_for(supervisor, answered)
+    response = b"".join(chunks)
+    client.close()
+    header, body = response.split(b"\r\n\r\n", 1)
+    assert header.startswith(b"HTTP/1.0 200 OK")
+    assert b"application/openmetrics-text" in header
+    assert b'taskmaster_log_bytes_total{program="echo",stream="stdout"} 6\n' \
+        in body
+    assert b'taskmaster_spawn_seconds_count{program="echo"} 1\n' in body
+    assert b'taskmaster_reap_seconds_count{program="echo"} 1\n' in body
+    supervisor.close()
+
+
+def test_histogram_percentiles_and_reset():
+    metrics = Metrics()
+    histogram = metrics.running_seconds.labels("web")
+    for ms in range(1, 101):
+        histogram.observe(ms / 1000)
+    row = metrics.stats("web")[0]
+    assert row["metric"] == "taskmaster_running_seconds"
+    assert row["count"] == 100
+    assert abs(row["p50"] - 0.050) < 0.050 / 8
+    assert abs(row["p99"] - 0.099) < 0.099 / 8
+    assert row["max"] == 0.1
+    assert metrics.stats("other") == []
+    text = metrics.render()
+    assert metrics.stats(reset=True)[0]["count"] == 100
+    assert metrics.stats()[0]["count"] == 0
+    # The exported series keep counting from where they were
+    assert metrics.render() == text
+    histogram.observe(0.2)
+    row = metrics.stats()[0]
+    assert row["count"] == 1 and row["max"] == row["mean"] == 0.2
+    assert abs(row["p50"] - 0.2) < 0.2 / 8
+    assert b'taskmaster_running_seconds_count{program="web"} 101\n' \
+        in metrics.render()
+
+
+def test_restart_delay_is_measured(tmp_path, wait_for):
+    config = ConfigYAML(programs={"crash": {
+        "cmd": "sh -c 'sleep 0.1; exit 1'",
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "autorestart": "unexpected",
+        "startretries": 3,
+        "starttime": 0,
+    }})
+    supervisor = Supervisor(config)
+    supervisor.install_signals()
+    supervisor.start()
+    histogram = supervisor.metrics.restart_seconds.labels("crash")
+    wait_for(supervisor, lambda: histogram.count >= 2)
+    supervisor.shutdown()
+    wait_for(supervisor, supervisor.finished)
+    supervisor.close()
+    rows = {row["metric"]: row for row in supervisor.metrics.stats("crash")}
+    assert rows["taskmaster_running_seconds"]["count"] >= 3
+    assert 0 < rows["taskmaster_restart_seconds"]["p50"] < 1
+    assert rows["taskmaster_reap_seconds"]["count"] >= 2
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import yaml
+from pydantic import ValidationError
+
+from classes import Config, ConfigError, ConfigYAML
+from names import NameTable
+
+PROGRAM = {"cmd": "true", "umask": "022", "workingdir": "/",
+           "startretries": 0, "starttime": 0}
+
+
+def test_instances_of_a_program_get_consecutive_ids():
+    names = NameTable(ConfigYAML(programs={
+        "web": dict(PROGRAM, numprocs=3), "db": PROGRAM}))
+    assert names.programs == ["web", "db"]
+    assert names.processes == [(0, 0), (0, 1), (0, 2), (1, 0)]
+    assert names.process_id("web", 2) == 2
+    assert names.process_id("db", 0) == 3
+    assert names.process_id("web", 3) is None
+    assert names.process_id("db", -1) is None
+    assert names.process_id("cache", 0) is None
+    assert names.process_name(1) == "web:1"
+
+
+def test_targets_resolve_to_process_ids():
+    names = NameTable(ConfigYAML(programs={
+        "web": dict(PROGRAM, numprocs=3), "worker": dict(PROGRAM, numprocs=2),
+        "db": PROGRAM}, groups={"front": ["web", "db"]}))
+    assert names.resolve("all") == [0, 1, 2, 3, 4, 5]
+    assert names.resolve("web") == names.resolve("web:*") == [0, 1, 2]
+    assert names.resolve("w*:*") == [0, 1, 2, 3, 4]
+    assert names.resolve("worker:1") == [4]
+    assert names.resolve("group:front") == [0, 1, 2, 5]
+    for target in ("group:back", "cache", "web:3", "web:x", "x*"):
+        assert names.resolve(target) is None
+    with pytest.raises(ValidationError):
+        ConfigYAML(programs={"web": PROGRAM}, groups={"front": ["cache"]})
+
+
+def test_dependency_cycles_are_rejected_at_load():
+    names = NameTable(ConfigYAML(programs={
+        "web": dict(PROGRAM, depends_on=["db", "cache"]),
+        "cache": dict(PROGRAM, depends_on=["db"]), "db": PROGRAM}))
+    assert names.depends == [[1, 2], [2], []]
+    assert names.dependents == [[], [0], [0, 1]]
+    with pytest.raises(ValidationError, match="web -> db -> cache -> web"):
+        ConfigYAML(programs={
+            "web": dict(PROGRAM, depends_on=["db"]),
+            "db": dict(PROGRAM, depends_on=["cache"]),
+            "cache": dict(PROGRAM, depends_on=["web"])})
+    with pytest.raises(ValidationError, match="depends on unknown"):
+        ConfigYAML(programs={"web": dict(PROGRAM, depends_on=["queue"])})
+
+
+def test_cycles_are_reported_without_a_traceback(tmp_path):
+    path = tmp_path / "cycle.yml"
+    path.write_text(yaml.safe_dump({"programs": {
+        "a": dict(PROGRAM, depends_on=["b"]),
+        "b": dict(PROGRAM, depends_on=["a"])}}))
+    with pytest.raises(ConfigError) as error:
+        Config(str(path))
+    assert str(error.value) == "dependency cycle: a -> b -> a"
+    daemon = os.path.join(os.path.dirname(__file__), "..", "taskmaster",
+                          "taskmasterd.py")
+    result = subprocess.run([sys.executable, daemon, "-c", str(path)],
+                            capture_output=True, text=True, timeout=30)
+    assert result.returncode == 1
+    assert "dependency cycle: a -> b -> a" in result.stderr
+    assert "Traceback" not in result.stderr
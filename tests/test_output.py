@@ -0,0 +1,112 @@
+import re
+import time
+
+from classes import ConfigYAML
+from output import LinePrefixer, MAX_LINE
+from taskmasterd import Supervisor
+
+STAMP = rb"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}"
+
+
+def test_prefixer_whole_lines():
+    prefixer = LinePrefixer("nginx:3")
+    out = prefixer.feed(b"one\ntwo\n", now=0.5)
+    lines = out.split(b"\n")
+    assert lines[-1] == b""
+    assert re.fullmatch(STAMP + rb" nginx:3 one", lines[0])
+    assert re.fullmatch(STAMP + rb" nginx:3 two", lines[1])
+    assert lines[0].split(b" ")[1].endswith(b".500")
+
+
+def test_prefixer_keeps_partial_line():
+    prefixer = LinePrefixer("web:0")
+    assert prefixer.feed(b"hel") == b""
+    out = prefixer.feed(b"lo\nwor")
+    assert out.endswith(b" web:0 hello\n")
+    assert out.count(b"\n") == 1
+    assert prefixer.flush().endswith(b" web:0 wor\n")
+    assert prefixer.flush() == b""
+
+
+def test_prefixer_splits_overlong_line():
+    prefixer = LinePrefixer("web:0")
+    out = prefixer.feed(b"x" * MAX_LINE)
+    assert out.endswith(b"x\n")
+    assert prefixer.partial == b""
+
+
+def run(supervisor, timeout=5.0):
+    supervisor.install_signals()
+    supervisor.start()
+    deadline = time.monotonic() + timeout
+    while any(p.pid for p in supervisor.table):
+        assert time.monotonic() < deadline
+        supervisor.tick(0.1)
+    supervisor.close()
+
+
+def test_supervisor_prefixes_captured_output(tmp_path):
+    config = ConfigYAML(programs={"echo": {
+        "cmd": "sh -c 'printf \"a\\nb\\n\"; printf c >&2'",
+        "numprocs": 2,
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "autorestart": False,
+        "startretries": 0,
+        "starttime": 0,
+        "stdout": str(tmp_path / "out"),
+        "stderr": str(tmp_path / "err"),
+        "logprefix": True,
+    }})
+    run(Supervisor(config))
+    for instance in (0, 1):
+        out = (tmp_path / ("out.%d" % instance)).read_bytes()
+        assert re.fullmatch(
+            STAMP + b" echo:%d a\n" % instance
+            + STAMP + b" echo:%d b\n" % instance, out)
+        err = (tmp_path / ("err.%d" % instance)).read_bytes()
+        assert re.fullmatch(STAMP + b" echo:%d c\n" % instance, err)
+
+
+def test_merged_log_writes_once_per_flush(tmp_path, monkeypatch):
+    import output
+
+    writes = []
+    real_write = output.os.write
+
+    def counting_write(fd, data):
+        writes.append(bytes(data))
+        return real_write(fd, data)
+
+    dirty = []
+    log = output.MergedLog(str(tmp_path / "merged"), dirty)
+    monkeypatch.setattr(output.os, "write", counting_write)
+    for instance in range(3):
+        prefixer = LinePrefixer("web:%d" % instance, timestamps=False)
+        log.write(prefixer.feed(b"up\ndown\n"))
+    assert dirty == [log]
+    log.flush()
+    log.close()
+    assert len(writes) == 1
+    assert writes[0] == (b"web:0 up\nweb:0 down\nweb:1 up\nweb:1 down\n"
+                         b"web:2 up\nweb:2 down\n")
+
+
+def test_supervisor_merges_instance_logs(tmp_path):
+    config = ConfigYAML(programs={"echo": {
+        "cmd": "sh -c 'echo out; echo err >&2'",
+        "numprocs": 3,
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "autorestart": False,
+        "startretries": 0,
+        "starttime": 0,
+        "stdout": str(tmp_path / "log"),
+        "stderr": str(tmp_path / "log"),
+        "mergelogs": True,
+    }})
+    run(Supervisor(config))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["log"]
+    lines = sorted((tmp_path / "log").read_bytes().splitlines())
+    assert lines == [b"echo:%d %s" % (i, s) for i in range(3)
+                     for s in (b"err", b"out")]
@@ -0,0 +1,40 @@
+import time
+
+from profiler import SamplingProfiler
+
+
+def burn(seconds):
+    deadline = time.process_time() + seconds
+    total = 0
+    while time.process_time() < deadline:
+        total += sum(range(1000))
+    return total
+
+
+def test_collapsed_stacks_name_the_busy_function():
+    profiler = SamplingProfiler(interval=0.002)
+    profiler.start()
+    try:
+        burn(0.3)
+    finally:
+        profiler.stop()
+    report = profiler.report()
+    assert report["samples"] > 10
+    assert report["overhead_percent"] < 100 * profiler.budget
+    lines = report["stacks"].splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) \
+        == report["samples"]
+    assert any("burn (test_profiler.py:" in line for line in lines)
+    assert all(";" in line for line in lines)
+
+
+def test_stop_restores_previous_handler():
+    import signal
+
+    before = signal.getsignal(signal.SIGPROF)
+    profiler = SamplingProfiler()
+    profiler.start()
+    profiler.stop()
+    profiler.stop()
+    assert signal.getsignal(signal.SIGPROF) == before
+    assert signal.getitimer(signal.ITIMER_PROF) == (0.0, 0.0)
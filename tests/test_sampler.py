@@ -0,0 +1,94 @@
+import os
+import socket
+import subprocess
+
+from classes import ConfigYAML
+from sampler import PAGE_SIZE, ProcSampler
+from taskmasterctl import Controller, formatStatus
+from taskmasterd import Supervisor
+
+
+def test_samples_reuse_open_fds():
+    child = subprocess.Popen(["sleep", "30"])
+    sampler = ProcSampler()
+    samples = sampler.sample([os.getpid(), child.pid, 2 ** 22 + 1])
+    assert set(samples) == {os.getpid(), child.pid}
+    assert samples[os.getpid()].rss > PAGE_SIZE
+    assert samples[os.getpid()].threads >= 1
+    assert samples[os.getpid()].fds > 0
+    fds = sampler.open[child.pid]
+    sampler.sample([os.getpid(), child.pid])
+    assert sampler.open[child.pid] == fds
+    child.kill()
+    child.wait()
+    assert set(sampler.sample([os.getpid(), child.pid])) == {os.getpid()}
+    assert child.pid not in sampler.open
+    sampler.clear()
+    assert sampler.open == {}
+
+
+def test_sampler_respects_fd_budget():
+    sampler = ProcSampler(max_fds=0)
+    assert os.getpid() in sampler.sample([os.getpid()])
+    assert sampler.open == {}
+
+
+def test_cycle_spread_over_steps():
+    sampler = ProcSampler()
+    sampler.begin([os.getpid(), os.getppid(), 2 ** 22 + 1])
+    assert sampler.step(2)
+    assert sampler.samples == {}
+    assert not sampler.step(2)
+    assert set(sampler.samples) == {os.getpid(), os.getppid()}
+    sampler.begin([os.getpid()])
+    assert not sampler.step(10)
+    assert sampler.samples[os.getpid()].cpu_percent >= 0
+    assert list(sampler.open) == [os.getpid()]
+    sampler.clear()
+
+
+def test_status_resources_over_control_socket(tmp_path, wait_for):
+    config = ConfigYAML(programs={"sleeper": {
+        "cmd": "sleep 30",
+        "numprocs": 2,
+        "umask": "022",
+        "workingdir": str(tmp_path),
+        "startretries": 0,
+        "starttime": 0,
+        "stopsignal": "KILL",
+    }}, taskmasterd={"sampleinterval": 0})
+    supervisor = Supervisor(config)
+    supervisor.install_signals()
+    supervisor.listen(str(tmp_path / "sock"))
+    supervisor.start()
+
+    class Options:
+        socket = str(tmp_path / "sock")
+
+    controller = Controller(Options)
+    controller.connect()
+    controller.sock.sendall(b'{"id":1,"cmd":"status","args":'
+                            b'{"resources":true}}\n')
+
+    def replied():
+        try:
+            controller.buffer += controller.sock.recv(65536,
+                                                      socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+        return b"\n" in controller.buffer
+    wait_for(supervisor, replied)
+    reply = controller.readMessage()
+    assert reply["id"] == 1 and reply["ok"]
+    rows = reply["result"]["rows"]
+    assert [row["name"] for row in rows] == ["sleeper:0", "sleeper:1"]
+    for row in rows:
+        assert row["resources"]["rss"] > 0
+        assert row["resources"]["processes"] == 1
+        assert "rss" in formatStatus(row)
+    controller.close()
+    supervisor.shutdown()
+    while not supervisor.finished():
+        supervisor.tick(0.05)
+    supervisor.close()
+    assert not (tmp_path / "sock").exists()
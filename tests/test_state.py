@@ -0,0 +1,103 @@
+import os
+import signal
+import subprocess
+import time
+
+import linux
+import state
+from events import ProcessStateEvent
+from process import ProcessStates
+
+
+def sleeper(make_supervisor, tmp_path, **options):
+    return make_supervisor(name="sleeper", taskmasterd={
+        "statefile": str(tmp_path / "state")}, **options)
+
+
+def test_start_time_reads_proc():
+    assert linux.start_time(os.getpid()) > 0
+    assert linux.parent_pid(os.getpid()) == os.getppid()
+    assert linux.start_time(2 ** 22 + 1) == 0
+
+
+def test_snapshot_is_written_atomically(tmp_path, make_supervisor, wait_for):
+    supervisor = sleeper(make_supervisor, tmp_path)
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("sleeper", 0)]
+    process.start()
+    supervisor.snapshot()
+    data = state.read_snapshot(str(tmp_path / "state"))
+    assert data["daemon"] == os.getpid()
+    assert data["processes"] == [["sleeper", 0, process.pid,
+                                  linux.start_time(process.pid),
+                                  ProcessStates.STARTING, [-1, -1]]]
+    assert os.listdir(tmp_path) == ["state"]
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    supervisor.close()
+    assert state.read_snapshot(str(tmp_path / "state"))["processes"] == []
+
+
+def test_snapshot_follows_the_worker(tmp_path, make_supervisor, wait_for):
+    supervisor = sleeper(make_supervisor, tmp_path,
+                         cmd="sh -c 'sleep 0.3; sleep 30 & exit 0'")
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("sleeper", 0)]
+    process.start()
+    leader = process.pid
+    wait_for(supervisor, lambda: process.state == ProcessStates.RUNNING)
+    supervisor.snapshot()
+    wait_for(supervisor, lambda: process.pid != leader)
+    supervisor.snapshot()
+    data = state.read_snapshot(str(tmp_path / "state"))
+    assert data["processes"][0][2:4] == [process.pid,
+                                         linux.start_time(process.pid)]
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    supervisor.close()
+
+
+def test_adopts_running_child(tmp_path, make_supervisor, wait_for):
+    child = subprocess.Popen(["sleep", "30"])
+    (tmp_path / "state").write_bytes(b'{"version":1,"daemon":%d,"processes":'
+                                     b'[["sleeper",0,%d,%d,20,[-1,-1]],'
+                                     b'["sleeper",1,%d,1,20,[-1,-1]]]}' % (
+                                         os.getpid(), child.pid,
+                                         linux.start_time(child.pid),
+                                         child.pid))
+    time.sleep(0.5)
+    supervisor = sleeper(make_supervisor, tmp_path)
+    events = []
+    supervisor.events.subscribe(ProcessStateEvent, events.append)
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("sleeper", 0)]
+    assert process.state == ProcessStates.RUNNING
+    assert process.pid == child.pid
+    assert process.pidfd is None
+    # Adopted with the uptime it had and without a state change
+    assert 0.4 < time.monotonic() - process.start_time < 5
+    assert events == []
+    assert supervisor.by_state[ProcessStates.RUNNING] == {process.id}
+    child.kill()
+    wait_for(supervisor, lambda: process.state == ProcessStates.EXITED)
+    assert process.exit_code == -signal.SIGKILL
+    child.returncode = process.exit_code
+    supervisor.close()
+
+
+def test_adopts_orphan_through_pidfd(tmp_path, make_supervisor, wait_for):
+    out = subprocess.run(["sh", "-c", "sleep 30 >/dev/null 2>&1 & echo $!"],
+                         capture_output=True, check=True)
+    pid = int(out.stdout)
+    (tmp_path / "state").write_bytes(b'{"version":1,"daemon":1,"processes":'
+                                     b'[["sleeper",0,%d,%d,20,[3,4]]]}' % (
+                                         pid, linux.start_time(pid)))
+    supervisor = sleeper(make_supervisor, tmp_path)
+    supervisor.start()
+    process = supervisor.table[supervisor.names.process_id("sleeper", 0)]
+    assert process.state == ProcessStates.RUNNING
+    assert process.channels == [None, None]
+    os.kill(pid, signal.SIGKILL)
+    wait_for(supervisor, lambda: process.state == ProcessStates.EXITED)
+    assert process.exit_code is None
+    supervisor.close()
@@ -0,0 +1,81 @@
+import pytest
+
+import tracing
+from process import ProcessStates
+
+
+@pytest.fixture
+def failing(make_supervisor):
+    # A program that exits at once and goes FATAL after one retry
+    def make(**daemon):
+        return make_supervisor(name="fail", cmd="sh -c 'exit 3'",
+                               autostart=True, startretries=1, starttime=5,
+                               taskmasterd=daemon)
+    return make
+
+
+@pytest.fixture
+def run_until_fatal(wait_for):
+    def run(supervisor):
+        supervisor.attach_tracers()
+        supervisor.start()
+        process = supervisor.table[supervisor.names.process_id("fail", 0)]
+        wait_for(supervisor,
+                 lambda: process.state == ProcessStates.FATAL, timeout=10)
+        return process
+    return run
+
+
+def test_no_hook_means_no_emit(failing, run_until_fatal, monkeypatch):
+    def emit(*args):
+        raise AssertionError("emit called without hooks")
+    supervisor = failing()
+    monkeypatch.setattr(supervisor.tracer, "emit", emit)
+    try:
+        assert run_until_fatal(supervisor).state == ProcessStates.FATAL
+    finally:
+        supervisor.close()
+
+
+def test_failing_hook_does_not_break_the_state_machine(failing,
+                                                       run_until_fatal):
+    supervisor = failing()
+
+    def hook(*args):
+        raise RuntimeError("broken hook")
+    supervisor.tracer.register(hook, [tracing.SPAWN, tracing.BACKOFF])
+    try:
+        # Both attempts still run their starttime and backoff timers
+        assert run_until_fatal(supervisor).state == ProcessStates.FATAL
+    finally:
+        supervisor.close()
+
+
+def test_hooks_and_ring_file(tmp_path, failing, run_until_fatal):
+    ring = tmp_path / "trace.ring"
+    supervisor = failing(tracefile=str(ring))
+    events = []
+    supervisor.tracer.register(
+        lambda point, now, name, instance, pid, detail:
+        events.append((tracing.POINT_NAMES[point], detail)),
+        [tracing.EXITED, tracing.BACKOFF, tracing.FATAL])
+    try:
+        run_until_fatal(supervisor)
+    finally:
+        supervisor.close()
+    assert events == [("exited", 3), ("backoff", 1), ("exited", 3),
+                      ("fatal", 2)]
+    records = list(tracing.read_ring(str(ring)))
+    assert [record[1] for record in records] == [
+        "spawn", "exited", "backoff", "spawn", "exited", "fatal"]
+    assert all(record[2] == "fail" for record in records)
+    assert records[0][4] > 0
+
+
+def test_ring_wraps(tmp_path):
+    ring = tracing.RingFileTracer(str(tmp_path / "ring"), capacity=4)
+    for i in range(10):
+        ring(tracing.SPAWN, i, "web", 0, 100 + i, 0)
+    ring.close()
+    assert [record[4] for record in tracing.read_ring(
+        str(tmp_path / "ring"))] == [106, 107, 108, 109]
@@ -0,0 +1,80 @@
+import os
+import time
+
+import linux
+from process import ProcessStates
+
+
+TRACKED = {"exitcodes": 0, "stoptime": 5,
+           "taskmasterd": {"trackinterval": 0}}
+
+
+def alive(pid):
+    fields = linux.proc_stat(pid)
+    return fields is not None and fields[0] != b"Z"
+
+
+def test_follows_child_in_process_group(make_supervisor, wait_for):
+    supervisor = make_supervisor(cmd="sh -c 'sleep 30 & exit 0'", **TRACKED)
+    process = supervisor.table[supervisor.names.process_id("daemon", 0)]
+    process.start()
+    leader = process.pid
+    wait_for(supervisor, lambda: process.pid != leader)
+    worker = process.pid
+    assert linux.proc_stat(worker)[2] == b"%d" % leader
+    assert process.state in (ProcessStates.STARTING, ProcessStates.RUNNING)
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    assert not alive(worker)
+    supervisor.close()
+
+
+def test_follows_orphan_that_left_the_session(make_supervisor, wait_for):
+    assert linux.set_subreaper()
+    supervisor = make_supervisor(
+        cmd="sh -c 'setsid sh -c \"sleep 30 & sleep 30\" & sleep 0.2'",
+        **TRACKED)
+    process = supervisor.table[supervisor.names.process_id("daemon", 0)]
+    process.start()
+    leader = process.pid
+    wait_for(supervisor, lambda: process.pid != leader)
+    master = process.pid
+    assert linux.parent_pid(master) == os.getpid()
+    assert linux.proc_stat(master)[3] == b"%d" % master
+    workers = list(process.members)
+    assert workers
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    assert not alive(master)
+    assert not any(alive(pid) for pid in workers)
+    supervisor.close()
+
+
+def test_reaps_stray_grandchildren(make_supervisor, wait_for):
+    assert linux.set_subreaper()
+    supervisor = make_supervisor(cmd="sh -c 'sleep 0.2 & exit 3'",
+                                 starttime=5, **TRACKED)
+    process = supervisor.table[supervisor.names.process_id("daemon", 0)]
+    process.start()
+    wait_for(supervisor, lambda: process.state == ProcessStates.FATAL)
+    time.sleep(0.3)
+    supervisor.tick(0.5)
+    children = [pid for pid, fields in linux.processes().items()
+                if int(fields[1]) == os.getpid() and fields[0] == b"Z"]
+    assert children == []
+    supervisor.close()
+
+
+def test_clean_exit_skips_the_proc_walk(make_supervisor, wait_for,
+                                        monkeypatch):
+    supervisor = make_supervisor(**TRACKED)
+    process = supervisor.table[supervisor.names.process_id("daemon", 0)]
+    process.start()
+    walks = []
+    processes = linux.processes
+    monkeypatch.setattr(linux, "processes",
+                        lambda: walks.append(1) or processes())
+    process.stop()
+    wait_for(supervisor, lambda: process.state == ProcessStates.STOPPED)
+    assert walks == []
+    supervisor.close()